@@ -1,4 +1,5 @@
-def ivcurve(mechanism_name, i_type, vmin=-100, vmax=100, deltav=1, transient_time=50, test_time=50, rs=1, vinit=-665):
+def ivcurve(mechanism_name, i_type, vmin=-100, vmax=100, deltav=1, transient_time=50, test_time=50, rs=1, vinit=-665,
+            processes=None, pool=None, checkpoint=True, settle_tol=None, settle_window=1):
     """
     Returns the (peak) current-voltage relationship for an ion channel.
 
@@ -12,6 +13,18 @@ def ivcurve(mechanism_name, i_type, vmin=-100, vmax=100, deltav=1, transient_tim
         test_time = duration of the voltage clamp tests (ms)
         rs = resistance of voltage clamp in MOhm
         vinit = initialization voltage
+        processes = number of worker processes to spread the voltage steps over
+                    (Default: None, run everything in this process)
+        pool = a multiprocessing.Pool to use instead of starting a new one. Workers
+               keep their clamp setup between calls, so passing the same pool to
+               repeated calls avoids rebuilding it. The current dt, celsius and
+               mechanism parameters are sent to the workers with every call.
+        checkpoint = equilibrate at vinit only once, save the state with SaveState and
+                     restore it before every test step (Default: True)
+        settle_tol = if given, end a test step early once the peak has passed and the
+                     current has varied by less than settle_tol over the last
+                     settle_window ms
+        settle_window = see settle_tol (ms)
 
     Returns:
         i = iterable of peak currents (in mA/cm^2)
@@ -23,45 +36,447 @@ def ivcurve(mechanism_name, i_type, vmin=-100, vmax=100, deltav=1, transient_tim
         strongly hyperpolarizing vinit will uninactivate many channels, leading to more
         current.
     """
+    table = ivtable(mechanism_name, [i_type], vmin=vmin, vmax=vmax, deltav=deltav,
+                    transient_time=transient_time, test_time=test_time, rs=rs, vinit=vinit,
+                    processes=processes, pool=pool, checkpoint=checkpoint,
+                    settle_tol=settle_tol, settle_window=settle_window)
+    return list(table[i_type + '_peak']), table['v']
+
+def ivtable(mechanism_name, variables, vmin=-100, vmax=100, deltav=1, transient_time=50, test_time=50, rs=1,
+            vinit=-665, processes=None, pool=None, checkpoint=True, settle_tol=None, settle_window=1,
+            cache=False, cache_dir=None):
+    """
+    Runs one voltage-clamp sweep and records several variables at once, e.g. all
+    the currents of a mechanism together with its conductances and gating states.
+
+    Args:
+        mechanism_name = name of the mechanism (e.g. hh)
+        variables = list of range variables to record (e.g. ['ik', 'ina', 'gna_hh', 'm_hh'])
+        cache, cache_dir = see state_curves (Default: no caching)
+        all other arguments are as for ivcurve. With settle_tol, a test step ends once
+        every recorded variable has settled.
+
+    Returns:
+        table = structured numpy array with one row per test voltage and the fields
+                v = test voltage
+                <var>_peak = value furthest from the start of the test step
+                <var>_ss = value at the end of the test step (steady state)
+                <var>_tpeak = time of the peak after the start of the step (ms)
+
+    Example:
+        table = ivtable('hh', ['ik', 'ina'])
+        pyplot.plot(table['v'], table['ina_peak'])
+        pyplot.plot(table['v'], table['ik_ss'])
+    """
+    import numpy
+    if isinstance(variables, str):
+        variables = [variables]
+    variables = tuple(variables)
+    result_v = numpy.arange(vmin, vmax, deltav)
+    protocol = (transient_time, test_time, vinit, checkpoint, settle_tol, settle_window, None, _peak_measure)
+
+    def compute():
+        result = _sweep(mechanism_name, variables, rs, result_v, protocol, processes, pool)
+        return _table(result_v, variables, ['peak', 'ss', 'tpeak'], result)
+    if not cache:
+        return compute()
+    return _cached(mechanism_name, (variables, rs, tuple(result_v), protocol[:-1]), compute, cache_dir)
+
+def state_curves(mechanism_name, states, vmin=-100, vmax=100, deltav=1, vinit=-120, hold_time=50,
+                 step_time=100, rs=1, processes=None, pool=None, cache=True, cache_dir=None):
+    """
+    Returns the steady-state value (e.g. activation/inactivation) and the time
+    constant of gating states as a function of voltage, all in one sweep.
+
+    Each state is held at vinit for hold_time, then stepped to every test voltage for
+    step_time. The steady state is the value at the end of the step and the time
+    constant is the area between the trajectory and its steady state divided by the
+    total change, which is exact for a first-order state that has fully relaxed.
+
+    Args:
+        mechanism_name = name of the mechanism (e.g. hh)
+        states = list of states to analyze (e.g. ['m_hh', 'h_hh', 'n_hh'])
+        vmin, vmax, deltav = range of test voltages
+        vinit = holding potential before the steps
+        hold_time = time at the holding potential (ms)
+        step_time = duration of the steps, should be several time constants (ms)
+        rs = resistance of voltage clamp in MOhm
+        processes, pool = see ivcurve
+        cache = reuse results computed before for the same mechanism parameters
+                (Default: True)
+        cache_dir = optional directory to also keep the results in between sessions
+
+    Returns:
+        table = structured numpy array with one row per test voltage and the fields
+                v = test voltage
+                <state>_inf = steady-state value
+                <state>_tau = time constant (ms), nan where the state does not change
+
+    Note:
+        Results are cached on the mechanism name, the values of its parameters and
+        globals, the ion concentrations and reversal potentials, celsius, the
+        integration method and the protocol. Changes to other mechanisms or to the
+        rest of the model do not invalidate the cache.
+    """
+    import numpy
+    if isinstance(states, str):
+        states = [states]
+    states = tuple(states)
+    result_v = numpy.arange(vmin, vmax, deltav)
+    protocol = (hold_time, step_time, vinit, True, None, 1, None, _tau_measure)
+
+    def compute():
+        result = _sweep(mechanism_name, states, rs, result_v, protocol, processes, pool)
+        return _table(result_v, states, ['inf', 'tau'], result)
+    if not cache:
+        return compute()
+    return _cached(mechanism_name, ('states', states, rs, tuple(result_v), protocol[:-1]), compute, cache_dir)
+
+def tau_curve(mechanism_name, state, **kwargs):
+    """
+    Returns the time constant of one gating state as a function of voltage.
+
+    Args:
+        mechanism_name = name of the mechanism (e.g. hh)
+        state = state to analyze (e.g. m_hh)
+        **kwargs passes on to state_curves
+
+    Returns:
+        tau = array of time constants (ms)
+        v = array of corresponding test voltages
+    """
+    table = state_curves(mechanism_name, [state], **kwargs)
+    return table[state + '_tau'], table['v']
+
+def activation_curve(mechanism_name, variable, vmin=-100, vmax=100, deltav=1, vinit=-120, hold_time=50,
+                     test_time=50, rs=1, processes=None, pool=None, cache=True, cache_dir=None):
+    """
+    Returns the normalized peak of a conductance (or current) during voltage steps
+    from a hyperpolarized holding potential.
+
+    Args:
+        mechanism_name = name of the mechanism (e.g. hh)
+        variable = variable to measure (e.g. gna_hh)
+        other arguments are as for state_curves
+
+    Returns:
+        g = array of peak values, divided by the largest one
+        v = array of corresponding test voltages
+    """
+    import numpy
+    table = ivtable(mechanism_name, [variable], vmin=vmin, vmax=vmax, deltav=deltav,
+                    transient_time=hold_time, test_time=test_time, rs=rs, vinit=vinit,
+                    processes=processes, pool=pool, cache=cache, cache_dir=cache_dir)
+    g = table[variable + '_peak']
+    return g / numpy.max(numpy.abs(g)), table['v']
+
+def inactivation_curve(mechanism_name, variable, vtest=0, vmin=-100, vmax=100, deltav=1, vinit=-120,
+                       hold_time=50, prepulse_time=100, test_time=20, rs=1, processes=None, pool=None,
+                       cache=True, cache_dir=None):
+    """
+    Returns the normalized peak of a conductance (or current) at vtest after a long
+    prepulse to each test voltage (steady-state inactivation protocol).
+
+    Args:
+        mechanism_name = name of the mechanism (e.g. hh)
+        variable = variable to measure (e.g. gna_hh)
+        vtest = voltage of the test pulse following the prepulse
+        prepulse_time = duration of the prepulses (ms)
+        test_time = duration of the test pulse (ms)
+        other arguments are as for state_curves
+
+    Returns:
+        g = array of peak values at vtest, divided by the largest one
+        v = array of corresponding prepulse voltages
+    """
+    import numpy
+    variables = (variable,)
+    result_v = numpy.arange(vmin, vmax, deltav)
+    protocol = (hold_time, prepulse_time, vinit, True, None, 1, (vtest, test_time), _peak_measure)
+
+    def compute():
+        result = _sweep(mechanism_name, variables, rs, result_v, protocol, processes, pool)
+        return _table(result_v, variables, ['peak', 'ss', 'tpeak'], result)
+    if cache:
+        table = _cached(mechanism_name, ('inactivation', variables, rs, tuple(result_v), protocol[:-1]),
+                        compute, cache_dir)
+    else:
+        table = compute()
+    g = table[variable + '_peak']
+    return g / numpy.max(numpy.abs(g)), table['v']
+
+def _sweep(mechanism_name, variables, rs, test_vs, protocol, processes, pool):
+    """Helper function, runs the protocol for every test voltage here or in worker processes."""
     from neuron import h
     import numpy
     h.load_file('stdrun.hoc')
+    if processes is None and pool is None:
+        clamp = _Clamp(h, mechanism_name, variables, rs)
+        return clamp.run(test_vs, *protocol)
+
+    from multiprocessing import Pool, cpu_count
+    nchunks = processes if processes is not None else cpu_count()
+    chunks = [c for c in numpy.array_split(test_vs, nchunks) if len(c)]
+    # workers of a reused pool keep the state they were forked with, so send along
+    # everything _cached keys the results on
+    settings = (bool(h.CVode().active()), h.dt, h.celsius, _mechanism_params(h, mechanism_name))
+    tasks = [(mechanism_name, variables, rs, settings, c, protocol) for c in chunks]
+    if pool is None:
+        own_pool = Pool(processes)
+        try:
+            results = own_pool.map(_ivcurve_worker, tasks)
+        finally:
+            own_pool.close()
+            own_pool.join()
+    else:
+        results = pool.map(_ivcurve_worker, tasks)
+    return numpy.concatenate(results)
+
+def _table(test_vs, variables, fields, result):
+    """Helper function, turns a (voltages x fields x variables) array into a structured array."""
+    import numpy
+    dtype = [('v', test_vs.dtype)]
+    for var in variables:
+        dtype += [(var + '_' + f, float) for f in fields]
+    table = numpy.empty(len(test_vs), dtype=dtype)
+    table['v'] = test_vs
+    for (j, var) in enumerate(variables):
+        for (k, f) in enumerate(fields):
+            table[var + '_' + f] = result[:, k, j]
+    return table
+
+# results of earlier runs, keyed on the mechanism parameters and the protocol
+_curve_cache = {}
+
+def _cached(mechanism_name, args, compute, cache_dir=None):
+    """Helper function, returns compute() from the cache if the same run was done before."""
+    from neuron import h
+    import numpy
+    key = (mechanism_name, _mechanism_params(h, mechanism_name), h.celsius, bool(h.CVode().active()),
+           h.dt, args)
+    if key in _curve_cache:
+        return _curve_cache[key].copy()
+    fname = None
+    if cache_dir is not None:
+        import os
+        import hashlib
+        fname = os.path.join(cache_dir, '%s_%s.npy' % (mechanism_name, hashlib.sha1(repr(key).encode()).hexdigest()))
+        if os.path.exists(fname):
+            _curve_cache[key] = numpy.load(fname)
+            return _curve_cache[key].copy()
+    table = compute()
+    _curve_cache[key] = table
+    if fname is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        numpy.save(fname, table)
+    return table.copy()
+
+def _mechanism_params(h, mechanism_name):
+    """
+    Helper function, returns a hashable summary of everything that determines the
+    behavior of a mechanism: its parameters and globals, and the ion concentrations
+    and reversal potentials of a section it is inserted in.
+    """
+    name = h.ref('')
+    params = []
+    for vartype in (1, -1):
+        ms = h.MechanismStandard(mechanism_name, vartype)
+        for i in range(int(ms.count())):
+            ms.name(name, i)
+            if vartype == 1:
+                params.append((name[0], ms.get(name[0])))
+            else:
+                params.append((name[0], getattr(h, name[0])))
     sec = h.Section()
     sec.insert(mechanism_name)
-    sec.L = 1
-    sec.diam = 1
-    seclamp = h.SEClamp(sec(0.5))
-    seclamp.amp1 = vinit
-    seclamp.dur1 = transient_time
-    seclamp.dur2 = test_time 
-    seclamp.rs = rs
-    i_record = h.Vector()
-    i_record.record(sec(0.5).__getattribute__('_ref_' + i_type))
-    result_i = []
-    result_v = numpy.arange(vmin, vmax, deltav)
-    for test_v in result_v:
-        seclamp.amp2 = test_v
-        h.finitialize(vinit)
-        h.continuerun(transient_time)
-        num_transient_points = len(i_record)
-        h.continuerun(test_time + transient_time)
-        i_record2 = i_record.as_numpy()[num_transient_points:]
-        baseline_i = i_record2[0]
-        i_record_shift = i_record2 - baseline_i
-        max_i = max(i_record_shift)
-        min_i = min(i_record_shift)
-        peak_i = max_i if abs(max_i) > abs(min_i) else min_i
-        peak_i += baseline_i
-        result_i.append(peak_i)
-    return result_i, result_v
+    ions = sec.psection()['ions']
+    for ion in sorted(ions):
+        for var in sorted(ions[ion]):
+            params.append((var, tuple(ions[ion][var])))
+    return tuple(params)
+
+def _peak_measure(t, x):
+    """
+    Helper function, returns the peak, steady state and time-to-peak of each row of
+    x, where t is the time since the start of the step.
+    """
+    import numpy
+    rows = numpy.arange(len(x))
+    # the peak is the largest excursion from the value at the start of the step
+    baseline = x[:, 0]
+    x_shift = x - baseline[:, None]
+    i_max = x_shift.argmax(axis=1)
+    i_min = x_shift.argmin(axis=1)
+    max_x = x_shift[rows, i_max]
+    min_x = x_shift[rows, i_min]
+    i_peak = numpy.where(numpy.abs(max_x) > numpy.abs(min_x), i_max, i_min)
+    return numpy.array([x_shift[rows, i_peak] + baseline, x[:, -1], t[i_peak]])
+
+def _tau_measure(t, x):
+    """
+    Helper function, returns the steady state and the time constant of each row
+    of x, assuming first-order relaxation.
+    """
+    import numpy
+    x_inf = x[:, -1]
+    change = x_inf - x[:, 0]
+    # integral of (x_inf - x) dt is change * tau for an exponential relaxation
+    dt = numpy.diff(t)
+    area = numpy.sum((2 * x_inf[:, None] - x[:, 1:] - x[:, :-1]) * dt, axis=1) / 2
+    ok = numpy.abs(change) > 1e-9
+    tau = numpy.full(len(x), numpy.nan)
+    tau[ok] = area[ok] / change[ok]
+    return numpy.array([x_inf, tau])
+
+class _Clamp(object):
+    """
+    Helper class, a single-compartment section with the mechanism inserted and an
+    SEClamp, recording one or more range variables.
+    """
+    def __init__(self, h, mechanism_name, variables, rs):
+        self.h = h
+        self.sec = sec = h.Section()
+        sec.insert(mechanism_name)
+        sec.L = 1
+        sec.diam = 1
+        self.seclamp = h.SEClamp(sec(0.5))
+        self.seclamp.rs = rs
+        self.records = []
+        for var in variables:
+            vec = h.Vector()
+            vec.record(sec(0.5).__getattribute__('_ref_' + var))
+            self.records.append(vec)
+        self.t_record = h.Vector()
+        self.t_record.record(h._ref_t)
+
+    def run(self, test_vs, transient_time, test_time, vinit, checkpoint=True, settle_tol=None, settle_window=1,
+            post=None, measure=None):
+        """
+        Steps to each test voltage after the transient at vinit and returns a
+        (test voltages x measures x variables) array of measure(t, x) for the step.
+        With post = (v, duration), a final step follows each test step and is
+        measured instead. The default measure is the peak, steady state and
+        time-to-peak.
+        """
+        import numpy
+        h = self.h
+        if measure is None:
+            measure = _peak_measure
+        seclamp = self.seclamp
+        seclamp.amp1 = vinit
+        seclamp.dur1 = transient_time
+        seclamp.dur2 = test_time
+        tstop = transient_time + test_time
+        tmeasure = transient_time
+        if post is not None:
+            seclamp.amp3, seclamp.dur3 = post
+            tstop += post[1]
+            tmeasure += test_time
+        else:
+            seclamp.dur3 = 0
+        if checkpoint:
+            # the transient is the same for every test voltage; run it once
+            h.finitialize(vinit)
+            h.continuerun(transient_time)
+            state = h.SaveState()
+            state.save()
+        result = []
+        for test_v in test_vs:
+            seclamp.amp2 = test_v
+            if checkpoint:
+                state.restore()
+                if h.CVode().active():
+                    h.CVode().re_init()
+                h.frecord_init()
+                num_transient_points = 1
+            else:
+                h.finitialize(vinit)
+                h.continuerun(transient_time)
+                num_transient_points = len(self.t_record)
+            self._test(tstop, num_transient_points, settle_tol, settle_window)
+            t, x = self._traces(num_transient_points)
+            start = numpy.searchsorted(t, tmeasure - 1e-6) if post is not None else 0
+            result.append(measure(t[start:] - tmeasure, x[:, start:]))
+        return numpy.array(result)
+
+    def _traces(self, start):
+        """Returns the time vector and a (variables x time) array of the test step."""
+        import numpy
+        t = self.t_record.as_numpy()[start:]
+        x = numpy.array([vec.as_numpy()[start:] for vec in self.records])
+        return t, x
+
+    def _test(self, tstop, start, settle_tol, settle_window):
+        """Runs the test step, optionally stopping once every variable has settled."""
+        h = self.h
+        if settle_tol is None:
+            h.continuerun(tstop)
+            return
+        import numpy
+        while h.t < tstop - 1e-6:
+            tnext = min(h.t + settle_window, tstop)
+            if h.CVode().active():
+                # continuerun does not stop at intermediate times with CVode
+                h.CVode().solve(tnext)
+            else:
+                h.continuerun(tnext)
+            t, x = self._traces(start)
+            recent = numpy.nonzero(t > h.t - settle_window)[0]
+            if len(recent) == 0 or recent[0] == 0:
+                continue
+            peak = numpy.argmax(numpy.abs(x - x[:, :1]), axis=1)
+            if numpy.all(peak < recent[0]) and numpy.all(numpy.ptp(x[:, recent], axis=1) < settle_tol):
+                break
+
+# clamp setups kept alive in each worker process, keyed on (mechanism_name, variables, rs)
+_worker_clamps = {}
+
+def _ivcurve_worker(task):
+    """Helper function, runs a chunk of voltage steps in a worker process."""
+    from neuron import h
+    mechanism_name, variables, rs, settings, test_vs, protocol = task
+    h.load_file('stdrun.hoc')
+    key = (mechanism_name, variables, rs)
+    if key not in _worker_clamps:
+        _worker_clamps[key] = _Clamp(h, mechanism_name, variables, rs)
+    clamp = _worker_clamps[key]
+    _apply_settings(h, clamp.sec(0.5), mechanism_name, settings)
+    return clamp.run(test_vs, *protocol)
+
+def _apply_settings(h, seg, mechanism_name, settings):
+    """
+    Helper function, copies the integrator settings, celsius and the mechanism
+    parameters of the parent process (see _mechanism_params) into a worker, setting
+    the range parameters and ion variables in seg.
+    """
+    cvode_active, dt, celsius, params = settings
+    h.CVode().active(cvode_active)
+    h.dt = dt
+    h.celsius = celsius
+    name = h.ref('')
+    ms = h.MechanismStandard(mechanism_name, -1)
+    global_names = set()
+    for i in range(int(ms.count())):
+        ms.name(name, i)
+        global_names.add(name[0])
+    currents = set('i' + ion for ion in seg.sec.psection()['ions'])
+    for (var, value) in params:
+        if var in global_names:
+            setattr(h, var, value)
+        elif isinstance(value, tuple):
+            if var not in currents:
+                setattr(seg, var, value[0])
+        else:
+            setattr(seg, var, value)
 
 if __name__ == '__main__':
     from matplotlib import pyplot
     import numpy
     from neuron import h
     h.CVode().active(1)
-    ik, v = ivcurve('hh', 'ik')
-    pyplot.plot(v, ik, label='ik')
+    table = ivtable('hh', ['ik', 'ina'])
+    pyplot.plot(table['v'], table['ik_peak'], label='ik')
     ina, v = ivcurve('hh', 'ina', vinit=-100)
     pyplot.plot(v, ina, label='ina')
     pyplot.xlabel('v (mV)')
@@ -2,9 +2,11 @@ from __future__ import division
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import cm
-import string
+from matplotlib.colors import Normalize
 from neuron import h
 import numbers
+import os
+import hashlib
 
 # a helper library, included with NEURON
 h.load_file('stdlib.hoc')
@@ -12,6 +14,7 @@ h.load_file('import3d.hoc')
 
 class Cell:
     def __init__(self,name='neuron',soma=None,apic=None,dend=None,axon=None):
+        self.name = name
         self.soma = soma if soma is not None else []
         self.apic = apic if apic is not None else []
         self.dend = dend if dend is not None else []
@@ -28,7 +31,8 @@ class Cell:
     def __str__(self):
         return self.name
 
-def load(filename, fileformat=None, cell=None, use_axon=True, xshift=0, yshift=0, zshift=0):
+def load(filename, fileformat=None, cell=None, use_axon=True, xshift=0, yshift=0, zshift=0, import3d=False,
+         cache=True):
     """
     Load an SWC from filename and instantiate inside cell. Code kindly provided
     by @ramcdougal.
@@ -39,6 +43,10 @@ def load(filename, fileformat=None, cell=None, use_axon=True, xshift=0, yshift=0
         filename = the filename of the SWC file
         use_axon = include the axon? Default: True (yes)
         xshift, yshift, zshift = use to position the cell
+        import3d = read SWC files with NEURON's Import3d tools instead of the
+                   faster load_swc (Default: False)
+        cache = reuse the parsed morphology of earlier loads of the same file
+                (Default: True, see read_morphology)
 
     Returns:
         Cell() object with populated soma, axon, dend, & apic fields
@@ -53,12 +61,28 @@ def load(filename, fileformat=None, cell=None, use_axon=True, xshift=0, yshift=0
     """
 
     if cell is None:
-        cell = Cell(name=string.join(filename.split('.')[:-1]))
+        cell = Cell(name=' '.join(filename.split('.')[:-1]))
 
     if fileformat is None:
         fileformat = filename.split('.')[-1]
 
-    name_form = {1: 'soma[%d]', 2: 'axon[%d]', 3: 'dend[%d]', 4: 'apic[%d]'}
+    template = read_morphology(filename, fileformat=fileformat, import3d=import3d, cache=cache)
+    return instantiate(template, cell, use_axon=use_axon, xshift=xshift, yshift=yshift, zshift=zshift)
+
+def read_import3d(filename, fileformat=None):
+    """
+    Reads a morphology with NEURON's Import3d tools into a morphology template
+    (see read_swc).
+
+    Args:
+        filename = morphology file
+        fileformat = 'swc' or 'asc' (Default: None, use the file extension)
+
+    Returns:
+        template = dict of arrays, see read_swc
+    """
+    if fileformat is None:
+        fileformat = filename.split('.')[-1]
 
     # load the data. Use Import3d_SWC_read for swc, Import3d_Neurolucida3 for
     # Neurolucida V3, Import3d_MorphML for MorphML (level 1 of NeuroML), or
@@ -78,62 +102,468 @@ def load(filename, fileformat=None, cell=None, use_axon=True, xshift=0, yshift=0
 
     # get a list of the swc section objects
     swc_secs = i3d.swc.sections
-    swc_secs = [swc_secs.object(i) for i in xrange(int(swc_secs.count()))]
-
-    # initialize the lists of sections
-    sec_list = {1: cell.soma, 2: cell.axon, 3: cell.dend, 4: cell.apic}
+    swc_secs = [swc_secs.object(i) for i in range(int(swc_secs.count()))]
 
-    # name and create the sections
-    real_secs = {}
+    points, offsets, parent, parentx, types, style = [], [0], [], [], [], []
+    index = {}
     for swc_sec in swc_secs:
-        cell_part = int(swc_sec.type)
-
-        # skip everything else if it's an axon and we're not supposed to
-        # use it... or if is_subsidiary
-        if (not(use_axon) and cell_part == 2) or swc_sec.is_subsidiary:
+        # skip subsidiary sections
+        if swc_sec.is_subsidiary:
             continue
-        
-        # figure out the name of the new section
-        if cell_part not in name_form:
-            raise Exception('unsupported point type')
-        name = name_form[cell_part] % len(sec_list[cell_part])
+        if swc_sec.iscontour_:
+            # never happens in SWC files, but can happen in other formats supported
+            # by NEURON's Import3D GUI
+            raise Exception('Unsupported section style: contour')
 
-        # create the section
-        sec = h.Section(name=name, cell=cell)
-        
-        # connect to parent, if any
         if swc_sec.parentsec is not None:
-            sec.connect(real_secs[swc_sec.parentsec.hname()](swc_sec.parentx))
+            parent.append(index[swc_sec.parentsec.hname()])
+        else:
+            parent.append(-1)
+        parentx.append(swc_sec.parentx)
+        types.append(int(swc_sec.type))
 
         # define shape
         if swc_sec.first == 1:
-            h.pt3dstyle(1, swc_sec.raw.getval(0, 0), swc_sec.raw.getval(1, 0),
-                        swc_sec.raw.getval(2, 0), sec=sec)
+            style.append([swc_sec.raw.getval(i, 0) for i in range(3)])
+        else:
+            style.append([np.nan]*3)
+        j = int(swc_sec.first)
+        xyzd = np.array([list(swc_sec.raw.getrow(i).c(j)) for i in range(3)] + [list(swc_sec.d.c(j))]).T
+        if len(xyzd) == 1:
+            # single point soma; treat as sphere
+            xyzd = np.repeat(xyzd,3,axis=0)
+            xyzd[:,0] += np.array([-1,0,1]) * xyzd[:,3] / 2.
+        points.append(xyzd)
+        offsets.append(offsets[-1] + len(xyzd))
+        index[swc_sec.hname()] = len(types) - 1
 
-        j = swc_sec.first
-        xx, yy, zz = [swc_sec.raw.getrow(i).c(j) for i in xrange(3)]
-        dd = swc_sec.d.c(j)
-        if swc_sec.iscontour_:
-            # never happens in SWC files, but can happen in other formats supported
-            # by NEURON's Import3D GUI
-            raise Exception('Unsupported section style: contour')
+    return {'points': np.concatenate(points), 'offsets': np.array(offsets), 'parent': np.array(parent),
+            'parentx': np.array(parentx,dtype=float), 'type': np.array(types), 'style': np.array(style)}
 
-        if dd.size() == 1:
-            # single point soma; treat as sphere
-            x, y, z, d = [dim.x[0] for dim in [xx, yy, zz, dd]]
-            for xprime in [x - d / 2., x, x + d / 2.]:
-                h.pt3dadd(xprime + xshift, y + yshift, z + zshift, d, sec=sec)
-        else:
-            for x, y, z, d in zip(xx, yy, zz, dd):
-                h.pt3dadd(x + xshift, y + yshift, z + zshift, d, sec=sec)
+# morphology templates are kept in memory and, as .npz files, in this directory,
+# named after the hash of the morphology file (None: keep them in memory only)
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'PyNeuronToolbox', 'morphology')
+_templates = {}
 
-        # store the section in the appropriate list in the cell and lookup table               
-        sec_list[cell_part].append(sec)    
-        real_secs[swc_sec.hname()] = sec
+def read_morphology(filename, fileformat=None, import3d=False, cache=True):
+    """
+    Reads a morphology file into a template (see read_swc), reusing the result of
+    earlier reads of files with the same contents.
+
+    On the first read, the template is written to cache_dir as an .npz file of
+    float32 points, section offsets, parent indices, connection locations and
+    type codes. Later reads of any file with the same contents (and format) only
+    load that file.
+
+    Args:
+        filename = morphology file
+        fileformat = 'swc' or 'asc' (Default: None, use the file extension)
+        import3d = read SWC files with NEURON's Import3d tools instead of the
+                   faster read_swc (Default: False)
+        cache = use and update the cache (Default: True)
+
+    Returns:
+        template = dict of arrays, see read_swc
+    """
+    if fileformat is None:
+        fileformat = filename.split('.')[-1]
+    reader = 'import3d' if import3d or fileformat != 'swc' else 'swc'
+
+    def read():
+        if reader == 'swc':
+            return read_swc(filename)
+        return read_import3d(filename, fileformat)
+    if not cache:
+        return read()
+
+    with open(filename, 'rb') as f:
+        key = '%s_%s_%s_v%d' % (hashlib.sha1(f.read()).hexdigest(), fileformat, reader, _template_version)
+    if key in _templates:
+        return _templates[key]
+    fname = None if cache_dir is None else os.path.join(cache_dir, key + '.npz')
+    if fname is not None and os.path.exists(fname):
+        template = load_template(fname)
+    else:
+        template = _compact(read())
+        if fname is not None:
+            try:
+                save_template(fname, template)
+            except (IOError, OSError):
+                pass # e.g. read-only home directory; keep the template in memory only
+    _templates[key] = template
+    return template
+
+# increase when the layout of templates changes, to invalidate old cache files
+_template_version = 1
+
+def _compact(template):
+    """Helper function, converts a template to the cached (compact) data types."""
+    return {'points': np.asarray(template['points'],dtype=np.float32),
+            'offsets': np.asarray(template['offsets'],dtype=np.int64),
+            'parent': np.asarray(template['parent'],dtype=np.int32),
+            'parentx': np.asarray(template['parentx'],dtype=np.float32),
+            'type': np.asarray(template['type'],dtype=np.int16),
+            'style': np.asarray(template['style'],dtype=np.float32)}
+
+def save_template(filename, template):
+    """ Writes a morphology template (see read_swc) to an .npz file """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # write to a temporary file first so that readers never see a partial file
+    tmp = '%s.%d.tmp.npz' % (filename[:-4] if filename.endswith('.npz') else filename, os.getpid())
+    np.savez(tmp, **_compact(template))
+    os.rename(tmp, filename)
+
+def load_template(filename):
+    """ Reads a morphology template written by save_template """
+    with np.load(filename) as f:
+        return dict((name, f[name]) for name in f.files)
+
+def load_swc(filename, cell=None, use_axon=True, xshift=0, yshift=0, zshift=0, cache=True):
+    """
+    Load an SWC from filename and instantiate inside cell, without going through
+    NEURON's Import3d tools. Produces the same sections, connections and 3D points
+    as load, but parses the file with numpy and adds the points of each section
+    in one call.
+
+    Args:
+        filename = .swc file containing morphology
+        cell = Cell() object. (Default: None, creates new object)
+        use_axon = include the axon? Default: True (yes)
+        xshift, yshift, zshift = use to position the cell
+        cache = reuse the parsed morphology of earlier loads of the same file
+                (Default: True, see read_morphology)
+
+    Returns:
+        Cell() object with populated soma, axon, dend, & apic fields
+    """
+    if cell is None:
+        cell = Cell(name=' '.join(filename.split('.')[:-1]))
+    template = read_morphology(filename, fileformat='swc', cache=cache)
+    return instantiate(template, cell, use_axon=use_axon, xshift=xshift, yshift=yshift, zshift=zshift)
+
+def read_swc(filename):
+    """
+    Parses an SWC file into a morphology template, following the rules of
+    NEURON's Import3d_SWC_read: sections are split at branch points and at
+    changes of point type, a section with a single point (such as a
+    single-point soma, or the NeuroMorpho.Org three-point soma) is treated
+    as a sphere, and dendrites attached to the soma start at the parent
+    point with their own diameter.
+
+    Args:
+        filename = .swc file containing morphology
+
+    Returns:
+        template = dict of arrays, see instantiate
+            points = (number of points x 4) array of x, y, z, diam for all sections
+            offsets = section k has points[offsets[k]:offsets[k+1]]
+            parent = index of the parent section (-1 for the root)
+            parentx = location on the parent section to connect to
+            type = SWC type code of each section
+            style = logical connection point (x, y, z) of sections connected
+                    by a wire (see pt3dstyle), nan for the others
+    """
+    with open(filename) as f:
+        lines = [line for line in f.read().splitlines()
+                 if line.strip() and not line.lstrip().startswith('#')]
+    tokens = ' '.join(lines).split()
+    if len(tokens) == 7*len(lines):
+        data = np.array(tokens,dtype=float).reshape(-1,7)
+    else:
+        data = np.array([line.split()[:7] for line in lines],dtype=float)
+    if np.any(np.diff(data[:,0]) <= 0):
+        data = data[np.argsort(data[:,0],kind='mergesort')]
+    ids = data[:,0]
+    types = data[:,1].astype(int)
+    # Import3d reads coordinates in single precision
+    xyzd = data[:,2:6].astype(np.float32).astype(float)
+    xyzd[:,3] *= 2 # radius to diameter
+    n = len(ids)
+
+    # index of the parent point, -1 for roots
+    pix = np.minimum(np.searchsorted(ids,data[:,6]),n-1)
+    pix = np.where((data[:,6] >= 0) & (ids[pix] == data[:,6]), pix, -1)
+    idx = np.arange(n)
+
+    # count the children of each point; a point with exactly one contiguous
+    # child of the same type is inside a section, any other point ends one
+    child = np.nonzero(pix >= 0)[0]
+    p = pix[child]
+    noncontig = p != child - 1
+    typediff = types[p] != types[child]
+    grandparent = pix[p]
+    # children attached to the start of a section that is wired to the soma
+    # connect to the proximal end of that section
+    prox = noncontig & ((p == 0) & (types[p] != 1) |
+                        (p > 1) & (types[p] != 1) & (grandparent >= 0) & (types[grandparent] == 1))
+    connect2prox = np.zeros(n,dtype=bool)
+    connect2prox[child[prox]] = True
+    # ...and the parent is then counted as if it had one child so far
+    last_prox = np.full(n,-1)
+    np.maximum.at(last_prox,p[prox],child[prox])
+    keep = child >= last_prox[p]
+    extra = typediff + noncontig*(child != last_prox[p])
+    nchild = np.bincount(p[keep],minlength=n)
+    nextra = np.bincount(p[keep],weights=extra[keep],minlength=n)
+    section_end = (nchild != 1) | (nextra != 0)
+
+    # number of soma children of each soma point
+    soma_child = (types == 1) & (pix >= 0)
+    soma_child[soma_child] = types[pix[soma_child]] == 1
+    soma_child[0] = False
+    nchild_soma = np.bincount(pix[soma_child],minlength=n)
+
+    # NeuroMorpho.Org three-point soma: a cylinder with length equal to its
+    # diameter, centered on the first point, is treated as a sphere
+    soma3geom = False
+    if np.count_nonzero(types == 1) == 3 and n >= 3 and pix[1] == 0 and pix[2] == 0 and \
+            nchild[1] == 0 and nchild[2] == 0 and xyzd[1,3] == xyzd[0,3] and xyzd[2,3] == xyzd[0,3]:
+        length = np.sum(np.sqrt(np.sum((xyzd[1:3,:3] - xyzd[0,:3])**2,axis=1)))
+        if xyzd[0,3] != 0 and abs(length/xyzd[0,3] - 1) < .01:
+            soma3geom = True
+            pix[2] = 1
+
+    # consecutive soma points stay in one section unless the soma branches
+    contiguous = (types[:-1] == 1) & (types[1:] == 1) & (pix[1:] == idx[:-1]) & \
+                 ~((idx[:-1] != 0) & (nchild_soma[:-1] > 1))
+    section_end[:-1][contiguous] = False
+
+    point2sec = np.searchsorted(np.nonzero(section_end)[0],idx)
+    starts = np.concatenate(([0],np.nonzero(np.diff(point2sec))[0] + 1))
+    stops = np.append(starts[1:],n)
+    if soma3geom:
+        stops[0] = 1
+    nsec = len(starts)
+    sec_type = types[starts]
+
+    # connect each section to its parent
+    pp = pix[starts]
+    root = pp < 0
+    parent = np.where(root,-1,point2sec[np.maximum(pp,0)])
+    ps = np.maximum(parent,0)
+    ptype = sec_type[ps]
+    den_con_soma = ~root & (ptype == 1) & (sec_type != 1)
+    con_soma = ~root & (ptype == 1)
+    multi = stops - starts > 1
+    # number of points of the parent section, which includes the parent point
+    # for everything but the root
+    par_npts = stops[ps] - starts[ps] + (ps != 0)
+    parentx = np.ones(nsec)
+    wire = np.zeros(nsec,dtype=bool)
+
+    to_root = ~root & (ps == 0)
+    single = to_root & den_con_soma & (par_npts == 1)
+    parentx[single] = 0.5
+    wire |= single & multi
+    to_first = to_root & ~single & (pp == starts[ps])
+    parentx[to_first] = 0.0
+    wire |= to_first & (sec_type != 1) & (nchild_soma[np.maximum(pp,0)] > 1)
+
+    rest = ~(single | to_first) & con_soma
+    last = starts[ps] + par_npts + np.where(ps == 0,-1,-2)
+    interior = rest & (pp < last)
+    parentx[interior] = 0.5
+    wire |= interior & den_con_soma & multi
+    wire |= rest & ~interior & multi & (nchild_soma[np.maximum(pp,0)] > 1) & (sec_type != 1)
+    parentx[connect2prox[starts]] = 0.0
+
+    style = np.full((nsec,3),np.nan)
+    style[wire] = xyzd[pp[wire],:3]
+
+    # gather the points: the parent point first (unless wired), then the
+    # section's own points; any section left with a single point (a root
+    # or a wired one-point branch) becomes a sphere along x
+    with_parent = ~root & ~wire
+    sphere = stops - starts + with_parent == 1
+    npts = np.where(sphere,3,stops - starts + with_parent)
+    offsets = np.concatenate(([0],np.cumsum(npts)))
+    local = np.arange(offsets[-1]) - np.repeat(offsets[:-1],npts)
+    sec = np.repeat(np.arange(nsec),npts)
+    src = starts[sec] - with_parent[sec] + np.where(sphere[sec],0,local)
+    first = (local == 0) & with_parent[sec]
+    src[first] = pp[sec[first]]
+    points = xyzd[src]
+    # dendrites attached to the soma take their own diameter at the parent point
+    fix = first & (ptype[sec] == 1) & (sec_type[sec] != 1)
+    points[fix,3] = xyzd[starts[sec[fix]],3]
+    in_sphere = sphere[sec]
+    points[in_sphere,0] += (local[in_sphere] - 1) * points[in_sphere,3] / 2.
+
+    return {'points': points, 'offsets': offsets, 'parent': parent, 'parentx': parentx,
+            'type': sec_type, 'style': style}
+
+def instantiate(template, cell=None, use_axon=True, xshift=0, yshift=0, zshift=0, rotation=None):
+    """
+    Creates the sections of a morphology template (see read_swc) inside cell.
+
+    Args:
+        template = dict of arrays, as returned by read_swc
+        cell = Cell() object. (Default: None, creates new object)
+        use_axon = include the axon? Default: True (yes)
+        xshift, yshift, zshift = use to position the cell
+        rotation = optional 3x3 rotation matrix (see rotation_matrix), applied
+                   about the origin of the file's coordinates before the shift
+
+    Returns:
+        Cell() object with populated soma, axon, dend, & apic fields
+    """
+    if cell is None:
+        cell = Cell()
+    points, style = _transform(template, [[xshift,yshift,zshift]], None if rotation is None else [rotation])
+    return _build_cell(template, points[0], style[0], cell, use_axon)
+
+def _transform(template, shifts, rotations=None):
+    """
+    Helper function, returns the points and style points of a template moved to
+    each of the shifts (and rotated by each of the rotations), as arrays of shape
+    (cells x points x 4) and (cells x sections x 3).
+    """
+    shifts = np.asarray(shifts,dtype=float)
+    xyzd = np.asarray(template['points'],dtype=float)
+    style = np.asarray(template['style'],dtype=float)
+    points = np.empty((len(shifts),) + xyzd.shape)
+    points[:,:,3] = xyzd[:,3]
+    if rotations is None:
+        points[:,:,:3] = xyzd[:,:3] + shifts[:,None,:]
+        style = style + shifts[:,None,:]
+    else:
+        rotations = np.asarray(rotations,dtype=float)
+        points[:,:,:3] = np.einsum('nij,pj->npi',rotations,xyzd[:,:3]) + shifts[:,None,:]
+        style = np.einsum('nij,sj->nsi',rotations,style) + shifts[:,None,:]
+    return points, style
+
+def _build_cell(template, points, style, cell, use_axon):
+    """Helper function, creates the sections of a template with the given (transformed) points."""
+    name_form = {1: 'soma[%d]', 2: 'axon[%d]', 3: 'dend[%d]', 4: 'apic[%d]'}
+    sec_list = {1: cell.soma, 2: cell.axon, 3: cell.dend, 4: cell.apic}
+
+    offsets = template['offsets']
+    xyzd = _pt3d_vectors(points)
+    real_secs = []
+    for (k,(cell_part,parent,parentx)) in enumerate(zip(template['type'],template['parent'],template['parentx'])):
+        cell_part = int(cell_part)
+        # skip the axon if we're not supposed to use it (and anything attached to it)
+        if (not(use_axon) and cell_part == 2) or (parent >= 0 and real_secs[parent] is None):
+            real_secs.append(None)
+            continue
+        if cell_part not in name_form:
+            raise Exception('unsupported point type')
+        name = name_form[cell_part] % len(sec_list[cell_part])
+
+        sec = h.Section(name=name, cell=cell)
+        if parent >= 0:
+            sec.connect(real_secs[parent](parentx))
+        if not np.isnan(style[k,0]):
+            h.pt3dstyle(1, style[k,0], style[k,1], style[k,2], sec=sec)
+        _pt3dadd(xyzd, offsets[k], offsets[k+1], sec)
+
+        sec_list[cell_part].append(sec)
+        real_secs.append(sec)
 
     cell.all = cell.soma + cell.apic + cell.dend + cell.axon
     return cell
 
+def _pt3d_vectors(xyzd):
+    """Helper function, the x, y, z and diam columns of a (points x 4) array as hoc Vectors."""
+    # copying pieces of one hoc Vector is much faster than converting many small arrays
+    return [h.Vector(np.ascontiguousarray(xyzd[:,i],dtype=float)) for i in range(4)]
+
+def _pt3dadd(vecs, start, stop, sec):
+    """Helper function, adds points start to stop-1 of the _pt3d_vectors vecs to sec."""
+    if stop > start:
+        h.pt3dadd(vecs[0].c(start,stop-1), vecs[1].c(start,stop-1), vecs[2].c(start,stop-1),
+                  vecs[3].c(start,stop-1), sec=sec)
+
+def rotation_matrix(axis, angle):
+    """
+    Returns the 3x3 matrix of a rotation by angle (radians) about axis, e.g.
+    rotation_matrix([0,0,1], np.pi/2) rotates the x axis onto the y axis.
+    """
+    axis = np.asarray(axis,dtype=float)
+    x, y, z = axis / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c + x*x*(1-c), x*y*(1-c) - z*s, x*z*(1-c) + y*s],
+                     [y*x*(1-c) + z*s, c + y*y*(1-c), y*z*(1-c) - x*s],
+                     [z*x*(1-c) - y*s, z*y*(1-c) + x*s, c + z*z*(1-c)]])
+
+class MorphologyTemplate(object):
+    """
+    A morphology parsed once, from which any number of cells can be created.
+
+    Args:
+        filename = morphology file (.swc or .asc)
+        fileformat, import3d, cache = as for load
+        use_axon = include the axon? Default: True (yes)
+        name = base name of the cells (Default: the file name without extension)
+        template = use this template (see read_swc) instead of reading filename
+
+    Example:
+        pyr = MorphologyTemplate('c91662.swc')
+        cells = pyr.population(positions, rotations=[rotation_matrix([0,0,1],a) for a in angles])
+        cells[3].soma[0]      # c91662[3].soma[0]
+        cell = pyr.cell(xshift=100)
+    """
+    def __init__(self, filename=None, fileformat=None, use_axon=True, import3d=False, cache=True,
+                 name=None, template=None):
+        if template is None:
+            template = read_morphology(filename, fileformat=fileformat, import3d=import3d, cache=cache)
+        if name is None:
+            name = 'neuron' if filename is None else ' '.join(filename.split('.')[:-1])
+        self.template = template
+        self.use_axon = use_axon
+        self.name = name
+        self.ncells = 0
+
+    def _next_name(self):
+        name = '%s[%d]' % (self.name, self.ncells)
+        self.ncells += 1
+        return name
+
+    def cell(self, xshift=0, yshift=0, zshift=0, rotation=None, name=None):
+        """
+        Creates one cell, moved by (xshift, yshift, zshift) after the optional
+        rotation. Cells are named <name>[i] unless a name is given.
+        """
+        if name is None:
+            name = self._next_name()
+        return instantiate(self.template, Cell(name=name), use_axon=self.use_axon,
+                           xshift=xshift, yshift=yshift, zshift=zshift, rotation=rotation)
+
+    def population(self, positions, rotations=None, names=None):
+        """
+        Creates one cell for each row of positions (an N x 3 array of shifts),
+        transforming the points of all cells at once.
+
+        Args:
+            positions = N x 3 array of shifts
+            rotations = optional N x 3 x 3 array of rotation matrices (or a single
+                        3 x 3 matrix for all cells), applied before the shifts
+            names = optional list of N cell names (Default: <name>[i])
+
+        Returns:
+            list of N Cell() objects
+        """
+        positions = np.atleast_2d(np.asarray(positions,dtype=float))
+        if rotations is not None:
+            rotations = np.asarray(rotations,dtype=float)
+            if rotations.ndim == 2:
+                rotations = np.repeat(rotations[None],len(positions),axis=0)
+        if names is None:
+            names = [self._next_name() for i in range(len(positions))]
+        cells = []
+        # transform a block of cells at a time to bound the memory used
+        block = max(1, 2**22 // max(1, len(self.template['points'])))
+        for start in range(0,len(positions),block):
+            stop = start + block
+            points, style = _transform(self.template, positions[start:stop],
+                                       None if rotations is None else rotations[start:stop])
+            for i in range(len(points)):
+                cells.append(_build_cell(self.template, points[i], style[i], Cell(name=names[start+i]),
+                                         self.use_axon))
+        return cells
+
 def sequential_spherical(xyz):
     """
     Converts sequence of cartesian coordinates into a sequence of
@@ -207,58 +637,162 @@ def interpolate_jagged(xyz,nseg):
     Returns:
         interp_xyz = interpolated path
     """
-    
-    # Spherical coordinates specifying the angles of all line
-    # segments that make up the section path
-    (r,theta,phi) = sequential_spherical(xyz)
-    
-    # cumulative length of section path at each coordinate
-    rcum = np.append(0,np.cumsum(r))
+    # thin view onto the flat buffer computed by interpolate_jagged_batch
+    coords, offsets = interpolate_jagged_batch(xyz,[0,len(xyz)],[nseg])
+    return [ coords[offsets[a]:offsets[a+1]] for a in range(nseg) ]
 
-    # breakpoints for segment paths along section path
-    breakpoints = np.linspace(0,rcum[-1],nseg+1)
-    np.delete(breakpoints,0)
-    
-    # Find segment paths
-    seg_paths = []
-    for a in range(nseg):
-        path = []
-        
-        # find (x,y,z) starting coordinate of path
-        if a == 0:
-            start_coord = xyz[0,:]
-        else:
-            start_coord = end_coord # start at end of last path
-        path.append(start_coord)
-
-        # find all coordinates between the start and end points
-        start_length = breakpoints[a]
-        end_length = breakpoints[a+1]
-        mid_boolean = (rcum > start_length) & (rcum < end_length)
-        mid_indices = np.nonzero(mid_boolean)[0]
-        for mi in mid_indices:
-            path.append(xyz[mi,:])
-
-        # find (x,y,z) ending coordinate of path
-        end_coord = find_coord(end_length,xyz,rcum,theta,phi)
-        path.append(end_coord)
-
-        # Append path to list of segment paths
-        seg_paths.append(np.array(path))
-    
-    # Return all segment paths
-    return seg_paths
+def interpolate_jagged_batch(xyz,pt_offsets,nseg):
+    """
+    Interpolates segment paths for many sections at once. All section
+    paths are concatenated into a single array and processed in one pass
+    with np.searchsorted and linear interpolation.
+
+    Args:
+        xyz = 2d numpy array with the 3D points of all sections stacked
+              on top of each other
+        pt_offsets = section k owns the points xyz[pt_offsets[k]:pt_offsets[k+1]]
+        nseg = number of segments in each section (1D array-like)
+
+    Returns:
+        coords = 2d numpy array holding the points of all segment paths,
+                 one after the other (section by section, then segment
+                 by segment)
+        offsets = segment path g is coords[offsets[g]:offsets[g+1]]
+    """
+    xyz = np.asarray(xyz,dtype=float)
+    pt_offsets = np.asarray(pt_offsets,dtype=int)
+    nseg = np.asarray(nseg,dtype=int)
+    nsec = len(nseg)
+    lo, hi = pt_offsets[:-1], pt_offsets[1:]
+
+    # arc length along the concatenated path; the steps between the last
+    # point of one section and the first point of the next count as zero
+    r = np.linalg.norm(np.diff(xyz,axis=0),axis=1)
+    r[hi[:-1]-1] = 0
+    rcum = np.append(0,np.cumsum(r))
+    start = rcum[lo]
+    end = rcum[np.maximum(hi-1,lo)]
+    length = end - start
+
+    # breakpoints for segment paths along each section path
+    sec_of_bp = np.repeat(np.arange(nsec),nseg+1)
+    bp_offsets = np.append(0,np.cumsum(nseg+1))
+    frac = (np.arange(len(sec_of_bp)) - bp_offsets[sec_of_bp]) / nseg[sec_of_bp]
+    # the last breakpoint is set to the section end, which start+length
+    # may miss by a rounding error
+    breakpoints = np.where(frac < 1, start[sec_of_bp] + frac*length[sec_of_bp], end[sec_of_bp])
+
+    # cartesian coordinates of the breakpoints: find the line segment
+    # containing each breakpoint, then interpolate linearly along it
+    i = np.searchsorted(rcum,breakpoints,side='right') - 1
+    i = np.clip(i,lo[sec_of_bp],np.maximum(hi[sec_of_bp]-2,lo[sec_of_bp]))
+    j = np.minimum(i+1,hi[sec_of_bp]-1)
+    step = rcum[j] - rcum[i]
+    t = np.where(step > 0, (breakpoints-rcum[i])/np.where(step > 0,step,1), 0)
+    t = np.clip(t,0,1)
+    bp_xyz = xyz[i] + t[:,None]*(xyz[j]-xyz[i])
+
+    # points of the section paths strictly inside a segment path
+    sec_of_pt = np.repeat(np.arange(nsec),hi-lo)
+    q = np.searchsorted(breakpoints,rcum,side='right') - 1
+    q = np.clip(q,bp_offsets[sec_of_pt],bp_offsets[sec_of_pt+1]-2)
+    inside = (rcum > start[sec_of_pt]) & (rcum < end[sec_of_pt]) \
+             & (rcum > breakpoints[q])
+    mid_pts = np.nonzero(inside)[0]
+    mid_seg = q[mid_pts] - sec_of_pt[mid_pts] # global segment index
+
+    # layout: [start, interior points..., end] for each segment path
+    nsegs_total = int(nseg.sum())
+    counts = 2 + np.bincount(mid_seg,minlength=nsegs_total)
+    offsets = np.append(0,np.cumsum(counts))
+    coords = np.empty((offsets[-1],3))
+    seg_bp = np.arange(nsegs_total) + np.repeat(np.arange(nsec),nseg)
+    coords[offsets[:-1]] = bp_xyz[seg_bp]
+    coords[offsets[1:]-1] = bp_xyz[seg_bp+1]
+    rank = np.arange(len(mid_seg)) - np.searchsorted(mid_seg,mid_seg)
+    coords[offsets[mid_seg]+1+rank] = xyz[mid_pts]
+
+    return coords, offsets
 
 def get_section_path(h,sec):
+    """
+    Returns the 3D points of a section path as an (n3d x 3) numpy array.
+    """
+    return get_section_points(h,sec)[:,:3]
+
+def get_section_points(h,sec):
+    """
+    Extracts all 3D points of a section in one go.
+
+    Args:
+        h = hocObject to interface with neuron
+        sec = h.Section() object
+
+    Returns:
+        xyzd = (n3d x 4) numpy array, columns are x, y, z and diam
+    """
     n3d = int(h.n3d(sec=sec))
-    xyz = []
-    for i in range(0,n3d):
-        xyz.append([h.x3d(i,sec=sec),h.y3d(i,sec=sec),h.z3d(i,sec=sec)])
-    xyz = np.array(xyz)
-    return xyz
+    xyzd = np.empty((n3d,4))
+    _fill_points(h,sec,xyzd)
+    return xyzd
+
+def get_points(h,sections):
+    """
+    Extracts the 3D points of a list of sections into one contiguous array.
+
+    Args:
+        h = hocObject to interface with neuron
+        sections = list of h.Section() objects
+
+    Returns:
+        xyzd = (total n3d x 4) numpy array, columns are x, y, z and diam
+        offsets = section k owns the rows xyzd[offsets[k]:offsets[k+1]]
+    """
+    n3d = [ int(h.n3d(sec=sec)) for sec in sections ]
+    offsets = np.append(0,np.cumsum(n3d)).astype(int)
+    xyzd = np.empty((offsets[-1],4))
+    for k,sec in enumerate(sections):
+        _fill_points(h,sec,xyzd[offsets[k]:offsets[k+1]])
+    return xyzd, offsets
+
+def _fill_points(h,sec,out):
+    """
+    Helper function, copies the 3D points of sec into the (n3d x 4) array
+    out. NEURON does not expose the pt3d arrays as a buffer, so this is the
+    single place where the points are read one by one.
+    """
+    n3d = len(out)
+    if hasattr(sec,'x3d'):
+        # NEURON 7.7+, bound accessors avoid pushing the section each call
+        for j,f in enumerate((sec.x3d,sec.y3d,sec.z3d,sec.diam3d)):
+            out[:,j] = np.fromiter(map(f,range(n3d)),float,n3d)
+    else:
+        sec.push()
+        try:
+            for j,f in enumerate((h.x3d,h.y3d,h.z3d,h.diam3d)):
+                out[:,j] = np.fromiter(map(f,range(n3d)),float,n3d)
+        finally:
+            h.pop_section()
+
+def segment_paths(h,sections):
+    """
+    Computes the paths of all segments in a list of sections in a single
+    batch (see interpolate_jagged_batch).
+
+    Args:
+        h = hocObject to interface with neuron
+        sections = list of h.Section() objects
+
+    Returns:
+        coords = 2d numpy array holding the points of all segment paths
+        offsets = segment path i is coords[offsets[i]:offsets[i+1]]
+    """
+    xyzd, pt_offsets = get_points(h,sections)
+    nseg = [ sec.nseg for sec in sections ]
+    return interpolate_jagged_batch(xyzd[:,:3],pt_offsets,nseg)
 
 def shapeplot(h,ax,sections=None,order='pre',cvals=None,\
-              clim=None,cmap=cm.YlOrBr_r,**kwargs):
+              clim=None,cmap=cm.YlOrBr_r,mode='lines',**kwargs):
     """
     Plots a 3D shapeplot
 
@@ -271,10 +805,15 @@ def shapeplot(h,ax,sections=None,order='pre',cvals=None,\
         cvals = list/array with values mapped to color by cmap; useful
                 for displaying voltage, calcium or some other state
                 variable across the shapeplot.
+        mode = { 'lines'= one matplotlib line per segment
+                 'collection'= a single LineCollection (Line3DCollection
+                               on 3D axes) for all segments; much faster
+                               for large cells }
         **kwargs passes on to matplotlib (e.g. color='r' for red lines)
 
     Returns:
-        lines = list of line objects making up shapeplot
+        lines = list of line objects making up shapeplot, or the
+                collection if mode='collection'
     """
     
     # Default is to plot all sections. 
@@ -291,48 +830,209 @@ def shapeplot(h,ax,sections=None,order='pre',cvals=None,\
             clim = [np.min(cvals[cn]), np.max(cvals[cn])]
 
     # Plot each segement as a line
+    coords, offsets = segment_paths(h,sections)
+    if mode == 'collection':
+        return _shapeplot_collection(ax,coords,offsets,cvals,clim,cmap,**kwargs)
+    elif mode != 'lines':
+        raise ValueError("Unrecognized option '%s' for mode" % mode)
+
     lines = []
-    i = 0
-    for sec in sections:
-        xyz = get_section_path(h,sec)
-        seg_paths = interpolate_jagged(xyz,sec.nseg)
-
-        for (j,path) in enumerate(seg_paths):
-            line, = plt.plot(path[:,0], path[:,1], path[:,2], '-k',**kwargs)
-            if cvals is not None:
-                if isinstance(cvals[i], numbers.Number):
-                    # map number to colormap
-                    col = cmap(int((cvals[i]-clim[0])*255/(clim[1]-clim[0])))
-                else:
-                    # use input directly. E.g. if user specified color with a string.
-                    col = cvals[i]
-                line.set_color(col)
-            lines.append(line)
-            i += 1
+    for i in range(len(offsets)-1):
+        path = coords[offsets[i]:offsets[i+1]]
+        line, = plt.plot(path[:,0], path[:,1], path[:,2], '-k',**kwargs)
+        if cvals is not None:
+            if isinstance(cvals[i], numbers.Number):
+                # map number to colormap
+                col = cmap(int((cvals[i]-clim[0])*255/(clim[1]-clim[0])))
+            else:
+                # use input directly. E.g. if user specified color with a string.
+                col = cvals[i]
+            line.set_color(col)
+        lines.append(line)
+
+    return lines
+
+def _shapeplot_collection(ax,coords,offsets,cvals,clim,cmap,**kwargs):
+    """
+    Helper function for shapeplot, draws all segment paths as a single
+    collection and maps cvals to colors in one step.
+    """
+    three_d = hasattr(ax,'get_zlim')
+    if three_d:
+        from mpl_toolkits.mplot3d.art3d import Line3DCollection
+        paths = [ coords[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1) ]
+    else:
+        from matplotlib.collections import LineCollection
+        paths = [ coords[offsets[i]:offsets[i+1],:2] for i in range(len(offsets)-1) ]
+
+    if cvals is None and 'color' not in kwargs and 'colors' not in kwargs:
+        kwargs['colors'] = 'k'
+
+    if three_d:
+        lines = Line3DCollection(paths,**kwargs)
+        ax.add_collection3d(lines)
+        ax.auto_scale_xyz(coords[:,0],coords[:,1],coords[:,2],ax.has_data())
+    else:
+        lines = LineCollection(paths,**kwargs)
+        ax.add_collection(lines)
+        ax.autoscale_view()
+
+    if cvals is not None:
+        if all(isinstance(cv, numbers.Number) for cv in cvals):
+            # colors are mapped through norm and cmap when the figure is drawn
+            lines.set_array(np.asarray(cvals,dtype=float))
+            lines.set_cmap(cmap)
+            lines.set_norm(Normalize(clim[0],clim[1]))
+        else:
+            # use input directly. E.g. if user specified color with a string.
+            lines.set_color([ cmap(Normalize(clim[0],clim[1])(cv)) \
+                              if isinstance(cv, numbers.Number) else cv \
+                              for cv in cvals ])
 
     return lines
 
 def shapeplot_animate(v,lines,nframes=None,tscale='linear',\
                       clim=[-80,50],cmap=cm.YlOrBr_r):
-    """ Returns animate function which updates color of shapeplot """
+    """
+    Returns animate function which updates color of shapeplot. lines is
+    either the list of lines or the collection returned by shapeplot.
+    The colors of all frames are computed up front, so that each frame
+    only has to assign an array of colors.
+    """
     if nframes is None:
         nframes = v.shape[0]
-    if tscale == 'linear':
+    t_index = _frame_indices(v.shape[0],nframes,tscale)
+    lut, cidx = _frame_colors(v,t_index,clim,cmap)
+
+    if isinstance(lines,list):
         def animate(i):
-            i_t = int((i/nframes)*v.shape[0])
+            colors = lut[cidx[i]]
             for i_seg in range(v.shape[1]):
-                lines[i_seg].set_color(cmap(int((v[i_t,i_seg]-clim[0])*255/(clim[1]-clim[0]))))
+                lines[i_seg].set_color(colors[i_seg])
             return []
-    elif tscale == 'log':
+    else:
+        # a single collection, colors are set directly rather than
+        # mapped from an array at draw time
+        lines.set_array(None)
         def animate(i):
-            i_t = int(np.round((v.shape[0] ** (1.0/(nframes-1))) ** i - 1))
-            for i_seg in range(v.shape[1]):
-                lines[i_seg].set_color(cmap(int((v[i_t,i_seg]-clim[0])*255/(clim[1]-clim[0]))))
+            lines.set_color(lut[cidx[i]])
             return []
+
+    return animate
+
+def shapeplot_movie(h,v,filename,sections=None,order='pre',nframes=None,\
+                    tscale='linear',clim=[-80,50],cmap=cm.YlOrBr_r,\
+                    processes=None,view=None,figsize=(8,8),dpi=100,\
+                    video=None,fps=30,**kwargs):
+    """
+    Renders an animated shapeplot offline, splitting the frames across
+    worker processes. Frames are drawn with the Agg backend, so no
+    interactive backend is involved.
+
+    Args:
+        h = hocObject to interface with neuron
+        v = (time x segments) array of values mapped to color, e.g. the
+            output of ez_convert
+        filename = pattern for the frame files, e.g. 'frames/v_%05d.png'
+        sections, order = sections to plot (see shapeplot)
+        nframes, tscale, clim, cmap = see shapeplot_animate
+        processes = number of worker processes (Default: None, one per cpu)
+        view = (elev, azim) camera angles of the 3D axes
+        figsize, dpi = size and resolution of each frame
+        video = optional video filename; the frames are joined with ffmpeg
+        fps = frame rate of the video
+        **kwargs passes on to the LineCollection (e.g. lw=2)
+
+    Returns:
+        frames = list of filenames of the rendered frames
+    """
+    from multiprocessing import Pool, cpu_count
+
+    if sections is None:
+        if order == 'pre':
+            sections = allsec_preorder(h)
+        else:
+            sections = list(h.allsec())
+    coords, offsets = segment_paths(h,sections)
+
+    if nframes is None:
+        nframes = v.shape[0]
+    t_index = _frame_indices(v.shape[0],nframes,tscale)
+    lut, cidx = _frame_colors(v,t_index,clim,cmap)
+
+    options = dict(filename=filename,view=view,figsize=figsize,dpi=dpi,kwargs=kwargs)
+    if processes is None:
+        processes = cpu_count()
+    pool = Pool(processes,initializer=_movie_worker_init,\
+                initargs=(coords,offsets,lut,cidx,options))
+    try:
+        chunks = np.array_split(np.arange(nframes),processes)
+        frames = pool.map(_movie_worker_render,[ c for c in chunks if len(c) ])
+    finally:
+        pool.close()
+        pool.join()
+    frames = [ f for chunk in frames for f in chunk ]
+
+    if video is not None:
+        import subprocess
+        subprocess.check_call(['ffmpeg','-y','-loglevel','error','-framerate',\
+                               str(fps),'-i',filename,'-pix_fmt','yuv420p',video])
+    return frames
+
+def _frame_indices(nt,nframes,tscale):
+    """ Helper function, maps each animation frame onto a time index """
+    if tscale == 'linear':
+        return ((np.arange(nframes)/nframes)*nt).astype(int)
+    elif tscale == 'log':
+        return np.round((nt ** (1.0/(nframes-1))) ** np.arange(nframes) - 1).astype(int)
     else:
         raise ValueError("Unrecognized option '%s' for tscale" % tscale)
 
-    return animate
+def _frame_colors(v,t_index,clim,cmap):
+    """
+    Helper function, maps v onto colormap indices for all frames in one pass.
+
+    Returns:
+        lut = (cmap.N+2 x 4) array of rgba colors, including the colors
+              for values below and above clim
+        cidx = (nframes x segments) array, the colors of frame i are
+               lut[cidx[i]]
+    """
+    idx = ((v[t_index]-clim[0])*255/(clim[1]-clim[0])).astype(int)
+    cidx = (np.clip(idx,-1,cmap.N)+1).astype(np.int16)
+    lut = cmap(np.arange(-1,cmap.N+1))
+    return lut, cidx
+
+_movie_state = {}
+
+def _movie_worker_init(coords,offsets,lut,cidx,options):
+    """ Helper function, builds the figure once in each worker process """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from mpl_toolkits.mplot3d import Axes3D
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+    fig = Figure(figsize=options['figsize'])
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111,projection='3d')
+    if options['view'] is not None:
+        ax.view_init(*options['view'])
+    paths = [ coords[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1) ]
+    lines = Line3DCollection(paths,**options['kwargs'])
+    ax.add_collection3d(lines)
+    ax.auto_scale_xyz(coords[:,0],coords[:,1],coords[:,2])
+    _movie_state.update(fig=fig,lines=lines,lut=lut,cidx=cidx,options=options)
+
+def _movie_worker_render(frames):
+    """ Helper function, renders a chunk of frames to image files """
+    st = _movie_state
+    filenames = []
+    for i in frames:
+        st['lines'].set_color(st['lut'][st['cidx'][i]])
+        fname = st['options']['filename'] % i
+        st['fig'].savefig(fname,dpi=st['options']['dpi'])
+        filenames.append(fname)
+    return filenames
 
 def mark_locations(h,section,locs,markspec='or',**kwargs):
     """
@@ -372,6 +1072,103 @@ def mark_locations(h,section,locs,markspec='or',**kwargs):
                      xyz_marks[:,2], markspec, **kwargs)
     return line
 
+class MorphologyIndex(object):
+    """
+    Compiled view of the section tree. Built once by walking the topology,
+    after which parent/child/branch order queries are array lookups.
+
+    Args:
+        h = hocObject to interface with neuron
+        sections = list of h.Section() objects, or a Cell() object.
+                   (Default: None, uses h.allsec())
+
+    Attributes:
+        sections = list of sections in pre-order; section i of the index is
+                   sections[i]
+        parent = index of the parent section (-1 for roots)
+        child_ptr, child_idx = children of section i (CSR layout) are
+                               child_idx[child_ptr[i]:child_ptr[i+1]]
+        preorder = position of each section in a pre-order traversal
+        depth = number of sections between each section and its root
+        branch_order = branch order of each section
+        length = length (L) of each section
+        parent_x = location on the parent where each section is attached
+                   (0 for roots)
+        orientation = end of each section (0 or 1) attached to its parent
+    """
+    def __init__(self,h,sections=None):
+        if sections is None:
+            sections = list(h.allsec())
+        elif isinstance(sections,Cell):
+            sections = sections.all
+        sections = list(sections)
+
+        # a single pass over the topology; sections whose parent is not
+        # part of the index are treated as roots
+        members = set(sections)
+        children = {}
+        for sec in sections:
+            children[sec] = [ c for c in sec.children() if c in members ]
+        has_parent = set(c for ch in children.values() for c in ch)
+        roots = [ sec for sec in sections if sec not in has_parent ]
+
+        # iterative pre-order traversal
+        order = []
+        stack = roots[::-1]
+        while stack:
+            sec = stack.pop()
+            order.append(sec)
+            stack.extend(children[sec][::-1])
+        
+        self.sections = order
+        self._lookup = { sec:i for i,sec in enumerate(order) }
+        n = len(order)
+        nchild = [ len(children[sec]) for sec in order ]
+        self.child_ptr = np.append(0,np.cumsum(nchild)).astype(int)
+        self.child_idx = np.array([ self._lookup[c] for sec in order \
+                                    for c in children[sec] ],dtype=int)
+        self.parent = -np.ones(n,dtype=int)
+        self.parent[self.child_idx] = np.repeat(np.arange(n),nchild)
+        self.preorder = np.arange(n)
+        self.length = np.array([ sec.L for sec in order ],dtype=float)
+        self.parent_x = np.zeros(n)
+        for i in np.nonzero(self.parent >= 0)[0]:
+            self.parent_x[i] = order[i].parentseg().x
+        self.orientation = np.array([ h.section_orientation(sec=sec) for sec in order ])
+
+        # parents precede their children in pre-order
+        depth = [0]*n
+        border = [0]*n
+        for i,p in enumerate(self.parent.tolist()):
+            if p >= 0:
+                depth[i] = depth[p] + 1
+                border[i] = border[p] + (nchild[p] > 1)
+        self.depth = np.array(depth,dtype=int)
+        self.branch_order = np.array(border,dtype=int)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def index(self,section):
+        """ Returns the position of section in the index """
+        return self._lookup[section]
+
+    def children(self,i):
+        """ Returns the indices of the children of section i """
+        return self.child_idx[self.child_ptr[i]:self.child_ptr[i+1]]
+
+    @property
+    def nchild(self):
+        return np.diff(self.child_ptr)
+
+    @property
+    def roots(self):
+        return np.nonzero(self.parent < 0)[0]
+
+    @property
+    def leaves(self):
+        return np.nonzero(self.nchild == 0)[0]
+
 def root_sections(h):
     """
     Returns a list of all sections that have no parent.
@@ -380,31 +1177,32 @@ def root_sections(h):
     roots.allroots()
     return list(roots)
 
-def leaf_sections(h):
+def leaf_sections(h,index=None):
     """
-    Returns a list of all sections that have no children.
+    Returns a list of all sections that have no children. If a
+    MorphologyIndex is given, the leaves are returned in pre-order.
     """
+    if index is not None:
+        return [ index.sections[i] for i in index.leaves ]
     return [sec for sec in h.allsec() if not sec.children()]
 
 def root_indices(sec_list):
     """
-    Returns the index of all sections without a parent.
+    Returns the index of all sections without a parent. sec_list may also
+    be a MorphologyIndex.
     """
+    if isinstance(sec_list,MorphologyIndex):
+        return sec_list.roots.tolist()
     return [i for i, sec in enumerate(sec_list) if sec.parentseg() is None]
 
-def allsec_preorder(h):
+def allsec_preorder(h,index=None):
     """
     Alternative to using h.allsec(). This returns all sections in order from
     the root. Traverses the topology each neuron in "pre-order"
     """
-    #Iterate over all sections, find roots
-    roots = root_sections(h)
-
-    # Build list of all sections
-    sec_list = []
-    for r in roots:
-        add_pre(h,sec_list,r)
-    return sec_list
+    if index is None:
+        index = MorphologyIndex(h)
+    return list(index.sections)
 
 def add_pre(h,sec_list,section,order_list=None,branch_order=None):
     """
@@ -412,17 +1210,20 @@ def add_pre(h,sec_list,section,order_list=None,branch_order=None):
     of the morphology in pre-order. This is usually not necessary for the
     user to import.
     """
+    # explicit stack instead of recursion, so deep trees do not hit
+    # python's recursion limit
+    stack = [(section,branch_order)]
+    while stack:
+        sec, order = stack.pop()
+        sec_list.append(sec)
+        children = sec.children()
 
-    sec_list.append(section)
-    sref = h.SectionRef(sec=section)
+        if order is not None:
+            order_list.append(order)
+            if len(children) > 1:
+                order += 1
 
-    if branch_order is not None:
-        order_list.append(branch_order)
-        if len(sref.child) > 1:
-            branch_order += 1
-    
-    for next_node in sref.child:
-        add_pre(h,sec_list,next_node,order_list,branch_order)
+        stack.extend((c,order) for c in reversed(children))
 
 def dist_between(h,seg1,seg2):
     """
@@ -431,118 +1232,734 @@ def dist_between(h,seg1,seg2):
     (www.neuron.yale.edu/phpbb/viewtopic.php?f=2&t=2114)
     
     Note: In NEURON 7.7+, you can just do return h.distance(seg1, seg2)
+    For the distances between many segments, see PathDistances.
     """
     h.distance(0, seg1)
     return h.distance(seg2)
 
-def all_branch_orders(h):
+class PathDistances(object):
     """
-    Produces a list branch orders for each section (following pre-order tree
-    traversal)
+    Path distances between many segments at once. The section tree is
+    compiled into a tree of points: the center of every segment, plus
+    every point where a child section is attached. The distance between
+    two points u and v is then
+
+        dist(u) + dist(v) - 2*dist(lca(u,v))
+
+    where dist is the path distance from the root and lca(u,v) is the
+    lowest common ancestor of u and v, found by a range-minimum query
+    over the pre-order traversal of the points. Every query is a handful
+    of numpy operations, so a full 10^4 x 10^4 matrix takes seconds
+    instead of 10^8 calls to h.distance.
+
+    Args:
+        h = hocObject to interface with neuron
+        sections = list of h.Section() objects, a Cell() object or a
+                   MorphologyIndex (Default: None, uses h.allsec())
+
+    Attributes:
+        index = the MorphologyIndex of the sections
+        segments = list of all segments, section by section in pre-order
+        sec = position in index.sections of the section of each segment
+        x = location of each segment within its section
+
+    Distances between segments in different trees are inf.
+
+    Example:
+        dist = PathDistances(h, cell)
+        d = dist.from_origin(cell.soma[0](0.5))  # to every segment
+        D = dist.matrix()                        # all pairs
+        i, j, d = dist.sparse(50.0)              # all pairs closer than 50 um
     """
-    #Iterate over all sections, find roots
-    roots = []
-    for section in h.allsec():
-        sref = h.SectionRef(sec=section)
-        # has_parent returns a float... cast to bool
-        if sref.has_parent() < 0.9:
-            roots.append(section)
-
-    # Build list of all sections
-    order_list = []
-    for r in roots:
-        add_pre(h,[],r,order_list,0)
-    return order_list
-
-def branch_order(h,section, path=[]):
-    """
-    Returns the branch order of a section
-    """
-    path.append(section)
-    sref = h.SectionRef(sec=section)
-    # has_parent returns a float... cast to bool
-    if sref.has_parent() < 0.9:
-        return 0 # section is a root
-    else:
-        nchild = len(list(h.SectionRef(sec=sref.parent).child))
-        if nchild <= 1.1:
-            return branch_order(h,sref.parent,path)
+    def __init__(self,h,sections=None):
+        if isinstance(sections,MorphologyIndex):
+            index = sections
         else:
-            return 1+branch_order(h,sref.parent,path)
-
-def dist_to_mark(h, section, secdict, path=[]):
-    path.append(section)
-    sref = h.SectionRef(sec=section)
-    # print 'current : '+str(section)
-    # print 'parent  : '+str(sref.parent)
-    if secdict[sref.parent] is None:
-        # print '-> go to parent'
-        s = section.L + dist_to_mark(h, sref.parent, secdict, path)
-        # print 'summing, '+str(s)
-        return s
-    else:
-        # print 'end <- start summing: '+str(section.L)
-        return section.L # parent is marked
+            index = MorphologyIndex(h,sections)
+        self.index = index
+        nsec = len(index)
+        parent = index.parent
+        nseg = np.array([ sec.nseg for sec in index.sections ],dtype=int)
+        self.sec = np.repeat(np.arange(nsec),nseg)
+        first = np.append(0,np.cumsum(nseg))
+        self.x = (np.arange(first[-1]) - first[self.sec] + 0.5) / nseg[self.sec]
+        self.segments = [ seg for sec in index.sections for seg in sec ]
+        self._lookup = None
+
+        # the points of each section, ordered along the section from its
+        # attached end: a start point, then the segment centers and the
+        # attachment points of the children
+        child = np.nonzero(parent >= 0)[0]
+        self._nseg = nseg
+        junction = self._arc(parent[child],self._node_x(parent[child],index.parent_x[child]))
+        psec = np.concatenate((np.arange(nsec),self.sec,parent[child]))
+        pos = np.concatenate((np.zeros(nsec),self._arc(self.sec,self.x),junction))
+        kind = np.concatenate((np.zeros(nsec),np.ones(len(self.sec)),np.ones(len(child))))
+        tie = np.concatenate((-np.ones(nsec+len(self.sec)),child))
+
+        # visit the child sections in the reverse order of their attachment
+        # points; then the points of each section followed by its subtrees
+        # form a pre-order traversal of the tree of points
+        children = [[] for i in range(nsec)]
+        for k in np.lexsort((-child,-junction)):
+            children[parent[child[k]]].append(child[k])
+        rank = np.empty(nsec,dtype=int)
+        stack = index.roots.tolist()[::-1]
+        r = 0
+        while stack:
+            i = stack.pop()
+            rank[i] = r
+            r += 1
+            stack.extend(children[i][::-1])
+        order = np.lexsort((tie,pos,kind,rank[psec]))
+        psec, pos, tie = psec[order], pos[order], tie[order]
+        npts = len(order)
+        point = np.empty(npts,dtype=int)
+        point[order] = np.arange(npts)
+
+        # parent point: the previous point along the section, or for the
+        # start of a section the point where it is attached
+        start = point[:nsec]
+        self._seg_point = point[nsec:nsec+len(self.sec)]
+        jpoint = point[nsec+len(self.sec):]
+        up = np.arange(npts) - 1
+        up[start] = -1
+        up[start[child]] = jpoint
+
+        # path distance from the root and depth of every point; sections
+        # are visited parents first
+        sec_dist = np.zeros(nsec)
+        sec_depth = np.zeros(nsec,dtype=int)
+        for (c,j,a) in zip(child.tolist(),jpoint.tolist(),junction.tolist()):
+            p = parent[c]
+            sec_dist[c] = sec_dist[p] + a
+            sec_depth[c] = sec_depth[p] + j - start[p] + 1
+        # the extra last entry makes pairs from different trees (lca -1) inf
+        self._dist = np.append(sec_dist[psec] + pos,-np.inf)
+        depth = sec_depth[psec] + np.arange(npts) - start[psec]
+        self._pos, self._start = pos, start
+        self._count = np.bincount(psec,minlength=nsec)
+
+        # sparse table for range-minimum queries; the key of a point
+        # encodes its depth and its parent, and among the points of
+        # minimal depth between u and v all share the parent lca(u,v)
+        key = depth*(npts+1) + (up+1)
+        levels = max(1,int(np.log2(max(npts,1)))+1)
+        table = np.empty((levels,npts),dtype=key.dtype)
+        table[0] = key
+        for level in range(1,levels):
+            step = 1 << (level-1)
+            table[level,:npts-step] = np.minimum(table[level-1,:npts-step],table[level-1,step:])
+            table[level,npts-step:] = table[level-1,npts-step:]
+        self._table = table.ravel()
+        self._npts = npts
+        self._log2 = np.zeros(npts+1,dtype=int)
+        self._log2[2:] = np.floor(np.log2(np.arange(2,npts+1))).astype(int)
+
+    def _node_x(self,sec,x):
+        # neuron places anything attached at x (0 < x < 1) at the center of
+        # the segment containing x, as does h.distance
+        nseg = self._nseg[sec]
+        center = (np.minimum(np.floor(x*nseg),nseg-1) + 0.5) / nseg
+        return np.where((x > 0) & (x < 1),center,x)
+
+    def _arc(self,sec,x):
+        # distance of location x from the attached end of the sections
+        L = self.index.length[sec]
+        return np.where(self.index.orientation[sec] == 0,x*L,(1-x)*L)
+
+    def __len__(self):
+        return len(self.sec)
+
+    def segment_index(self,seg):
+        """ Returns the position of seg in segments """
+        if self._lookup is None:
+            self._lookup = { (seg.sec,seg.x):i for (i,seg) in enumerate(self.segments) }
+        return self._lookup[(seg.sec,seg.x)]
+
+    def _between(self,u,v):
+        # distances between arrays of points u and v
+        lo, hi = np.minimum(u,v), np.maximum(u,v)
+        k = self._log2[hi-lo]
+        row = k*self._npts
+        m = np.minimum(self._table[row+np.minimum(lo+1,hi)],self._table[row+hi-(1 << k)+1])
+        d = self._dist[u] + self._dist[v] - 2*self._dist[m % (self._npts+1) - 1]
+        return np.where(lo == hi,0.0,d)
+
+    def between(self,i,j):
+        """
+        Returns the distances between segments i and j (arrays of
+        positions in segments, broadcast against each other)
+        """
+        return self._between(self._seg_point[np.asarray(i)],self._seg_point[np.asarray(j)])
+
+    def from_origin(self,origin,segments=None):
+        """
+        Returns the distances from origin to all segments.
+
+        Args:
+            origin = a segment, or (section, x) for any location
+            segments = optional positions of the segments to measure
+                       (Default: all segments)
+        """
+        if isinstance(origin,tuple):
+            sec, x = origin
+        else:
+            sec, x = origin.sec, origin.x
+        s = self.index.index(sec)
+        cols = self._seg_point if segments is None else self._seg_point[np.asarray(segments)]
+
+        # the origin lies between two points of its section (or on one);
+        # the path to any segment leaves through one of them
+        a = float(self._arc(s,self._node_x(s,x)))
+        first = self._start[s]
+        last = first + self._count[s] - 1
+        k = first + np.searchsorted(self._pos[first:last+1],a,side='right') - 1
+        d = a - self._pos[k] + self._between(k,cols)
+        if k < last:
+            d = np.minimum(d,self._pos[k+1] - a + self._between(k+1,cols))
+        return d
+
+    def matrix(self,rows=None,cols=None):
+        """
+        Returns the matrix of distances between segments rows and cols
+        (arrays of positions in segments, Default: all segments)
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        cols = np.arange(len(self)) if cols is None else np.asarray(cols)
+        out = np.empty((len(rows),len(cols)))
+        for (r0,r1) in self._blocks(len(rows),len(cols)):
+            out[r0:r1] = self.between(rows[r0:r1,None],cols[None,:])
+        return out
+
+    def sparse(self,max_distance,rows=None,cols=None):
+        """
+        Returns all pairs of segments no further apart than max_distance,
+        as triplets (i, j, d) of row positions, column positions and
+        distances. A full matrix is never built, the pairs are found
+        block by block. To get a scipy matrix:
+            scipy.sparse.coo_matrix((d,(i,j)),shape=(len(rows),len(cols)))
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        cols = np.arange(len(self)) if cols is None else np.asarray(cols)
+        ii, jj, dd = [], [], []
+        for (r0,r1) in self._blocks(len(rows),len(cols)):
+            d = self.between(rows[r0:r1,None],cols[None,:])
+            i, j = np.nonzero(d <= max_distance)
+            ii.append(i+r0)
+            jj.append(j)
+            dd.append(d[i,j])
+        return np.concatenate(ii), np.concatenate(jj), np.concatenate(dd)
+
+    def _blocks(self,nrows,ncols):
+        # row blocks of about 2^20 entries
+        step = max(1,2**20 // max(ncols,1))
+        return [ (r,min(r+step,nrows)) for r in range(0,nrows,step) ] or [(0,0)]
+
+class SpatialIndex(object):
+    """
+    Spatial index over the segments of a morphology, for finding the
+    segments near points (e.g. to place synapses, couple extracellular
+    electrodes or annotate locations). Every segment path (see
+    segment_paths) is split into its straight pieces, and the pieces
+    are stored in a hashed uniform grid, so a query only measures the
+    pieces in the grid cells around each point. Distances are measured
+    to the centerline of the segment paths. All queries take an (n x 3)
+    array of points and are processed as one batch.
 
-def branch_precedence(h):
-    roots = root_sections(h)
-    leaves = leaf_sections(h)
-    seclist = allsec_preorder(h)
-    secdict = { sec:None for sec in seclist }
+    Args:
+        h = hocObject to interface with neuron
+        sections = list of h.Section() objects or a Cell() object
+                   (Default: None, uses h.allsec()). All sections need 3D
+                   points, call h.define_shape() first if necessary
+        cell_size = edge length of the grid cells (Default: four times the
+                    median length of the pieces)
+
+    Attributes:
+        segments = list of indexed segments; queries return positions in
+                   this list
+        sections = list of indexed sections
+
+    Example:
+        index = SpatialIndex(h, cell)
+        seg_idx, dist = index.nearest(points)
+        seg_idx, dist, offsets = index.ball(electrodes, 50.0)
+        near_first = [ index.segments[i] for i in seg_idx[offsets[0]:offsets[1]] ]
+        index.add(new_sections)
+    """
+    def __init__(self,h,sections=None,cell_size=None):
+        self.h = h
+        self.cell_size = cell_size
+        self.sections = []
+        self.segments = []
+        self._members = set()
+        self._a = np.zeros((0,3))
+        self._b = np.zeros((0,3))
+        self._piece_seg = np.zeros(0,dtype=int)
+        self._keys = np.zeros(0,dtype=np.int64)
+        self._pieces = np.zeros(0,dtype=int)
+        if sections is None:
+            sections = list(h.allsec())
+        self.add(sections)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add(self,sections=None):
+        """
+        Adds sections to the index. With no arguments, adds every section
+        in h.allsec() that is not indexed yet.
+        """
+        if sections is None:
+            sections = self.h.allsec()
+        elif isinstance(sections,Cell):
+            sections = sections.all
+        sections = [ sec for sec in sections if sec not in self._members ]
+        if not sections:
+            return
+
+        coords, offsets = segment_paths(self.h,sections)
+        npieces = np.diff(offsets) - 1
+        seg = np.repeat(np.arange(len(offsets)-1),npieces) + len(self.segments)
+        first = np.repeat(offsets[:-1],npieces)
+        piece = np.arange(len(seg)) - np.repeat(np.cumsum(npieces)-npieces,npieces)
+        a, b = coords[first+piece], coords[first+piece+1]
+        length = np.linalg.norm(b-a,axis=1)
+        if self.cell_size is None:
+            self.cell_size = 4*np.median(length) if len(length) and np.median(length) > 0 else 1.0
+
+        # register every piece in all grid cells touched by the bounding
+        # boxes of its parts no longer than a grid cell
+        nsub = np.maximum(np.ceil(length/self.cell_size),1).astype(int)
+        sub = np.repeat(np.arange(len(a)),nsub)
+        t = np.arange(len(sub)) - np.repeat(np.cumsum(nsub)-nsub,nsub)
+        t0, t1 = (t/nsub[sub])[:,None], ((t+1)/nsub[sub])[:,None]
+        p0, p1 = a[sub] + t0*(b-a)[sub], a[sub] + t1*(b-a)[sub]
+        owner, keys = self._keys_of(*self._cells(np.minimum(p0,p1),np.maximum(p0,p1)))
+        owner = sub[owner] + len(self._piece_seg)
+        keys = np.concatenate((self._keys,keys))
+        pieces = np.concatenate((self._pieces,owner))
+        order = np.argsort(keys,kind='mergesort')
+        self._keys, self._pieces = keys[order], pieces[order]
+        self._density = len(keys) / (np.count_nonzero(np.diff(self._keys)) + 1.0)
+
+        self._a = np.concatenate((self._a,a))
+        self._b = np.concatenate((self._b,b))
+        self._piece_seg = np.concatenate((self._piece_seg,seg))
+        self._ab = self._b - self._a
+        norm = np.einsum('ij,ij->i',self._ab,self._ab)
+        self._inv_norm = np.where(norm > 0,1/np.where(norm > 0,norm,1),0)
+        self._lo = np.minimum(self._a.min(axis=0),self._b.min(axis=0))
+        self._hi = np.maximum(self._a.max(axis=0),self._b.max(axis=0))
+        self.sections.extend(sections)
+        self._members.update(sections)
+        self.segments.extend(s for sec in sections for s in sec)
+
+    def _cells(self,lo,hi):
+        # first grid cell and number of cells along each axis of the boxes lo-hi
+        lo = np.floor(lo/self.cell_size).astype(np.int64)
+        hi = np.floor(hi/self.cell_size).astype(np.int64)
+        return lo, hi - lo + 1
+
+    def _keys_of(self,lo,n,points=None,radius=None):
+        # keys of all grid cells in the boxes, and the box of each key;
+        # with points and radius, only the cells within radius of the
+        # point of their box
+        count = n.prod(axis=1)
+        owner = np.repeat(np.arange(len(lo)),count)
+        local = np.arange(len(owner)) - np.repeat(np.cumsum(count)-count,count)
+        nyz = (n[:,1]*n[:,2])[owner]
+        ijk = np.empty((len(owner),3),dtype=np.int64)
+        ijk[:,0] = lo[owner,0] + local // nyz
+        ijk[:,1] = lo[owner,1] + (local % nyz) // n[owner,2]
+        ijk[:,2] = lo[owner,2] + local % n[owner,2]
+        if points is not None:
+            p = points[owner]
+            gap = np.maximum(np.maximum(ijk*self.cell_size-p,p-(ijk+1)*self.cell_size),0)
+            near = np.einsum('ij,ij->i',gap,gap) <= radius[owner]**2
+            owner, ijk = owner[near], ijk[near]
+        # 21 bits per axis: exact for up to a million cells in each direction
+        ijk += 2**20
+        keys = (ijk[:,0] << 42) | (ijk[:,1] << 21) | ijk[:,2]
+        return owner, keys
+
+    def _lookup(self,query,keys):
+        # (query, piece) pairs for all pieces registered under keys
+        start = np.searchsorted(self._keys,keys,side='left')
+        count = np.searchsorted(self._keys,keys,side='right') - start
+        idx = np.arange(count.sum()) - np.repeat(np.cumsum(count)-count,count) \
+              + np.repeat(start,count)
+        return np.repeat(query,count), self._pieces[idx]
+
+    def _brute(self,query):
+        # (query, piece) pairs for all pieces
+        npieces = len(self._piece_seg)
+        return np.repeat(query,npieces), np.tile(np.arange(npieces),len(query))
+
+    def _candidates(self,points,radius):
+        # (query, piece) pairs for all pieces registered in the cells
+        # touched by the ball around each point; balls spanning more cells
+        # than there are pieces simply get all pieces
+        lo, n = self._cells(points-radius[:,None],points+radius[:,None])
+        brute = n.prod(axis=1) > len(self._piece_seg)
+        cells = np.nonzero(~brute)[0]
+        owner, keys = self._keys_of(lo[cells],n[cells],points[cells],radius[cells])
+        query, pieces = self._lookup(cells[owner],keys)
+        bquery, bpieces = self._brute(np.nonzero(brute)[0])
+        return np.concatenate((query,bquery)), np.concatenate((pieces,bpieces))
+
+    def _piece_distance(self,points,pieces):
+        ap = points - self._a[pieces]
+        ab = self._ab[pieces]
+        t = np.clip(np.einsum('ij,ij->i',ap,ab)*self._inv_norm[pieces],0,1)
+        ap -= t[:,None]*ab
+        return np.sqrt(np.einsum('ij,ij->i',ap,ap))
+
+    def _reduce(self,query,seg,d):
+        # unique (query, segment) pairs at their smallest distance, sorted
+        # by query and then distance
+        key = query*len(self.segments) + seg
+        order = np.argsort(key)
+        key, d = key[order], d[order]
+        first = np.ones(len(key),dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        start = np.nonzero(first)[0]
+        d = np.minimum.reduceat(d,start) if len(start) else d[:0]
+        key = key[start]
+        order = np.lexsort((d,key // len(self.segments)))
+        key, d = key[order], d[order]
+        return key // len(self.segments), key % len(self.segments), d
+
+    def _ball(self,points,radius):
+        # unique (query, segment, distance) within radius; the points are
+        # processed in blocks of about 2^22 candidate pieces
+        lo, n = self._cells(points-radius[:,None],points+radius[:,None])
+        cost = np.minimum(n.prod(axis=1)*self._density,len(self._piece_seg)) + 1
+        bounds = np.searchsorted(np.cumsum(cost),np.arange(0,cost.sum(),2**22),side='right')
+        bounds = np.unique(np.append(np.minimum(bounds,len(points)),[0,len(points)]))
+        query, seg, d = [np.zeros(0,dtype=int)], [np.zeros(0,dtype=int)], [np.zeros(0)]
+        for (i0,i1) in zip(bounds[:-1],bounds[1:]):
+            q, pieces = self._candidates(points[i0:i1],radius[i0:i1])
+            dist = self._piece_distance(points[i0:i1][q],pieces)
+            keep = dist <= radius[i0:i1][q]
+            q, s, dist = self._reduce(q[keep],self._piece_seg[pieces[keep]],dist[keep])
+            query.append(q+i0)
+            seg.append(s)
+            d.append(dist)
+        return np.concatenate(query), np.concatenate(seg), np.concatenate(d)
+
+    def ball(self,points,radius):
+        """
+        Finds all segments within radius of each point.
+
+        Args:
+            points = (n x 3) array
+            radius = scalar or one radius per point
+
+        Returns:
+            segs = positions in segments of the segments found, for each
+                   point sorted by distance
+            dist = distance of each segment found
+            offsets = the segments near point i are
+                      segs[offsets[i]:offsets[i+1]]
+        """
+        points = np.atleast_2d(np.asarray(points,dtype=float))
+        radius = np.broadcast_to(np.asarray(radius,dtype=float),(len(points),))
+        if not len(self._piece_seg):
+            return np.zeros(0,dtype=int), np.zeros(0), np.zeros(len(points)+1,dtype=int)
+        query, seg, d = self._ball(points,radius)
+        offsets = np.append(0,np.cumsum(np.bincount(query,minlength=len(points))))
+        return seg, d, offsets
+
+    def knearest(self,points,k):
+        """
+        Finds the k segments closest to each point.
+
+        Returns:
+            segs = (n x k) array of positions in segments, nearest first
+                   (-1 if there are fewer than k segments)
+            dist = (n x k) array of distances (inf where segs is -1)
+        """
+        points = np.atleast_2d(np.asarray(points,dtype=float))
+        segs = -np.ones((len(points),k),dtype=int)
+        dist = np.full((len(points),k),np.inf)
+        k_found = min(k,len(self.segments))
+        if k_found == 0:
+            return segs, dist
+        npieces = len(self._piece_seg)
+        cell = np.floor(points/self.cell_size).astype(np.int64)
+
+        # the first step searches the cube of cells reaching the bounding
+        # box of all pieces; after that, one shell of cells at a time until
+        # the k-th distance is within the searched cube. Points whose cube
+        # grows to more cells than there are pieces get all pieces
+        outside = np.maximum(np.maximum(self._lo-points,points-self._hi),0)
+        m = np.floor(np.linalg.norm(outside,axis=1)/self.cell_size).astype(np.int64)
+        brute = (2*m+1)**3 > npieces
+        todo = np.nonzero(~brute)[0]
+        lo, n = cell[todo]-m[todo,None], np.repeat(2*m[todo,None]+1,3,axis=1)
+        owner = np.arange(len(todo))
+        while True:
+            brute = np.nonzero(brute)[0]
+            block = max(1,2**22 // npieces)
+            for i in range(0,len(brute),block):
+                self._merge(points,segs,dist,*self._brute(brute[i:i+block]))
+            if not len(todo):
+                break
+            box, keys = self._keys_of(lo,n)
+            self._merge(points,segs,dist,*self._lookup(todo[owner[box]],keys),rows=todo)
+            # distance from each point to the surface of the searched cube
+            c, mm, p = cell[todo], m[todo,None], points[todo]
+            reach = np.minimum(p-(c-mm)*self.cell_size,(c+mm+1)*self.cell_size-p).min(axis=1)
+            todo = todo[dist[todo,k_found-1] > reach]
+            m[todo] += 1
+            brute = np.zeros(len(m),dtype=bool)
+            brute[todo] = (2*m[todo]+1)**3 > npieces
+            todo = todo[~brute[todo]]
+            lo, n, owner = self._shell(cell[todo],m[todo])
+        return segs, dist
+
+    def _shell(self,cell,m):
+        # boxes covering the cells at chebyshev distance m >= 1 from cell:
+        # two faces normal to x, then y, then z
+        x, y, z = cell[:,:1], cell[:,1:2], cell[:,2:]
+        m = m[:,None]
+        full, inner, one = 2*m+1, 2*m-1, np.ones_like(m)
+        lo = np.concatenate((np.hstack((x-m,y-m,z-m)),np.hstack((x+m,y-m,z-m)),
+                             np.hstack((x-m+1,y-m,z-m)),np.hstack((x-m+1,y+m,z-m)),
+                             np.hstack((x-m+1,y-m+1,z-m)),np.hstack((x-m+1,y-m+1,z+m))))
+        n = np.concatenate((np.hstack((one,full,full)),np.hstack((one,full,full)),
+                            np.hstack((inner,one,full)),np.hstack((inner,one,full)),
+                            np.hstack((inner,inner,one)),np.hstack((inner,inner,one))))
+        return lo, n, np.tile(np.arange(len(cell)),6)
+
+    def _merge(self,points,segs,dist,query,pieces,rows=None):
+        # merges the pieces found for each query into its k nearest segments
+        k = segs.shape[1]
+        d = self._piece_distance(points[query],pieces)
+        seg = self._piece_seg[pieces]
+        if k == 1:
+            # no sorting needed, a piece is nearer or it is not
+            best = dist[:,0].copy()
+            np.minimum.at(best,query,d)
+            win = d < dist[query,0]
+            win[win] = d[win] == best[query[win]]
+            segs[query[win],0] = seg[win]
+            dist[:,0] = best
+            return
+        # only pieces nearer than the current k-th segment matter
+        keep = d <= dist[query,k-1]
+        query, seg, d = query[keep], seg[keep], d[keep]
+        if rows is None:
+            rows = np.unique(query)
+        old = segs[rows].ravel() >= 0
+        query = np.concatenate((np.repeat(rows,k)[old],query))
+        seg = np.concatenate((segs[rows].ravel()[old],seg))
+        d = np.concatenate((dist[rows].ravel()[old],d))
+        query, seg, d = self._reduce(query,seg,d)
+        rank = np.arange(len(query)) - np.searchsorted(query,query)
+        keep = rank < k
+        segs[rows], dist[rows] = -1, np.inf
+        segs[query[keep],rank[keep]] = seg[keep]
+        dist[query[keep],rank[keep]] = d[keep]
+
+    def nearest(self,points):
+        """
+        Finds the segment closest to each point.
+
+        Returns:
+            segs = positions in segments of the nearest segments
+            dist = distance to the nearest segments
+        """
+        segs, dist = self.knearest(points,1)
+        return segs[:,0], dist[:,0]
+
+def all_branch_orders(h,index=None):
+    """
+    Produces a list branch orders for each section (following pre-order tree
+    traversal)
+    """
+    if index is None:
+        index = MorphologyIndex(h)
+    return index.branch_order.tolist()
 
-    for r in roots:
-        secdict[r] = 0
-    
-    precedence = 1
-    while len(leaves)>0:
-        # build list of distances of all paths to remaining leaves
-        d = []
-        for leaf in leaves:
-            p = []
-            dist = dist_to_mark(h, leaf, secdict, path=p)
-            d.append((dist,[pp for pp in p]))
-        
-        # longest path index
-        i = np.argmax([ dd[0] for dd in d ])
-        leaves.pop(i) # this leaf will be marked
+def branch_order(h,section,path=None,index=None):
+    """
+    Returns the branch order of a section. If path is a list, the section
+    and all of its ancestors are appended to it.
+    """
+    if index is not None:
+        i = index.index(section)
+        if path is not None:
+            j = i
+            while j >= 0:
+                path.append(index.sections[j])
+                j = index.parent[j]
+        return int(index.branch_order[i])
+
+    order = 0
+    while True:
+        if path is not None:
+            path.append(section)
+        pseg = section.parentseg()
+        if pseg is None:
+            return order # section is a root
+        if len(pseg.sec.children()) > 1:
+            order += 1
+        section = pseg.sec
+
+def dist_to_mark(h, section, secdict, path=None):
+    """
+    Returns the summed length of section and its ancestors, up to (but not
+    including) the first ancestor marked in secdict. If path is a list, the
+    visited sections are appended to it.
+    """
+    lengths = []
+    while True:
+        if path is not None:
+            path.append(section)
+        lengths.append(section.L)
+        pseg = section.parentseg()
+        if pseg is None or secdict[pseg.sec] is not None:
+            break # parent is marked
+        section = pseg.sec
+
+    # sum from the marked end, as a recursive traversal would
+    dist = 0
+    for L in reversed(lengths):
+        dist = L + dist
+    return dist
+
+def branch_precedence(h,index=None):
+    """
+    Decomposes the morphology into paths. The longest path from a root to
+    a leaf gets precedence 1, then the longest remaining path hanging off
+    an already marked section gets precedence 2, and so on. Roots have
+    precedence 0. Ties are broken in favour of the leaf that comes first
+    in h.allsec().
 
-        # mark all sections in longest path
-        for sec in d[i][1]:
-            if secdict[sec] is None:
-                secdict[sec] = precedence
+    This is a longest-path decomposition computed by dynamic programming
+    over the MorphologyIndex, O(n log n) in the number of sections.
 
-        # increment precedence across iterations
-        precedence += 1
+    Returns:
+        list of precedences for each section (in pre-order)
+    """
+    if index is None:
+        index = MorphologyIndex(h)
+    n = len(index)
+    allsec_pos = { sec:i for i,sec in enumerate(h.allsec()) }
+    parent = index.parent.tolist()
+    length = index.length.tolist()
+    child_ptr = index.child_ptr.tolist()
+    child_idx = index.child_idx.tolist()
+
+    # height = length of the longest path from a section down to a leaf,
+    # heavy = child continuing that path, first = leaf ending it
+    height = list(length)
+    first = [ allsec_pos.get(sec,n) for sec in index.sections ]
+    heavy = [-1]*n
+    for i in range(n-1,-1,-1): # children before parents
+        best = -1
+        for c in child_idx[child_ptr[i]:child_ptr[i+1]]:
+            if best < 0 or height[c] > height[best] or \
+               (height[c] == height[best] and first[c] < first[best]):
+                best = c
+        if best >= 0:
+            heavy[i] = best
+            height[i] = length[i] + height[best]
+            first[i] = first[best]
+
+    # every path starts at a child of a root or at a non-heavy child;
+    # longer paths are marked first
+    tops = [ i for i in range(n) if parent[i] >= 0 and \
+             (parent[parent[i]] < 0 or heavy[parent[i]] != i) ]
+    tops.sort(key=lambda i: (-height[i],first[i]))
+
+    precedence = [0]*n
+    for p,i in enumerate(tops):
+        while i >= 0:
+            precedence[i] = p+1
+            i = heavy[i]
+    return precedence
 
-    #prec = secdict.values()
-    #return [0 if p is None else 1 for p in prec], d[i][1]
-    return [ secdict[sec] for sec in seclist ]
+import json
+import base64
 
+def morphology_to_arrays(sections):
+    """
+    Extracts the morphology of a list of sections into flat arrays.
 
-from neuron import h
-from neuron.rxd.morphology import parent, parent_loc
-import json
+    Args:
+        sections = list of h.Section() objects
 
-def morphology_to_dict(sections, outfile=None):
+    Returns:
+        dict of arrays
+            points = (number of points x 4) float32 array of x, y, z, diam
+            offsets = section k has points[offsets[k]:offsets[k+1]]
+            parent = index of the parent section in sections (-1 if none)
+            parent_loc = location on the parent section (-1 if none)
+            orientation = section_orientation of each section
+            style = (number of sections x 3) logical connection point of sections
+                    connected by a wire (see pt3dstyle), nan for the others
+            name = name of each section
+    """
     section_map = {sec: i for i, sec in enumerate(sections)}
-    result = []
     h.define_shape()
+    xyzd, offsets = get_points(h, sections)
+    parent = np.full(len(sections), -1)
+    parent_loc = np.full(len(sections), -1.0)
+    style = np.full((len(sections), 3), np.nan)
+    xyz = [h.ref(0) for i in range(3)]
+    for (i, sec) in enumerate(sections):
+        seg = sec.parentseg()
+        if seg is not None and seg.sec in section_map:
+            parent[i] = section_map[seg.sec]
+            parent_loc[i] = seg.x
+        if h.pt3dstyle(sec=sec):
+            h.pt3dstyle(1, xyz[0], xyz[1], xyz[2], sec=sec)
+            style[i] = [r[0] for r in xyz]
+    return {'points': xyzd.astype(np.float32),
+            'offsets': offsets,
+            'parent': parent,
+            'parent_loc': parent_loc,
+            'orientation': np.array([h.section_orientation(sec=sec) for sec in sections]),
+            'style': style,
+            'name': np.array([sec.hname() for sec in sections])}
+
+def morphology_to_dict(sections, outfile=None, encoding=None):
+    """
+    Converts the morphology of a list of sections to a list of dicts, one per
+    section, that can be written as JSON and read back with load_json.
+
+    Args:
+        sections = list of h.Section() objects
+        outfile = optional JSON file to write the result to
+        encoding = None to store the points as lists of numbers in 'x', 'y', 'z'
+                   and 'diam', or 'base64' to store them as one base64 string of
+                   float32 values in 'xyzd' (about half the size, and faster to read)
 
-    for sec in sections:
-        my_parent = parent(sec)
-        my_parent_loc = -1 if my_parent is None else parent_loc(sec, my_parent)
-        my_parent = -1 if my_parent is None else section_map[my_parent]
-        n3d = int(h.n3d(sec=sec))
-        result.append({
-            'section_orientation': h.section_orientation(sec=sec),
-            'parent': my_parent,
-            'parent_loc': my_parent_loc,
-            'x': [h.x3d(i, sec=sec) for i in xrange(n3d)],
-            'y': [h.y3d(i, sec=sec) for i in xrange(n3d)],
-            'z': [h.z3d(i, sec=sec) for i in xrange(n3d)],
-            'diam': [h.diam3d(i, sec=sec) for i in xrange(n3d)],
-            'name': sec.hname()           
-        })
+    Returns:
+        list of dicts, one per section
+    """
+    arrays = morphology_to_arrays(sections)
+    result = []
+    for (i, name) in enumerate(arrays['name']):
+        xyzd = arrays['points'][arrays['offsets'][i]:arrays['offsets'][i+1]]
+        sd = {'section_orientation': float(arrays['orientation'][i]),
+              'parent': int(arrays['parent'][i]),
+              'parent_loc': float(arrays['parent_loc'][i]),
+              'name': str(name)}
+        if not np.isnan(arrays['style'][i, 0]):
+            sd['style'] = arrays['style'][i].tolist()
+        if encoding == 'base64':
+            sd['xyzd'] = base64.b64encode(xyzd.astype('<f4').tobytes()).decode('ascii')
+        elif encoding is None:
+            xyzd = xyzd.astype(float)
+            sd.update(x=xyzd[:, 0].tolist(), y=xyzd[:, 1].tolist(), z=xyzd[:, 2].tolist(),
+                      diam=xyzd[:, 3].tolist())
+        else:
+            raise Exception('encoding `%s` not recognized' % encoding)
+        result.append(sd)
 
     if outfile is not None:
         with open(outfile, 'w') as f:
@@ -550,27 +1967,116 @@ def morphology_to_dict(sections, outfile=None):
 
     return result
 
+def morphology_to_npz(sections, outfile):
+    """ Writes the arrays of morphology_to_arrays to an .npz file, read it with load_npz """
+    np.savez(outfile, **morphology_to_arrays(sections))
+
+class MorphologyWriter(object):
+    """
+    Writes the morphologies of many cells to one JSON file, one cell at a time,
+    so that exporting a network does not hold all of them in memory. The file
+    holds a list with one entry (a list of section dicts) per cell; load_json
+    reads it back into a list of section lists.
+
+    Args:
+        outfile = JSON file to write
+        encoding = see morphology_to_dict
+
+    Example:
+        with MorphologyWriter('network.json', encoding='base64') as writer:
+            for cell in cells:
+                writer.write(cell.all)
+    """
+    def __init__(self, outfile, encoding=None):
+        self.encoding = encoding
+        self.ncells = 0
+        self.f = open(outfile, 'w')
+        self.f.write('[')
+
+    def write(self, sections):
+        """ Appends the morphology of one cell """
+        if self.ncells:
+            self.f.write(',\n')
+        json.dump(morphology_to_dict(sections, encoding=self.encoding), self.f)
+        self.ncells += 1
+
+    def close(self):
+        if not self.f.closed:
+            self.f.write(']\n')
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 def load_json(morphfile):
+    """
+    Creates the sections described in a JSON file written by morphology_to_dict
+    (either encoding) or by MorphologyWriter.
 
-    with open(morphfile, 'r') as f:
-        secdata = json.load(morphfile)
+    Args:
+        morphfile = JSON file, or the list of dicts itself
 
-    seclist = []
+    Returns:
+        list of the new sections, or a list of such lists for a file with
+        several cells (from MorphologyWriter)
+    """
+    if isinstance(morphfile, list):
+        secdata = morphfile
+    else:
+        with open(morphfile, 'r') as f:
+            secdata = json.load(f)
+    if len(secdata) and isinstance(secdata[0], list):
+        return [_sections_from_dicts(cell) for cell in secdata]
+    return _sections_from_dicts(secdata)
+
+def _sections_from_dicts(secdata):
+    """Helper function for load_json, creates the sections of one list of section dicts."""
+    points = []
     for sd in secdata:
-        # make section
-        sec = h.Section(name=sd['name'])
-        seclist.append(sec)
-
+        if 'xyzd' in sd:
+            points.append(np.frombuffer(base64.b64decode(sd['xyzd']), dtype='<f4').reshape(-1, 4))
+        else:
+            points.append(np.array([sd['x'], sd['y'], sd['z'], sd['diam']], dtype=float).T.reshape(-1, 4))
+    offsets = np.append(0, np.cumsum([len(p) for p in points]))
+    parent = np.array([sd['parent'] for sd in secdata], dtype=int)
+    parent_loc = np.array([sd['parent_loc'] for sd in secdata], dtype=float)
+    orientation = np.array([sd['section_orientation'] for sd in secdata], dtype=float)
+    style = np.array([sd.get('style', [np.nan]*3) for sd in secdata], dtype=float).reshape(-1, 3)
+    names = [sd['name'] for sd in secdata]
+    xyzd = np.concatenate(points) if points else np.empty((0, 4))
+    return _sections_from_arrays(xyzd, offsets, parent, parent_loc, orientation, names, style)
+
+def load_npz(morphfile):
+    """
+    Creates the sections stored in an .npz file written by morphology_to_npz.
 
-        # make 3d morphology
-        for x,y,z,d in zip(sd['x'], sd['y'], sd['z'], sd('diam')): 
-            h.pt3dadd(x, y, z, d, sec=sec)
+    Returns:
+        list of the new sections
+    """
+    with np.load(morphfile) as f:
+        # files written before style was stored have no wired sections
+        style = f['style'] if 'style' in f.files else None
+        return _sections_from_arrays(f['points'], f['offsets'], f['parent'], f['parent_loc'],
+                                     f['orientation'], [str(name) for name in f['name']], style)
+
+def _sections_from_arrays(xyzd, offsets, parent, parent_loc, orientation, names, style=None):
+    """Helper function, creates sections from flat morphology arrays (see morphology_to_arrays)."""
+    vecs = _pt3d_vectors(xyzd)
+    seclist = []
+    for (k, name) in enumerate(names):
+        # make section and its 3d morphology
+        sec = h.Section(name=name)
+        if style is not None and not np.isnan(style[k, 0]):
+            h.pt3dstyle(1, style[k, 0], style[k, 1], style[k, 2], sec=sec)
+        _pt3dadd(vecs, offsets[k], offsets[k+1], sec)
+        seclist.append(sec)
 
     # connect children to parent compartments
-    for sec,sd in zip(seclist,secdata):
-        if sd['parent_loc'] >= 0:
-            parent_sec = sec_list[sd['parent']]
-            sec.connect(parent_sec(sd['parent_loc']), sd['section_orientation'])
+    for (k, sec) in enumerate(seclist):
+        if parent_loc[k] >= 0:
+            sec.connect(seclist[parent[k]](parent_loc[k]), orientation[k])
 
     return seclist
@@ -31,18 +31,299 @@ e.g. morphology('mb100318-a')
 
 An optional format keyword argument allows selecting between the original and the
 standardized versions.
+
+Pages can be kept in an on-disk cache, so that repeated queries do not go to the
+network, e.g.
+
+    set_cache('neuromorpho_cache', ttl=7*24*3600)
+    set_cache('neuromorpho_cache', offline=True)         # never touch the network
+    set_cache(None, mirror='fixtures')                   # serve pages from a directory
+
+To download many cells at once, use download_all.
+e.g. download_all('blowfly', 'blowfly_cells', threads=16)
 """
+import urllib
 import urllib2
+import urlparse
+import httplib
+import socket
+import threading
 import re
+import os
+import sys
+import time
 import json
 import base64
+import hashlib
 
 _cache = {}
 
+# on-disk cache settings, see set_cache
+_config = {'cache_dir': None, 'ttl': 7 * 24 * 3600, 'max_size': 2 ** 30, 'offline': False, 'mirror': None}
+_cache_size = [None]
+# names of the cache files, see _cache_file
+_page_pattern = re.compile(r'[0-9a-f]{40}\.page$')
+
+# network settings, see set_network
+_network = {'retries': 3, 'backoff': 0.5, 'timeout': 30}
+
+# keep-alive connections, one set per thread
+_local = threading.local()
+_lock = threading.Lock()
+
+# the last few pages fetched, so that e.g. metadata and morphology share a download
+_pages = {}
+_pages_order = []
+_max_pages = 32
+
+def set_cache(cache_dir, ttl=7 * 24 * 3600, max_size=2 ** 30, offline=False, mirror=None):
+    """Configure where and how long downloaded pages are kept.
+
+    Args:
+        cache_dir -- directory for the cache (created if needed), or None to disable it;
+                     pages are kept as <sha1 of the URL>.page and other files in the
+                     directory are never counted or removed
+        ttl -- seconds before a cached page is fetched again (None: never expires)
+        max_size -- bytes; when the cache grows past this, the oldest pages are removed
+        offline -- if True, only use cached (even expired) pages and raise IOError
+                   for anything else
+        mirror -- optional directory of pre-fetched pages that stands in for the
+                  server; the page for http://neuromorpho.org/<path>?<query> is read
+                  from <mirror>/<path>%3F<query>, with the query percent-encoded
+                  except for '=' and '&' (e.g. neuron_info.jsp%3Fneuron_name=cnic_001)
+    """
+    _config.update(cache_dir=cache_dir, ttl=ttl, max_size=max_size, offline=offline, mirror=mirror)
+    _cache_size[0] = None
+    del _pages_order[:]
+    _pages.clear()
+
+def set_network(retries=3, backoff=0.5, timeout=30):
+    """Configure how pages are fetched from the network.
+
+    Args:
+        retries -- number of times a failed request is repeated
+        backoff -- seconds to wait before the first retry, doubled for every next one
+        timeout -- seconds before a request is given up
+    """
+    _network.update(retries=retries, backoff=backoff, timeout=timeout)
+
+def clear_cache():
+    """Remove all pages from the on-disk and in-memory caches (other files in cache_dir are kept)."""
+    cache_dir = _config['cache_dir']
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        for name in _cache_entries(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+    _cache_size[0] = None
+    del _pages_order[:]
+    _pages.clear()
+
+def _normalize_url(url):
+    """Helper function, makes URLs differing only in the case of the host name equal."""
+    parts = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+def _cache_file(url):
+    """Helper function, the cache file for a (normalized) URL."""
+    return os.path.join(_config['cache_dir'], hashlib.sha1(url).hexdigest() + '.page')
+
+def _cache_entries(cache_dir):
+    """Helper function, names of the pages in cache_dir; other files are left alone."""
+    return [name for name in os.listdir(cache_dir) if _page_pattern.match(name)]
+
+def _mirror_file(url):
+    """Helper function, the file standing in for a URL in the mirror directory."""
+    parts = urlparse.urlsplit(url)
+    name = parts.path.lstrip('/')
+    if parts.query:
+        # '?' and most other query characters are not allowed in Windows file names
+        name += '%3F' + urllib.quote(parts.query, safe='=&')
+    return os.path.join(_config['mirror'], name)
+
+def _remember(url, data):
+    """Helper function, keeps a page in memory."""
+    with _lock:
+        if url not in _pages:
+            _pages_order.append(url)
+            if len(_pages_order) > _max_pages:
+                del _pages[_pages_order.pop(0)]
+        _pages[url] = data
+    return data
+
+def _fetch(url):
+    """Helper function, returns the page at url, from the caches if possible."""
+    url = _normalize_url(url)
+    if url in _pages:
+        return _pages[url]
+    if _config['mirror'] is not None:
+        with open(_mirror_file(url), 'rb') as f:
+            return _remember(url, f.read())
+
+    fname = None
+    if _config['cache_dir'] is not None:
+        fname = _cache_file(url)
+        if os.path.exists(fname):
+            ttl = _config['ttl']
+            if _config['offline'] or ttl is None or time.time() - os.path.getmtime(fname) < ttl:
+                with open(fname, 'rb') as f:
+                    return _remember(url, f.read())
+    if _config['offline']:
+        raise IOError('%s is not in the cache (offline mode)' % url)
+
+    try:
+        data = _http_get(url)
+    except urllib2.URLError:
+        # fall back on an expired copy
+        if fname is not None and os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                return _remember(url, f.read())
+        raise
+    if fname is not None:
+        _store(fname, data)
+    return _remember(url, data)
+
+def _http_get(url, redirects=5):
+    """
+    Helper function, fetches url over a keep-alive connection of the calling
+    thread, retrying with exponential backoff.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    key = (parts.scheme, parts.netloc)
+    connections = _local.__dict__.setdefault('connections', {})
+    error = None
+    for attempt in range(_network['retries'] + 1):
+        if attempt:
+            time.sleep(_network['backoff'] * 2 ** (attempt - 1))
+        conn = connections.get(key)
+        if conn is None:
+            cls = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+            conn = connections[key] = cls(parts.netloc, timeout=_network['timeout'])
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            # the server may have closed the connection; reconnect on the next try
+            conn.close()
+            del connections[key]
+            error = e
+            continue
+        if response.status in (301, 302, 303, 307, 308) and redirects:
+            return _http_get(urlparse.urljoin(url, response.getheader('location')), redirects - 1)
+        if response.status >= 500:
+            error = urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+            continue
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        return data
+    if isinstance(error, urllib2.URLError):
+        raise error
+    raise urllib2.URLError(error)
+
+def _store(fname, data):
+    """Helper function, writes a page to the cache and evicts the oldest pages if it is full."""
+    with _lock:
+        _store_locked(fname, data)
+
+def _store_locked(fname, data):
+    cache_dir = _config['cache_dir']
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if _cache_size[0] is None:
+        _cache_size[0] = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in _cache_entries(cache_dir))
+    if os.path.exists(fname):
+        _cache_size[0] -= os.path.getsize(fname)
+    # write to a temporary file first so that readers never see a partial page
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, fname)
+    _cache_size[0] += len(data)
+
+    if _cache_size[0] > _config['max_size']:
+        entries = []
+        for name in _cache_entries(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if path != fname:
+                entries.append((os.path.getmtime(path), path))
+        entries.sort()
+        for (mtime, path) in entries:
+            if _cache_size[0] <= _config['max_size']:
+                break
+            _cache_size[0] -= os.path.getsize(path)
+            os.remove(path)
+
+# patterns used to parse the pages, compiled once
+_table_pattern = re.compile(r"maketable\('(.*?)'\)")
+_name_pattern = re.compile(r"neuron_name=(.*?)'")
+# metadata cells; the first group is 'r' for right-aligned cells (keys) and empty for
+# left-aligned cells (values)
+_cell_pattern = re.compile(r'<td align="(?:(r)ight" width="50%"|left")[^>]*>(.*?)</td>', re.S)
+_link_pattern = re.compile(r'<a href=dableFiles/(.*?)>Morphology File \((Standardized|Original)')
+# non-breaking spaces and units become spaces (the longer unit must come first),
+# cubes and line breaks are dropped
+_replacements = (('&nbsp;', ' '), ('&#956;m<sup>2</sup>', ' '), ('&#956;m', ' '), ('&deg;', ' '),
+                 ('<b>x</b>', ' '), ('<sup>3</sup>', ''), ('\n', ''))
+_link_kinds = {'Standardized': 'swc', 'Original': 'original'}
+
+def _typed(value):
+    """Helper function, converts numeric strings to int or float."""
+    if value and value[0] in '0123456789+-.':
+        try:
+            number = float(value)
+            if number.is_integer() and '.' not in value and 'e' not in value.lower():
+                return int(value)
+        except ValueError:
+            return value
+        return number
+    return value
+
+def parse_neuron_info(html, typed=True):
+    """Parse a neuron_info.jsp page, with a single pass over the page for the
+    metadata and the download links whenever the links are inside metadata cells.
+
+    Args:
+        html -- contents of the page
+        typed -- convert numeric values to int or float (Default: True)
+
+    Returns:
+        metadata -- dict of the metadata, as returned by metadata
+        links -- dict mapping 'swc' and 'original' to the paths of the morphology files
+    """
+    cells = _cell_pattern.findall(html)
+    links = {}
+    for (link, kind) in _link_pattern.findall(''.join(text for (k, text) in cells if 'dableFiles' in text)):
+        links.setdefault(_link_kinds[kind], link)
+    if len(links) < len(_link_kinds):
+        # the links are not in metadata cells on this page
+        for (link, kind) in _link_pattern.findall(html):
+            links.setdefault(_link_kinds[kind], link)
+    # clean all cells at once rather than one at a time
+    texts = '\0'.join(text for (k, text) in cells)
+    for (old, new) in _replacements:
+        texts = texts.replace(old, new)
+    texts = texts.split('\0')
+    keys = [text[:-3].strip() for ((k, raw), text) in zip(cells, texts) if k]
+    # the first two left-aligned cells are not metadata
+    values = [text.strip() for ((k, raw), text) in zip(cells, texts) if not k][2:]
+    if typed:
+        values = [_typed(v) for v in values]
+    return dict(zip(keys, values)), links
+
+def _neuron_info(neuron_name):
+    """Helper function, fetches and parses a neuron_info page, reusing the last parse of this thread."""
+    html = _fetch('http://neuromorpho.org/neuron_info.jsp?neuron_name=%s' % neuron_name)
+    last = getattr(_local, 'info', None)
+    if last is None or last[0] is not html:
+        last = _local.info = (html, parse_neuron_info(html, typed=False))
+    return last[1]
+
 def _read_neuromorpho_table(bywhat):
     """Helper function, reads data from NeuroMorpho.Org, stores in cache."""
-    html = urllib2.urlopen('http://neuromorpho.org/by%s.jsp' % bywhat).read()
-    result = [m.strip() for m in re.findall("maketable\('(.*?)'\)", html)]
+    html = _fetch('http://neuromorpho.org/by%s.jsp' % bywhat)
+    result = [m.strip() for m in _table_pattern.findall(html)]
     _cache[bywhat] = set(result)
     return result
 
@@ -83,31 +364,23 @@ def _get_data_for_by(bywhat, category):
     """Helper function for cell_names."""
     query_code = bywhat if bywhat != 'cell' else 'class'
 
-    html = urllib2.urlopen('http://neuromorpho.org/getdataforby%s.jsp?%s=%s' % (bywhat, query_code, category.replace(' ', '%20'))).read()
-    return [m for m in re.findall("neuron_name=(.*?)'", html)]
+    html = _fetch('http://neuromorpho.org/getdataforby%s.jsp?%s=%s' % (bywhat, query_code, category.replace(' ', '%20')))
+    return _name_pattern.findall(html)
 
-def metadata(neuron_name):
+def metadata(neuron_name, typed=True):
     """Return a dict of the metadata for the specified neuron.
 
+    Numbers are returned as int or float with their units removed, unless typed
+    is False.
+
     Example:
 
         metadata('mb100318-a')
     """
-    html = urllib2.urlopen('http://neuromorpho.org/neuron_info.jsp?neuron_name=%s' % neuron_name).read()
-    # remove non-breaking spaces
-    html = html.replace('&nbsp;', ' ')
-
-    # remove units
-    html = html.replace('&#956;m<sup>2</sup>', ' ')
-    html = html.replace('&#956;m', ' ')
-    html = html.replace('&deg;', ' ')
-    html = html.replace('<b>x</b>', ' ')
-    html = html.replace('<sup>3</sup>', '')
-    html2 = html.replace('\n', '')
-    keys = [i[1][:-3].strip() for i in re.findall('<td align="right" width="50%"(.*?)>(.*?)</td>', html2)]
-    values = [i[1].strip() for i in re.findall('<td align="left"(.*?)>(.*?)</td>', html2)[2:]]
-
-    return dict(zip(keys, values))
+    info = _neuron_info(neuron_name)[0]
+    if typed:
+        return dict((key, _typed(value)) for (key, value) in info.iteritems())
+    return dict(info)
 
 def morphology(neuron_name, format='swc'):
     """Return the morphology associated with a given name.
@@ -125,12 +398,34 @@ def morphology(neuron_name, format='swc'):
     url_paths_from_format = {'swc': 'CNG%20Version', 'original': 'Source-Version'}
     assert(format in url_paths_from_format)
     # locate the path to the downloads
-    html = urllib2.urlopen('http://neuromorpho.org/neuron_info.jsp?neuron_name=%s' % neuron_name).read()
-    if format == 'swc':
-        url = re.findall("<a href=dableFiles/(.*?)>Morphology File \(Standardized", html)[0]
-    else:
-        url = re.findall("<a href=dableFiles/(.*?)>Morphology File \(Original", html)[0]
-    return urllib2.urlopen('http://NeuroMorpho.org/dableFiles/%s' % url).read()
+    url = _neuron_info(neuron_name)[1][format]
+    return _fetch('http://NeuroMorpho.org/dableFiles/%s' % url)
+
+def benchmark(dirname, repeat=3):
+    """Time the page parser on saved neuron_info pages.
+
+    Args:
+        dirname -- directory of saved pages (e.g. a mirror, see set_cache, or the
+                   fixtures in tests/fixtures/neuromorpho); every file whose name
+                   starts with neuron_info.jsp is parsed
+        repeat -- number of times each page is parsed
+
+    Returns:
+        pages parsed per second, e.g. print '%.0f pages/s' % benchmark('mirror')
+    """
+    pages = []
+    for name in sorted(os.listdir(dirname)):
+        if name.startswith('neuron_info.jsp'):
+            with open(os.path.join(dirname, name), 'rb') as f:
+                pages.append(f.read())
+    if not pages:
+        return 0.0
+    start = time.time()
+    for i in range(repeat):
+        for html in pages:
+            parse_neuron_info(html)
+    elapsed = time.time() - start
+    return repeat * len(pages) / elapsed
 
 def download(neuron_name, filename=None):
     format = 'swc'
@@ -141,6 +436,85 @@ def download(neuron_name, filename=None):
     with open(filename, 'w') as f:
         f.write(morphology(neuron_name, format=format))
 
+def download_all(neuron_names, dirname='.', format='swc', with_metadata=True, threads=8, progress=None):
+    """Download many morphologies (and their metadata) concurrently.
+
+    Each cell is saved as <dirname>/<neuron_name>.<format>, and its metadata as
+    <dirname>/<neuron_name>.json. Cells whose files already exist are skipped, so an
+    interrupted batch can be resumed by calling download_all again. Requests are
+    retried as configured with set_network.
+
+    Args:
+        neuron_names -- list of cell names, or a cell type, species or region
+                        (see cell_names)
+        dirname -- output directory (created if needed)
+        format -- 'swc' or 'original', see morphology
+        with_metadata -- also save the metadata of each cell
+        threads -- number of concurrent downloads
+        progress -- optional function called as progress(done, total, neuron_name)
+                    after each cell; True prints a progress line
+
+    Returns:
+        dict mapping the name of every cell that failed to the error
+
+    Example:
+
+        failed = download_all('blowfly', 'blowfly_cells', threads=16)
+    """
+    from multiprocessing.pool import ThreadPool
+    if isinstance(neuron_names, basestring):
+        neuron_names = cell_names(neuron_names)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if progress is True:
+        progress = _print_progress
+
+    def todo(neuron_name):
+        base = os.path.join(dirname, neuron_name)
+        return not os.path.exists(base + '.' + format) or \
+            (with_metadata and not os.path.exists(base + '.json'))
+    names = [name for name in neuron_names if todo(name)]
+    total = len(neuron_names)
+    done = [total - len(names)]
+    failed = {}
+
+    def fetch(neuron_name):
+        try:
+            base = os.path.join(dirname, neuron_name)
+            # metadata first: morphology then reuses the neuron_info page
+            if with_metadata:
+                _write_atomic(base + '.json', json.dumps(metadata(neuron_name), indent=4))
+            _write_atomic(base + '.' + format, morphology(neuron_name, format=format))
+        except Exception as e:
+            with _lock:
+                failed[neuron_name] = e
+        with _lock:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0], total, neuron_name)
+
+    pool = ThreadPool(threads)
+    try:
+        pool.map(fetch, names, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+def _write_atomic(filename, data):
+    """Helper function, writes a file so that it either exists completely or not at all."""
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+def _print_progress(done, total, neuron_name):
+    """Helper function, default progress report for download_all."""
+    sys.stderr.write('\r%d/%d %s\x1b[K' % (done, total, neuron_name))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
 if __name__ == '__main__':
     print 'Demo of reading data from NeuroMorpho.Org'
     print
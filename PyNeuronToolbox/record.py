@@ -1,27 +1,274 @@
 import numpy as np
-from morphology import allsec_preorder
+import struct
+import weakref
+from .morphology import allsec_preorder
 
 def ez_record(h,var='v',sections=None,order=None,\
-              targ_names=None,cust_labels=None):
+              targ_names=None,cust_labels=None,dt=None):
     """
     Records state variables across segments
 
     Args:
         h = hocObject to interface with neuron
-        var = string specifying state variable to be recorded.
-              Possible values are:
+        var = string specifying state variable to be recorded. Any range
+              variable can be used, for example:
                   'v' (membrane potential)
                   'cai' (Ca concentration)
+                  'ina' (sodium current)
+                  'm_hh' (state of a mechanism)
         sections = list of h.Section() objects to be recorded
         targ_names = list of section names to be recorded; alternative
                      passing list of h.Section() objects directly
                      through the "sections" argument above.
         cust_labels =  list of custom section labels
+        dt = optional sampling interval (ms); Default: every time step
 
     Returns:
         data = list of h.Vector() objects recording membrane potential
         labels = list of labels for each voltage trace
+
+    See record_vars for recording several variables at once with compact
+    (structured array) labels.
+    """
+    sections = _select_sections(h,sections,order,targ_names)
+    data, _, _ = record_vars(h,var,sections,dt=dt)
+
+    labels = []
+    for i in range(len(sections)):
+        sec = sections[i]
+        name = sec.name() if cust_labels is None else cust_labels[i]
+        positions = np.linspace(0,1,sec.nseg+2)
+        for position in positions[1:-1]:
+            labels.append(name+'_'+str(round(position,5)))
+
+    return data, labels
+
+def record_vars(h,variables='v',sections=None,order=None,targ_names=None,\
+                point_processes=None,dt=None):
+    """
+    Records one or more variables across segments, and optionally variables
+    of point processes. Labels are stored as a structured array rather
+    than as strings.
+
+    Args:
+        h = hocObject to interface with neuron
+        variables = name, or list of names, of range variables recorded in
+                    every segment (e.g. 'v', ['v','cai','m_hh'])
+        sections, order, targ_names = which sections to record (see ez_record)
+        point_processes = list of (point process, variable name) tuples,
+                          e.g. [(syn,'i'), (syn,'g')]
+        dt = optional sampling interval (ms); Default: every time step
+
+    Returns:
+        data = list of h.Vector() objects, for each variable all segments
+               of all sections (in order), then the point processes
+        labels = structured array with fields 'var' (variable name), 'sec'
+                 (index into sections, -1 if the section of a point process
+                 is not among them) and 'x' (position of the segment)
+        sections = the list of recorded sections
+
+    Note:
+        Every Vector.record call scans the recordings that already exist,
+        so setting up very many vectors gets slow. For cells with tens of
+        thousands of segments use GatherRecorder.
+    """
+    sections = _select_sections(h,sections,order,targ_names)
+    refs, labels = _record_refs(variables,sections,point_processes)
+
+    data = []
+    for ref in refs:
+        vec = h.Vector()
+        if dt is None:
+            vec.record(ref)
+        else:
+            vec.record(ref,dt)
+        data.append(vec)
+
+    return data, labels, sections
+
+class GatherRecorder(object):
+    """
+    Records many variables at once through a single h.PtrVector, which is
+    gathered into a numpy buffer at every sample time. Samples are taken
+    every dt (Default: h.dt at h.finitialize(), also when CVode is active). Setup is linear in
+    the number of recorded variables, and the data end up in one
+    (time x variables) array instead of one h.Vector() per segment.
+
+    Args:
+        h = hocObject to interface with neuron
+        variables, sections, order, targ_names, point_processes, dt
+            = what to record (see record_vars)
+        out = optional writer with an append(rows) method (e.g. a
+              TraceWriter); full blocks of rows are handed to it instead
+              of being kept in memory
+        block = number of time points buffered between hand-offs
+
+    Attributes:
+        labels = structured array of labels (see record_vars)
+        sections = the list of recorded sections
+
+    The recorder samples from every h.finitialize() on until remove() is
+    called, or until the last reference to it is dropped (NEURON only holds
+    weak references to it). Use it in a with block to have remove() called
+    at the end.
+
+    Example:
+        rec = GatherRecorder(h, ['v','cai'])
+        h.finitialize(-65)
+        h.continuerun(100)
+        t, data = rec.t, rec.data
+        rec.remove()
+
+        with GatherRecorder(h, 'v', dt=0.1) as rec:
+            h.finitialize(-65)
+            h.continuerun(100)
+        v = rec.data
     """
+    def __init__(self,h,variables='v',sections=None,order=None,targ_names=None,\
+                 point_processes=None,dt=None,out=None,block=1024):
+        self.h = h
+        self.sections = _select_sections(h,sections,order,targ_names)
+        refs, self.labels = _record_refs(variables,self.sections,point_processes)
+        self.pv = h.PtrVector(len(refs))
+        for (i,ref) in enumerate(refs):
+            self.pv.pset(i,ref)
+        self._vec = h.Vector(len(refs))
+        self.dt = dt
+        self.out = out
+        self._buf = np.empty((block,len(refs)))
+        self._tbuf = np.empty(block)
+        self._n = 0
+        self._blocks, self._tblocks = [], []
+        self._next_t = 0
+        self._active = False
+        self._fih = h.FInitializeHandler(1,_WeakCallback(self._init))
+        self._sample_callback = _WeakCallback(self._sample)
+
+    def _init(self):
+        self._n = 0
+        self._blocks, self._tblocks = [], []
+        self._step = self.h.dt if self.dt is None else self.dt
+        self._next_t = self.h.t
+        self._active = True
+        self._sample()
+
+    def _sample(self):
+        # self-rescheduling event, so every sample sees a consistent state
+        if not self._active:
+            return
+        self._catch_up()
+        self.h.cvode.event(self._next_t,self._sample_callback)
+
+    def _catch_up(self):
+        h = self.h
+        if self._active and h.t >= self._next_t - 1e-3*self._step:
+            self._next_t = h.t + self._step
+            self.pv.gather(self._vec)
+            self._buf[self._n] = self._vec.as_numpy()
+            self._tbuf[self._n] = h.t
+            self._n += 1
+            if self._n == len(self._buf):
+                self._hand_off()
+
+    def _hand_off(self):
+        if self._n == 0:
+            return
+        if self.out is not None:
+            self.out.append(self._buf[:self._n])
+        else:
+            self._blocks.append(self._buf[:self._n].copy())
+        self._tblocks.append(self._tbuf[:self._n].copy())
+        self._n = 0
+
+    def flush(self):
+        """ Moves the buffered time points to out, or to the stored data """
+        # the sample due at the end of a run is only delivered once the
+        # simulation continues, so take it now
+        self._catch_up()
+        self._hand_off()
+
+    @property
+    def data(self):
+        """ (time x variables) array of everything recorded """
+        self.flush()
+        if not self._blocks:
+            return np.empty((0,len(self.labels)))
+        return np.concatenate(self._blocks)
+
+    @property
+    def t(self):
+        """ times of the recorded samples """
+        self.flush()
+        if not self._tblocks:
+            return np.empty(0)
+        return np.concatenate(self._tblocks)
+
+    def remove(self):
+        """ Stops recording; the recorded data stay available """
+        self.flush()
+        self._active = False
+        self._fih = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.remove()
+
+class _WeakCallback(object):
+    """
+    Helper class, calls a method without keeping its object alive. Callbacks
+    held by NEURON would otherwise keep a recorder, and the sections it
+    refers to, alive until the event queue is cleared in the middle of the
+    next h.finitialize(), where NEURON cannot delete sections.
+    """
+    def __init__(self,method):
+        self.ref = weakref.ref(method.__self__)
+        self.name = method.__name__
+
+    def __call__(self):
+        obj = self.ref()
+        if obj is not None:
+            getattr(obj,self.name)()
+
+label_dtype = np.dtype([('var','U32'),('sec',np.int32),('x',np.float64)])
+
+def _record_refs(variables,sections,point_processes):
+    """
+    Helper function, collects the references to the recorded variables
+    and builds their labels with array operations.
+    """
+    if isinstance(variables,str):
+        variables = [variables]
+    point_processes = point_processes or []
+
+    refs = []
+    for var in variables:
+        attr = '_ref_' + var
+        for sec in sections:
+            for seg in sec:
+                refs.append(getattr(seg,attr))
+
+    nseg = np.array([ sec.nseg for sec in sections ],dtype=int)
+    sec_idx = np.repeat(np.arange(len(sections)),nseg)
+    seg_idx = np.arange(len(sec_idx)) - np.repeat(np.cumsum(nseg)-nseg,nseg)
+    x = (seg_idx+0.5)/nseg[sec_idx]
+    n = len(variables)*len(sec_idx)
+    labels = np.empty(n+len(point_processes),dtype=label_dtype)
+    labels['var'][:n] = np.repeat(variables,len(sec_idx))
+    labels['sec'][:n] = np.tile(sec_idx,len(variables))
+    labels['x'][:n] = np.tile(x,len(variables))
+
+    lookup = { sec:i for i,sec in enumerate(sections) }
+    for (k,(pp,var)) in enumerate(point_processes):
+        refs.append(getattr(pp,'_ref_'+var))
+        seg = pp.get_segment()
+        labels[n+k] = (var,lookup.get(seg.sec,-1),seg.x)
+
+    return refs, labels
+
+def _select_sections(h,sections,order,targ_names):
+    """ Helper function, picks the sections to be recorded """
     if sections is None:
         if order == 'pre':
             sections = allsec_preorder(h)
@@ -33,34 +280,138 @@ def ez_record(h,var='v',sections=None,order=None,\
         for sec in old_sections:
             if sec.name() in targ_names:
                 sections.append(sec)
+    return sections
 
-    data, labels = [], []
-    for i in range(len(sections)):
-        sec = sections[i]
-        positions = np.linspace(0,1,sec.nseg+2)
-        for position in positions[1:-1]:
-            # record data
-            data.append(h.Vector())
-            if var is 'v':
-                data[-1].record(sec(position)._ref_v)
-            elif var is 'cai':
-                data[-1].record(sec(position)._ref_cai)
-            # determine labels
-            if cust_labels is None:
-                lab = sec.name()+'_'+str(round(position,5))
-            else: 
-                lab = cust_labels[i]+'_'+str(round(position,5))
-            labels.append(lab)
-
-    return data, labels
-
-def ez_convert(data):
+def ez_convert(data,out=None):
     """
     Takes data, a list of h.Vector() objects filled with data, and converts
     it into a 2d numpy array, data_clean. This should be used together with
-    the ez_record command. 
+    the ez_record command. The traces are copied straight from the vectors'
+    memory; out may be a preallocated (or memory-mapped) array to fill.
     """
-    data_clean = np.empty((len(data[0]),len(data)))
+    if out is None:
+        out = np.empty((len(data[0]),len(data)))
     for (i,vec) in enumerate(data):
-        data_clean[:,i] = vec.to_python()
-    return data_clean
+        out[:,i] = vec.as_numpy()
+    return out
+
+class StreamRecorder(object):
+    """
+    Streams the traces recorded by ez_record to disk while the simulation
+    runs. The simulation is advanced in chunks; after each chunk the
+    h.Vector() objects are copied into the output and emptied, so memory
+    use stays bounded no matter how long the simulation is.
+
+    Args:
+        h = hocObject to interface with neuron
+        data = list of h.Vector() objects (e.g. from ez_record)
+        filename = .npy file receiving the (time x traces) matrix, or any
+                   object with append(rows) and close() methods
+        tfile = optional .npy file (or writer object) receiving the time
+                points. The time vector starts recording when the
+                StreamRecorder is created, so create it before calling
+                h.finitialize()
+        dt = sampling interval (ms) of the traces, the same dt that was
+             passed to ez_record/record_vars; Default: every time step
+        dtype = data type of the stored traces
+
+    Example:
+        data, labels = ez_record(h, dt=0.5)
+        rec = StreamRecorder(h, data, 'v.npy', tfile='t.npy', dt=0.5)
+        h.finitialize(-65)
+        rec.run(3600e3, chunk=1000)
+        rec.close()
+        v = np.load('v.npy', mmap_mode='r')
+    """
+    def __init__(self,h,data,filename,tfile=None,dt=None,dtype=np.float64):
+        self.h = h
+        self.data = data
+        self.dtype = np.dtype(dtype)
+        if isinstance(filename,str):
+            self.out = _NpyWriter(filename,len(data),self.dtype)
+        else:
+            self.out = filename
+        self.tvec, self.tout = None, None
+        if tfile is not None:
+            self.tvec = h.Vector()
+            if dt is None:
+                self.tvec.record(h._ref_t)
+            else:
+                self.tvec.record(h._ref_t,dt)
+            if isinstance(tfile,str):
+                self.tout = _NpyWriter(tfile,None,self.dtype)
+            else:
+                self.tout = tfile
+        self._buf = np.empty((0,len(data)),dtype=self.dtype)
+
+    def flush(self):
+        """ Moves everything recorded so far to the output """
+        n = len(self.data[0]) if self.data else 0
+        if self.tvec is not None and self.data and len(self.tvec) != n:
+            raise ValueError('%d time points for %d recorded rows, was dt '
+                             'passed to StreamRecorder?' % (len(self.tvec),n))
+        if n > 0:
+            if len(self._buf) < n:
+                self._buf = np.empty((n,len(self.data)),dtype=self.dtype)
+            buf = self._buf[:n]
+            for (i,vec) in enumerate(self.data):
+                buf[:,i] = vec.as_numpy()
+                vec.resize(0)
+            self.out.append(buf)
+        if self.tvec is not None and len(self.tvec) > 0:
+            self.tout.append(self.tvec.as_numpy())
+            self.tvec.resize(0)
+
+    def run(self,tstop,chunk=100.0):
+        """
+        Continues the simulation until tstop, flushing every chunk (ms).
+        Call h.finitialize() first.
+        """
+        h = self.h
+        while h.t < tstop - 0.5*h.dt:
+            h.continuerun(min(h.t + chunk, tstop))
+            self.flush()
+
+    def close(self):
+        """ Flushes the remaining data and finalizes the output files """
+        self.flush()
+        self.out.close()
+        if self.tout is not None:
+            self.tout.close()
+
+class _NpyWriter(object):
+    """
+    Helper class, appends rows to a .npy file whose final length is not
+    known in advance. The header has a fixed size and is rewritten with
+    the current shape after every append, so the file is always readable
+    with np.load(filename, mmap_mode='r').
+    """
+    header_len = 128
+
+    def __init__(self,filename,ncols=None,dtype=np.float64):
+        self.f = open(filename,'wb')
+        self.ncols = ncols
+        self.dtype = np.dtype(dtype)
+        self.nrows = 0
+        self._write_header()
+
+    def _write_header(self):
+        shape = (self.nrows,) if self.ncols is None else (self.nrows,self.ncols)
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" \
+                 % (self.dtype.str, shape)
+        header = header.ljust(self.header_len-11) + '\n'
+        self.f.seek(0)
+        self.f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H',len(header)) \
+                     + header.encode('latin1'))
+        self.f.seek(0,2)
+
+    def append(self,rows):
+        rows = np.ascontiguousarray(rows,dtype=self.dtype)
+        rows.tofile(self.f)
+        self.nrows += len(rows)
+        self._write_header()
+
+    def close(self):
+        if not self.f.closed:
+            self._write_header()
+            self.f.close()
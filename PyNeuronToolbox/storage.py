@@ -0,0 +1,231 @@
+"""
+Chunked on-disk storage for recorded traces.
+
+A trace store is a directory holding the (time x traces) matrix split into
+compressed blocks of chunk_rows time points by chunk_cols traces, next to the
+time vector, trace labels and segment positions:
+
+    store/
+        meta.json
+        t.npy
+        labels.npy
+        positions.npy
+        chunks/r000000_c000000.npz
+        ...
+
+Reading a single trace or a time window only loads the blocks it touches.
+
+Example:
+    data, labels = ez_record(h)
+    store = TraceWriter('run1', len(data), labels=labels)
+    rec = StreamRecorder(h, data, store, tfile=store.time)
+    h.finitialize(-65)
+    rec.run(tstop)
+    rec.close()
+
+    traces = TraceStore('run1')
+    v_soma = traces[:, 0]                 # one trace, all time points
+    window = traces.window(100, 200)      # all traces, 100 ms < t < 200 ms
+"""
+import os
+import json
+import numpy as np
+from .record import _NpyWriter
+
+class TraceWriter(object):
+    """
+    Writes a trace store, one block of time points at a time. Has the
+    append(rows) and close() methods expected by StreamRecorder.
+
+    Args:
+        dirname = directory of the store (created if needed)
+        ntraces = number of traces (columns)
+        labels = optional labels for each trace (e.g. from ez_record)
+        positions = optional array of segment positions for each trace
+        chunk_rows = number of time points per block
+        chunk_cols = number of traces per block
+        dtype = data type of the stored traces
+        compress = compress the blocks (Default: True)
+    """
+    def __init__(self,dirname,ntraces,labels=None,positions=None,\
+                 chunk_rows=4096,chunk_cols=256,dtype=np.float64,compress=True):
+        self.dirname = dirname
+        self.ntraces = ntraces
+        self.chunk_rows = chunk_rows
+        self.chunk_cols = chunk_cols
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.nrows = 0
+        self._block = np.empty((chunk_rows,ntraces),dtype=self.dtype)
+        self._fill = 0
+        self._time = None
+        self.closed = False
+
+        if not os.path.isdir(os.path.join(dirname,'chunks')):
+            os.makedirs(os.path.join(dirname,'chunks'))
+        if labels is not None:
+            np.save(os.path.join(dirname,'labels.npy'),np.asarray(labels))
+        if positions is not None:
+            np.save(os.path.join(dirname,'positions.npy'),np.asarray(positions))
+
+    @property
+    def time(self):
+        """ Writer for the time vector, pass as tfile to StreamRecorder """
+        if self._time is None:
+            self._time = _NpyWriter(os.path.join(self.dirname,'t.npy'),None,self.dtype)
+        return self._time
+
+    def append(self,rows):
+        """ Appends a (time x traces) array """
+        rows = np.asarray(rows)
+        i = 0
+        while i < len(rows):
+            n = min(len(rows)-i, self.chunk_rows-self._fill)
+            self._block[self._fill:self._fill+n] = rows[i:i+n]
+            self._fill += n
+            i += n
+            if self._fill == self.chunk_rows:
+                self._write_block()
+
+    def _write_block(self):
+        if self._fill == 0:
+            return
+        r = self.nrows // self.chunk_rows
+        for c in range(0,self.ntraces,self.chunk_cols):
+            block = self._block[:self._fill,c:c+self.chunk_cols]
+            name = os.path.join(self.dirname,'chunks',_chunk_name(r,c//self.chunk_cols))
+            if self.compress:
+                np.savez_compressed(name+'.npz',data=block)
+            else:
+                np.save(name+'.npy',block)
+        self.nrows += self._fill
+        self._fill = 0
+
+    def close(self):
+        """ Writes the last (partial) block and the metadata """
+        if self.closed:
+            return
+        self._write_block()
+        if self._time is not None:
+            self._time.close()
+        meta = dict(nt=self.nrows,ntraces=self.ntraces,chunk_rows=self.chunk_rows,\
+                    chunk_cols=self.chunk_cols,dtype=self.dtype.str,compress=self.compress)
+        with open(os.path.join(self.dirname,'meta.json'),'w') as f:
+            json.dump(meta,f)
+        self.closed = True
+
+def save_traces(dirname,data,labels=None,t=None,positions=None,**kwargs):
+    """
+    Writes traces that are already in memory to a trace store.
+
+    Args:
+        dirname = directory of the store
+        data = list of h.Vector() objects (e.g. from ez_record) or a
+               (time x traces) array
+        labels = optional labels for each trace
+        t = optional time vector (h.Vector() or array)
+        positions = optional segment positions for each trace
+        **kwargs passes on to TraceWriter (e.g. chunk_rows, compress)
+    """
+    if isinstance(data,np.ndarray):
+        ntraces = data.shape[1]
+    else:
+        ntraces = len(data)
+    store = TraceWriter(dirname,ntraces,labels=labels,positions=positions,**kwargs)
+    if isinstance(data,np.ndarray):
+        store.append(data)
+    else:
+        # convert one block of rows at a time
+        nt = len(data[0]) if ntraces else 0
+        buf = np.empty((store.chunk_rows,ntraces),dtype=store.dtype)
+        for i in range(0,nt,store.chunk_rows):
+            n = min(store.chunk_rows,nt-i)
+            for (j,vec) in enumerate(data):
+                buf[:n,j] = vec.as_numpy()[i:i+n]
+            store.append(buf[:n])
+    if t is not None:
+        store.time.append(np.asarray(t))
+    store.close()
+
+class TraceStore(object):
+    """
+    Lazy reader for a trace store. Indexing works like a (time x traces)
+    numpy array, but only the blocks touched by the index are loaded.
+
+    Args:
+        dirname = directory of the store
+        cache_size = number of decoded blocks kept in memory
+
+    Attributes:
+        shape = (number of time points, number of traces)
+        t = time vector (memory-mapped), or None
+        labels = trace labels, or None
+        positions = segment positions, or None
+    """
+    def __init__(self,dirname,cache_size=16):
+        self.dirname = dirname
+        with open(os.path.join(dirname,'meta.json')) as f:
+            self.meta = json.load(f)
+        self.shape = (self.meta['nt'],self.meta['ntraces'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.t = self._optional('t.npy',mmap_mode='r')
+        self.labels = self._optional('labels.npy')
+        self.positions = self._optional('positions.npy')
+        self.cache_size = cache_size
+        self._cache = {}
+        self._cache_order = []
+
+    def _optional(self,name,mmap_mode=None):
+        fname = os.path.join(self.dirname,name)
+        if os.path.exists(fname):
+            return np.load(fname,mmap_mode=mmap_mode)
+        return None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self,r,c):
+        key = (r,c)
+        if key not in self._cache:
+            name = os.path.join(self.dirname,'chunks',_chunk_name(r,c))
+            if self.meta['compress']:
+                with np.load(name+'.npz') as f:
+                    block = f['data']
+            else:
+                block = np.load(name+'.npy',mmap_mode='r')
+            self._cache[key] = block
+            self._cache_order.append(key)
+            if len(self._cache_order) > self.cache_size:
+                del self._cache[self._cache_order.pop(0)]
+        return self._cache[key]
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key = (key,slice(None))
+        rows = np.arange(self.shape[0])[key[0]]
+        cols = np.arange(self.shape[1])[key[1]]
+        out = np.empty((np.size(rows),np.size(cols)),dtype=self.dtype)
+        rows_1d, cols_1d = np.atleast_1d(rows), np.atleast_1d(cols)
+
+        cr, cc = self.meta['chunk_rows'], self.meta['chunk_cols']
+        rblock, cblock = rows_1d // cr, cols_1d // cc
+        for r in np.unique(rblock):
+            ri = np.nonzero(rblock == r)[0]
+            for c in np.unique(cblock):
+                ci = np.nonzero(cblock == c)[0]
+                block = self._chunk(r,c)
+                out[np.ix_(ri,ci)] = block[np.ix_(rows_1d[ri]-r*cr,cols_1d[ci]-c*cc)]
+
+        return out.reshape(np.shape(rows)+np.shape(cols))
+
+    def trace(self,i):
+        """ Returns all time points of trace i """
+        return self[:,i]
+
+    def window(self,tstart,tstop,traces=slice(None)):
+        """ Returns the traces for time points tstart <= t < tstop """
+        i0, i1 = np.searchsorted(self.t,[tstart,tstop])
+        return self[i0:i1,traces]
+
+def _chunk_name(r,c):
+    return 'r%06d_c%06d' % (r,c)
@@ -1,4 +1,5 @@
 from __future__ import division
+import os
 import numpy as np
 
 def add_exp2(h,seg,spktimes,e=0,tau1=0.5,tau2=20,weight=0.001):
@@ -19,12 +20,482 @@ def add_exp2(h,seg,spktimes,e=0,tau1=0.5,tau2=20,weight=0.001):
                or other parameters during the simulation.
     """
     syn = h.Exp2Syn(seg)
-    syn.e = 0
-    syn.tau1 = 0.5
-    syn.tau2 = 20
+    syn.e = e
+    syn.tau1 = tau1
+    syn.tau2 = tau2
     vs = h.VecStim()
     vec = h.Vector(np.sort(spktimes)) # Spend a bit of overhead to make sure spktimes are sorted
     vs.play(vec)
     nc = h.NetCon(vs,syn)
     nc.weight[0] = weight
     return [syn,vs,nc,vec]            # All these things need to be kept in memory
+
+def add_exp2_batch(h,segs,spktimes,offsets,e=0,tau1=0.5,tau2=20,weight=0.001,\
+                   assume_sorted=False,sources=None,dedupe=False,pattern=False,\
+                   gid_base=None):
+    """
+    Adds a double-exponential synapse at each segment in segs, all in
+    one pass. The spike trains are given as one flat array of spike
+    times, where train i is spktimes[offsets[i]:offsets[i+1]]. The
+    parameters e, tau1, tau2 and weight can be scalars or arrays with
+    one value per synapse. Returns an Exp2SynBatch that keeps all the
+    hocObjects in memory.
+
+    By default synapse i gets train i. Synapses that receive the same
+    presynaptic train should share one source (VecStim) fanned out
+    through several NetCons, so the number of VecStim and Vector objects
+    grows with the number of distinct trains, not with the number of
+    synapses.
+
+    Args:
+        h = hocObject to interface with neuron
+        segs = list of segments, one per synapse
+        spktimes = flat array of spike times for all trains
+        offsets = array of start indices into spktimes, with one more
+                  entry than there are trains
+        assume_sorted = skip sorting if each train is already sorted
+                        (e.g. from renewal_trains)
+        sources = optional array giving the train of each synapse
+                  (Default: synapse i gets train i)
+        dedupe = give identical trains a single source
+        pattern = drive all synapses from a single PatternStim instead
+                  of one VecStim per train. Train j is sent as the spikes
+                  of gid gid_base+j through ParallelContext.gid_connect
+        gid_base = first gid used in pattern mode (Default: None, the
+                   next gids not used by another pattern batch, from
+                   10**8 up). Raises ValueError if any of the gids is used
+                   by another pattern batch or by a cell of the model
+
+    IMPORTANT: Like add_exp2, this requires vecevent.mod to be compiled
+               and loaded (not needed when pattern=True).
+
+    Example:
+        segs = [sec(0.5) for sec in h.allsec()]
+        counts = np.random.poisson(20,len(segs))
+        times = np.random.uniform(0,1000,counts.sum())
+        offsets = np.concatenate(([0],np.cumsum(counts)))
+        batch = add_exp2_batch(h,segs,times,offsets,weight=1e-3)
+        batch.weights = 2*batch.weights
+
+        # 10 presynaptic trains shared by all synapses
+        sources = np.random.randint(0,10,len(segs))
+        batch = add_exp2_batch(h,segs,times,offsets[:11],sources=sources)
+    """
+    n = len(segs)
+    spktimes = np.asarray(spktimes,dtype=float)
+    offsets = np.asarray(offsets,dtype=int)
+    if sources is None:
+        if len(offsets) != n+1:
+            raise ValueError('offsets must have len(segs)+1 entries')
+        sources = np.arange(n)
+    else:
+        sources = np.asarray(sources,dtype=int)
+        if len(sources) != n:
+            raise ValueError('sources must have one entry per segment')
+    # plain python floats are much faster to hand to hoc than numpy scalars
+    e, tau1, tau2, weight = [np.broadcast_to(np.asarray(x,dtype=float),(n,)).tolist() \
+                             for x in (e,tau1,tau2,weight)]
+    # offsets may cover only part of spktimes (e.g. offsets[:11])
+    if offsets[0] != 0 or offsets[-1] != len(spktimes):
+        spktimes = spktimes[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+
+    if not assume_sorted:
+        spktimes = sort_trains(spktimes,offsets)
+    if dedupe:
+        first, inverse = unique_trains(spktimes,offsets)
+        sources = first[inverse[sources]]
+    # only make sources for the trains that are used
+    used, sources = np.unique(sources,return_inverse=True)
+    if len(used) < len(offsets)-1:
+        spktimes, offsets = select_trains(spktimes,offsets,used)
+
+    batch = Exp2SynBatch(h,offsets,sources)
+    if pattern:
+        stims = batch._pattern(spktimes,gid_base)
+    else:
+        stims = batch._stims(spktimes)
+    for i in range(n):
+        syn = h.Exp2Syn(segs[i])
+        syn.e = e[i]
+        syn.tau1 = tau1[i]
+        syn.tau2 = tau2[i]
+        batch.syns.append(syn)
+    batch._connect([stims[j] for j in sources.tolist()],weight)
+    return batch
+
+def sort_trains(spktimes,offsets):
+    """
+    Sorts each train of a flat spike time array (see add_exp2_batch)
+    with a single sort, returning a new array. Returns spktimes
+    unchanged if every train is already sorted. Spike times outside
+    spktimes[offsets[0]:offsets[-1]] are left in place.
+    """
+    spktimes = np.asarray(spktimes)
+    lo, hi = offsets[0], offsets[-1]
+    part = spktimes[lo:hi]
+    train = np.repeat(np.arange(len(offsets)-1),np.diff(offsets))
+    if not np.any((np.diff(part) < 0) & (train[1:] == train[:-1])):
+        return spktimes
+    spktimes = spktimes.copy()
+    spktimes[lo:hi] = part[np.lexsort((part,train))]
+    return spktimes
+
+def unique_trains(spktimes,offsets):
+    """
+    Finds identical trains in a flat spike time array (see
+    add_exp2_batch). The trains should be sorted.
+
+    Returns:
+        first = index of the first train identical to each unique train
+        inverse = index into first for each train
+    """
+    spktimes = np.ascontiguousarray(spktimes,dtype=float)
+    bounds = np.asarray(offsets).tolist()
+    seen = {}
+    inverse = np.empty(len(bounds)-1,dtype=int)
+    for j in range(len(bounds)-1):
+        inverse[j] = seen.setdefault(spktimes[bounds[j]:bounds[j+1]].tobytes(),len(seen))
+    first = np.zeros(len(seen),dtype=int)
+    first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+    return first, inverse
+
+def select_trains(spktimes,offsets,trains):
+    """
+    Returns (spktimes, offsets) holding only the given trains of a flat
+    spike time array (see add_exp2_batch), in the given order.
+    """
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)[trains]
+    new_offsets = np.concatenate(([0],np.cumsum(lengths))).astype(int)
+    idx = np.arange(new_offsets[-1]) + np.repeat(offsets[trains]-new_offsets[:-1],lengths)
+    return np.asarray(spktimes)[idx], new_offsets
+
+def poisson_trains(n,rate,tstop,tstart=0,seed=None):
+    """
+    Generates n homogeneous Poisson spike trains. Same as
+    renewal_trains with the default order and refractory period.
+    """
+    return renewal_trains(n,rate,tstop,tstart=tstart,seed=seed)
+
+def renewal_trains(n,rate,tstop,tstart=0,order=1,refractory=0,seed=None):
+    """
+    Generates n renewal spike trains between tstart and tstop (ms) in a
+    few vectorized rounds. The interspike intervals are a refractory
+    period plus a gamma distributed interval, so order=1, refractory=0
+    is a Poisson process, order>1 gives more regular (gamma) trains and
+    refractory>0 a Poisson process with dead time. Each train starts
+    fresh at tstart.
+
+    Args:
+        n = number of trains
+        rate = mean firing rate in Hz, a scalar or one value per train
+        order = shape parameter of the gamma distribution
+        refractory = refractory period (ms), must be below 1000/rate
+        seed = None, an int or a np.random.RandomState
+
+    Returns:
+        spktimes = flat array of spike times, sorted within each train
+        offsets = train i is spktimes[offsets[i]:offsets[i+1]]
+
+    The output can be passed straight to add_exp2_batch with
+    assume_sorted=True.
+
+    Example:
+        times, offsets = renewal_trains(len(segs),5.0,1000,order=3,seed=1)
+        batch = add_exp2_batch(h,segs,times,offsets,assume_sorted=True)
+    """
+    rng = _random_state(seed)
+    rate = np.broadcast_to(np.asarray(rate,dtype=float),(n,))
+    mean_isi = np.full(n,np.inf)
+    mean_isi[rate > 0] = 1e3/rate[rate > 0]
+    if np.any(mean_isi <= refractory):
+        raise ValueError('refractory period must be shorter than the mean interval')
+    scale = (mean_isi-refractory)/order
+
+    # every round draws enough intervals to finish most of the remaining
+    # trains; the few that are still short of tstop go another round
+    last = np.full(n,float(tstart))
+    active = np.nonzero(rate > 0)[0]
+    trains, times = [], []
+    while len(active):
+        expected = (tstop-last[active])/mean_isi[active]
+        k = (expected + 3*np.sqrt(expected) + 1).astype(int)
+        train = np.repeat(active,k)
+        if order == 1:
+            isi = refractory + scale[train]*rng.standard_exponential(len(train))
+        else:
+            isi = refractory + scale[train]*rng.standard_gamma(order,len(train))
+        # running sum of the intervals, restarted for each train
+        starts = np.concatenate(([0],np.cumsum(k)[:-1]))
+        c = np.cumsum(isi)
+        t = last[train] + c - np.repeat(c[starts]-isi[starts],k)
+        keep = t < tstop
+        trains.append(train[keep])
+        times.append(t[keep])
+        last[active] = t[starts+k-1]
+        active = active[last[active] < tstop]
+
+    train = np.concatenate(trains+[np.zeros(0,dtype=int)])
+    times = np.concatenate(times+[np.zeros(0)])
+    offsets = np.concatenate(([0],np.cumsum(np.bincount(train,minlength=n))))
+    if len(trains) > 1:
+        # later rounds go after the earlier ones within each train
+        times = times[np.argsort(train,kind='mergesort')]
+    return times, offsets
+
+def inhomogeneous_poisson_trains(n,rate,tstop,tstart=0,rate_max=None,seed=None):
+    """
+    Generates n inhomogeneous Poisson spike trains by thinning: a
+    homogeneous train at rate_max is drawn and each spike at time t is
+    kept with probability rate(t)/rate_max.
+
+    Args:
+        n = number of trains
+        rate = the firing rate in Hz, either a function rate(t,i) of
+               spike times t and train indices i (arrays), or a tuple
+               (tvec, rates) of sample times and rates, linearly
+               interpolated. rates is 1D (same for all trains) or has
+               one row per train
+        rate_max = upper bound of the rate, a scalar or one value per
+                   train (Default: the maximum of the sampled rates;
+                   required when rate is a function)
+        seed = None, an int or a np.random.RandomState
+
+    Returns:
+        spktimes, offsets as for renewal_trains
+
+    Example:
+        tvec = np.arange(0,1000,1.0)
+        rates = 10 + 10*np.sin(2*np.pi*tvec/100)
+        times, offsets = inhomogeneous_poisson_trains(1000,(tvec,rates),1000)
+    """
+    rng = _random_state(seed)
+    if callable(rate):
+        if rate_max is None:
+            raise ValueError('rate_max is required when rate is a function')
+        rate_fn = rate
+    else:
+        tvec, rates = np.asarray(rate[0],dtype=float), np.asarray(rate[1],dtype=float)
+        if rate_max is None:
+            rate_max = rates.max(axis=-1)
+        rate_fn = lambda t,i: _interp_rows(t,i,tvec,rates)
+    rate_max = np.broadcast_to(np.asarray(rate_max,dtype=float),(n,))
+
+    spktimes, offsets = renewal_trains(n,rate_max,tstop,tstart=tstart,seed=rng)
+    train = np.repeat(np.arange(n),np.diff(offsets))
+    keep = rng.uniform(0,1,len(spktimes))*rate_max[train] < rate_fn(spktimes,train)
+    offsets = np.concatenate(([0],np.cumsum(np.bincount(train[keep],minlength=n))))
+    return spktimes[keep], offsets
+
+def _interp_rows(t,i,tvec,rates):
+    # linear interpolation of rates (1D, or one row per train) at times t of trains i
+    j = np.clip(np.searchsorted(tvec,t)-1,0,len(tvec)-2)
+    w = np.clip((t-tvec[j])/(tvec[j+1]-tvec[j]),0,1)
+    if rates.ndim == 1:
+        return (1-w)*rates[j] + w*rates[j+1]
+    return (1-w)*rates[i,j] + w*rates[i,j+1]
+
+def _random_state(seed):
+    if isinstance(seed,np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+# gid ranges (first: last+1) sending the trains of the pattern batches that
+# have not been removed
+_pattern_gids = {}
+_next_gid = [10**8]
+
+def _reserve_gids(pc,gid_base,n):
+    """
+    Helper function, reserves n gids for the trains of a pattern batch and
+    returns the first.
+    """
+    if gid_base is None:
+        gid_base = _next_gid[0]
+    stop = gid_base + n
+    for (start,end) in _pattern_gids.items():
+        if gid_base < end and start < stop:
+            raise ValueError('gids %d to %d are used by another pattern batch' % (start,end-1))
+    for gid in range(gid_base,stop):
+        if pc.gid_exists(gid):
+            raise ValueError('gid %d is used by a cell of the model' % gid)
+    _pattern_gids[gid_base] = stop
+    _next_gid[0] = max(_next_gid[0],stop)
+    return gid_base
+
+class Exp2SynBatch(object):
+    """
+    Owns the Exp2Syn, VecStim, NetCon and Vector objects created by
+    add_exp2_batch. Each VecStim plays its own h.Vector(), copied from its
+    slice of the flat spike time array.
+
+    Attributes:
+        syns = list of Exp2Syn objects
+        stims = list of sources, stims[j] plays train j (a single
+                PatternStim in pattern mode)
+        trains = list of h.Vector() objects, trains[j] holds the spike
+                 times of train j (empty in pattern mode)
+        netcons = list of NetCon objects, netcons[i] drives syns[i]
+        sources = array giving the train of each synapse
+        spikes = in pattern mode, h.Vector() holding all spike times in
+                 time order, with the sending gids in gids (None otherwise)
+        offsets = train j has offsets[j+1]-offsets[j] spikes
+
+    The weights property gets/sets the weights of all NetCons at once:
+        batch.weights = np.full(len(batch),2e-3)
+    """
+    def __init__(self,h,offsets,sources):
+        self.h = h
+        self.spikes = None
+        self.offsets = offsets
+        self.sources = sources
+        self.syns = []
+        self.stims = []
+        self.trains = []
+        self.netcons = []
+        self.gids = None
+        self.gid_base = None
+        self._pc = None
+        self._weights = None
+
+    def __len__(self):
+        return len(self.netcons)
+
+    def _stims(self,spktimes):
+        # one VecStim per train, each playing a copy of its slice of spktimes
+        h = self.h
+        offsets = np.asarray(self.offsets).tolist()
+        stims = []
+        for (i0,i1) in zip(offsets[:-1],offsets[1:]):
+            vs = h.VecStim()
+            vec = h.Vector(spktimes[i0:i1])
+            vs.play(vec)
+            stims.append(vs)
+            self.trains.append(vec)
+        self.stims.extend(stims)
+        return stims
+
+    def _pattern(self,spktimes,gid_base):
+        # a single PatternStim sending train j as the spikes of gid_base+j;
+        # returns the gids, which _connect hands to gid_connect
+        h = self.h
+        ntrains = len(self.offsets)-1
+        self._pc = h.ParallelContext()
+        gid_base = self.gid_base = _reserve_gids(self._pc,gid_base,ntrains)
+        gids = gid_base + np.repeat(np.arange(ntrains),np.diff(self.offsets))
+        order = np.argsort(spktimes,kind='mergesort')
+        self.spikes = h.Vector(spktimes[order])
+        self.gids = h.Vector(gids[order])
+        ps = h.PatternStim()
+        ps.play(self.spikes,self.gids)
+        self.stims.append(ps)
+        return range(gid_base,gid_base+ntrains)
+
+    def _connect(self,sources,weights):
+        # connects sources[i] to self.syns[i] for the most recently added synapses
+        if self._pc is None:
+            connect = self.h.NetCon
+        else:
+            connect = self._pc.gid_connect
+        syns = self.syns[len(self.netcons):]
+        for (src,syn,w) in zip(sources,syns,weights):
+            nc = connect(src,syn)
+            nc.weight[0] = w
+            self.netcons.append(nc)
+        self._weights = None
+
+    def _weight_ptrs(self):
+        if self._weights is None:
+            self._weights = self.h.PtrVector(len(self.netcons))
+            for (i,nc) in enumerate(self.netcons):
+                self._weights.pset(i,nc._ref_weight[0])
+        return self._weights
+
+    @property
+    def weights(self):
+        """ Array of NetCon weights """
+        vec = self.h.Vector(len(self))
+        self._weight_ptrs().gather(vec)
+        return vec.as_numpy().copy()
+
+    @weights.setter
+    def weights(self,w):
+        w = np.broadcast_to(np.asarray(w,dtype=float),(len(self),))
+        self._weight_ptrs().scatter(self.h.Vector(w))
+
+    def object_count(self):
+        """ Number of hocObjects owned by the batch """
+        n = len(self.syns) + len(self.netcons) + len(self.stims) + len(self.trains)
+        return n + sum(vec is not None for vec in (self.spikes,self.gids))
+
+    def remove(self):
+        """ Releases all hocObjects, removing the synapses from the model """
+        self._weights = None
+        self.netcons, self.stims, self.trains, self.syns = [], [], [], []
+        self.spikes, self.gids = None, None
+        _pattern_gids.pop(self.gid_base,None)
+        self.gid_base = None
+
+def benchmark(h,nsyn=10**5,ntrains=1000,rate=10.0,tstop=1000.0,seed=0):
+    """
+    Compares the ways add_exp2_batch can drive nsyn synapses that share
+    ntrains Poisson trains: a private copy of the train for every
+    synapse (as with add_exp2), shared sources, dedupe of the private
+    copies, and a single PatternStim. Measures the time, the number of
+    hocObjects and the growth of the resident memory for each.
+
+    Returns:
+        dict mapping each mode to (seconds, objects, MB)
+    """
+    rng = np.random.RandomState(seed)
+    sec = h.Section(name='benchmark')
+    sec.nseg = 101
+    segs = [sec(x) for x in rng.uniform(0,1,nsyn)]
+    times, offsets = poisson_trains(ntrains,rate,tstop,seed=rng)
+    sources = rng.randint(0,ntrains,nsyn)
+    private = select_trains(times,offsets,sources)
+
+    modes = [('private',private,dict()),
+             ('dedupe',private,dict(dedupe=True)),
+             ('shared',(times,offsets),dict(sources=sources)),
+             ('pattern',(times,offsets),dict(sources=sources,pattern=True))]
+    # each mode runs in a fresh (forked) process, so the memory growth of
+    # one mode is not hidden by memory released by another
+    from multiprocessing import Pool
+    global _benchmark_state
+    _benchmark_state = (h,segs,modes)
+    results = {}
+    for (i,(mode,_,_)) in enumerate(modes):
+        pool = Pool(1)
+        results[mode] = pool.apply(_benchmark_mode,(i,))
+        pool.close()
+        pool.join()
+    _benchmark_state = None
+    return results
+
+_benchmark_state = None
+
+def _benchmark_mode(i):
+    import time
+    h, segs, modes = _benchmark_state
+    (t,offsets), kwargs = modes[i][1:]
+    mem = _rss()
+    start = time.time()
+    batch = add_exp2_batch(h,segs,t,offsets,assume_sorted=True,**kwargs)
+    elapsed = time.time() - start
+    return (elapsed,batch.object_count(),(_rss()-mem)/1e6)
+
+def _rss():
+    # resident memory in bytes (linux only, 0 elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError,OSError):
+        return 0
+
+if __name__ == '__main__':
+    from neuron import h
+    h.load_file('stdrun.hoc')
+    for (mode,result) in sorted(benchmark(h).items()):
+        print('%8s: %6.2f s, %7d objects, %7.1f MB' % ((mode,)+result))
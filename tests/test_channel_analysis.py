@@ -0,0 +1,61 @@
+"""
+Tests for PyNeuronToolbox.channel_analysis, on the built-in hh mechanism.
+"""
+import unittest
+
+try:
+    import numpy as np
+    from neuron import h
+    from PyNeuronToolbox import channel_analysis
+except ImportError:
+    channel_analysis = None
+
+@unittest.skipIf(channel_analysis is None, 'needs numpy and NEURON')
+class IvcurveTest(unittest.TestCase):
+
+    def test_checkpoint(self):
+        kwargs = dict(vmin=-80, vmax=40, deltav=20, vinit=-65)
+        with_checkpoint = channel_analysis.ivtable('hh', ['ina', 'ik'], checkpoint=True, **kwargs)
+        without = channel_analysis.ivtable('hh', ['ina', 'ik'], checkpoint=False, **kwargs)
+        for name in with_checkpoint.dtype.names:
+            np.testing.assert_allclose(with_checkpoint[name], without[name], rtol=1e-9, atol=1e-12)
+        i, v = channel_analysis.ivcurve('hh', 'ina', checkpoint=True, **kwargs)
+        np.testing.assert_array_equal(i, with_checkpoint['ina_peak'])
+        np.testing.assert_array_equal(v, np.arange(-80, 40, 20))
+        # inward sodium current at depolarized steps
+        self.assertLess(min(i), 0)
+
+@unittest.skipIf(channel_analysis is None, 'needs numpy and NEURON')
+class StateCurvesTest(unittest.TestCase):
+
+    def test_hh_rates(self):
+        table = channel_analysis.state_curves('hh', ['m_hh', 'h_hh', 'n_hh'], vmin=-80, vmax=40,
+                                              deltav=10, cache=False)
+        sec = h.Section()
+        sec.insert('hh')
+        seg = sec(0.5)
+        for row in table:
+            h.setdata_hh(seg)
+            h.rates_hh(row['v'])
+            for state in 'mhn':
+                inf = getattr(seg, state + 'inf_hh')
+                tau = getattr(seg, state + 'tau_hh')
+                self.assertAlmostEqual(row[state + '_hh_inf'], inf, delta=1e-3)
+                self.assertAlmostEqual(row[state + '_hh_tau'] / tau, 1, delta=0.02)
+
+    def test_tau_curve(self):
+        tau, v = channel_analysis.tau_curve('hh', 'n_hh', vmin=-80, vmax=40, deltav=10, cache=False)
+        table = channel_analysis.state_curves('hh', ['n_hh'], vmin=-80, vmax=40, deltav=10, cache=False)
+        np.testing.assert_array_equal(tau, table['n_hh_tau'])
+        np.testing.assert_array_equal(v, table['v'])
+
+    def test_activation_inactivation(self):
+        g, v = channel_analysis.activation_curve('hh', 'gna_hh', vmin=-80, vmax=40, deltav=10, cache=False)
+        self.assertEqual(np.max(g), 1)
+        self.assertTrue(np.all(np.diff(g) >= -1e-9))
+        g, v = channel_analysis.inactivation_curve('hh', 'gna_hh', vmin=-80, vmax=40, deltav=10, cache=False)
+        self.assertEqual(np.max(g), 1)
+        self.assertTrue(np.all(np.diff(g) <= 1e-9))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,401 @@
+"""
+Tests for PyNeuronToolbox.morphology.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    from neuron import h
+    from PyNeuronToolbox import morphology
+except ImportError:
+    morphology = None
+
+# NeuroMorpho.Org three-point soma with a one-point dendrite attached to the
+# first soma point, a two-point dendrite and a one-point axon continuing it
+swc_one_point_branches = """\
+# three-point soma
+1 1 0 0 0 5 -1
+2 1 0 -5 0 5 1
+3 1 0 5 0 5 1
+4 3 -20 0 0 1 1
+5 3 0 30 0 1 3
+6 3 0 60 0 0.5 5
+7 2 0 -40 0 0.4 2
+"""
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class InterpolateJaggedTest(unittest.TestCase):
+
+    def test_batch_matches_single_sections(self):
+        rng = np.random.RandomState(0)
+        for trial in range(2000):
+            nsec = rng.randint(2, 6)
+            npts = rng.randint(1, 8, nsec)
+            nseg = rng.randint(1, 6, nsec)
+            xyz = rng.uniform(-100, 100, (npts.sum(), 3))
+            pt_offsets = np.concatenate(([0], np.cumsum(npts)))
+            coords, offsets = morphology.interpolate_jagged_batch(xyz, pt_offsets, nseg)
+            expected = []
+            for k in range(nsec):
+                expected += morphology.interpolate_jagged(xyz[pt_offsets[k]:pt_offsets[k+1]], nseg[k])
+            self.assertEqual(len(offsets) - 1, len(expected))
+            for (g, path) in enumerate(expected):
+                np.testing.assert_allclose(coords[offsets[g]:offsets[g+1]], path, rtol=0, atol=1e-9)
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class ReadSwcTest(unittest.TestCase):
+
+    def setUp(self):
+        h.load_file('stdlib.hoc')
+        h.load_file('import3d.hoc')
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write(self, text):
+        fname = os.path.join(self.dirname, 'cell.swc')
+        with open(fname, 'w') as f:
+            f.write(text)
+        return fname
+
+    def assertSameTemplate(self, a, b):
+        for key in ('offsets', 'parent', 'parentx', 'type'):
+            np.testing.assert_array_equal(a[key], b[key])
+        np.testing.assert_array_equal(np.isnan(a['style']), np.isnan(b['style']))
+        np.testing.assert_allclose(a['style'][~np.isnan(a['style'])], b['style'][~np.isnan(b['style'])])
+        np.testing.assert_allclose(a['points'], b['points'], rtol=0, atol=1e-6)
+
+    def test_one_point_sections_as_import3d(self):
+        fname = self.write(swc_one_point_branches)
+        template = morphology.read_swc(fname)
+        self.assertSameTemplate(template, morphology.read_import3d(fname, 'swc'))
+        # the wired one-point dendrite is a sphere with L = diam
+        npts = np.diff(template['offsets'])
+        sphere = template['points'][template['offsets'][2]:template['offsets'][3]]
+        self.assertEqual(list(template['type']), [1, 1, 3, 3, 2])
+        self.assertEqual(npts[2], 3)
+        self.assertAlmostEqual(sphere[2,0] - sphere[0,0], 2.0)
+
+    def test_load_without_cell(self):
+        fname = self.write(swc_one_point_branches)
+        cell = morphology.load(fname, cache=False)
+        self.assertEqual(len(cell.soma), 2)
+        self.assertAlmostEqual(cell.dend[0].L, 2.0, places=3)
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class TemplateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache_dir = morphology.cache_dir
+        self.templates = dict(morphology._templates)
+        morphology.cache_dir = os.path.join(self.dirname, 'cache')
+        morphology._templates.clear()
+        self.fname = os.path.join(self.dirname, 'cell.swc')
+        self.write(swc_one_point_branches)
+
+    def tearDown(self):
+        morphology.cache_dir = self.cache_dir
+        morphology._templates.clear()
+        morphology._templates.update(self.templates)
+        shutil.rmtree(self.dirname)
+
+    def write(self, text):
+        with open(self.fname, 'w') as f:
+            f.write(text)
+
+    def cached_files(self):
+        return sorted(os.listdir(morphology.cache_dir))
+
+    def assertSameArrays(self, a, b):
+        self.assertEqual(sorted(a), sorted(b))
+        for key in a:
+            np.testing.assert_array_equal(a[key], b[key])
+
+    def test_miss_then_hit(self):
+        template = morphology.read_morphology(self.fname)
+        self.assertSameArrays(template, morphology._compact(morphology.read_swc(self.fname)))
+        self.assertEqual(len(self.cached_files()), 1)
+        # a hit in memory returns the same template
+        self.assertIs(morphology.read_morphology(self.fname), template)
+        # a hit on disk does not parse the file again
+        morphology._templates.clear()
+        read_swc = morphology.read_swc
+        morphology.read_swc = None
+        try:
+            loaded = morphology.read_morphology(self.fname)
+        finally:
+            morphology.read_swc = read_swc
+        self.assertSameArrays(loaded, template)
+
+    def test_same_contents_other_file(self):
+        template = morphology.read_morphology(self.fname)
+        other = os.path.join(self.dirname, 'copy.swc')
+        shutil.copy(self.fname, other)
+        self.assertIs(morphology.read_morphology(other), template)
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_invalidated_by_changed_file(self):
+        before = morphology.read_morphology(self.fname)
+        # move the axon point
+        self.write(swc_one_point_branches.replace('7 2 0 -40 0 0.4 2', '7 2 0 -80 0 0.4 2'))
+        after = morphology.read_morphology(self.fname)
+        self.assertEqual(len(self.cached_files()), 2)
+        self.assertSameArrays(after, morphology._compact(morphology.read_swc(self.fname)))
+        self.assertEqual(after['points'][-1,1], -80)
+        self.assertEqual(before['points'][-1,1], -40)
+
+    def test_no_cache(self):
+        template = morphology.read_morphology(self.fname, cache=False)
+        self.assertFalse(os.path.exists(morphology.cache_dir))
+        self.assertEqual(morphology._templates, {})
+        self.assertSameArrays(template, morphology.read_swc(self.fname))
+
+    def test_memory_only(self):
+        morphology.cache_dir = None
+        template = morphology.read_morphology(self.fname)
+        self.assertIs(morphology.read_morphology(self.fname), template)
+        self.assertFalse(os.path.exists(os.path.join(self.dirname, 'cache')))
+
+def _pt3d(sec):
+    return np.array([[sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.diam3d(i)] for i in range(sec.n3d())])
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class MorphologyTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, 'cell.swc')
+        with open(self.fname, 'w') as f:
+            f.write(swc_one_point_branches)
+        self.template = morphology.MorphologyTemplate(self.fname, cache=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assertSameCell(self, a, b):
+        self.assertEqual(len(a.all), len(b.all))
+        for (sa, sb) in zip(a.all, b.all):
+            np.testing.assert_allclose(_pt3d(sa), _pt3d(sb), rtol=0, atol=1e-4)
+            pa, pb = sa.parentseg(), sb.parentseg()
+            self.assertEqual(pa is None, pb is None)
+            if pa is not None:
+                self.assertEqual(pa.x, pb.x)
+                self.assertEqual(a.all.index(pa.sec), b.all.index(pb.sec))
+
+    def test_cell_matches_load_swc(self):
+        cell = self.template.cell(xshift=100, zshift=-5)
+        self.assertSameCell(cell, morphology.load_swc(self.fname, xshift=100, zshift=-5, cache=False))
+        self.assertEqual(cell.name, self.template.name + '[0]')
+        self.assertEqual(self.template.cell(name='other').name, 'other')
+
+    def test_rotation(self):
+        rotation = morphology.rotation_matrix([0, 0, 1], np.pi / 2)
+        cell = self.template.cell(xshift=10, rotation=rotation)
+        plain = self.template.cell()
+        for (sec, ref) in zip(cell.all, plain.all):
+            xyzd = _pt3d(ref)
+            # (x, y) -> (-y, x), then the shift
+            expected = np.column_stack((10 - xyzd[:, 1], xyzd[:, 0], xyzd[:, 2], xyzd[:, 3]))
+            np.testing.assert_allclose(_pt3d(sec), expected, rtol=0, atol=1e-4)
+
+    def test_population_matches_cells(self):
+        rng = np.random.RandomState(0)
+        positions = rng.uniform(-500, 500, (5, 3))
+        rotations = [morphology.rotation_matrix(rng.normal(size=3), a) for a in rng.uniform(0, 6, 5)]
+        cells = self.template.population(positions, rotations=rotations)
+        self.assertEqual([c.name for c in cells], [self.template.name + '[%d]' % i for i in range(5)])
+        for (cell, pos, rot) in zip(cells, positions, rotations):
+            self.assertSameCell(cell, self.template.cell(*pos, rotation=rot))
+        self.assertEqual(self.template.ncells, 10)
+        # a single rotation for all cells
+        cells = self.template.population(positions[:2], rotations=rotations[0], names=['a', 'b'])
+        self.assertEqual([c.name for c in cells], ['a', 'b'])
+        self.assertSameCell(cells[1], self.template.cell(*positions[1], rotation=rotations[0]))
+
+    def test_without_axon(self):
+        template = morphology.MorphologyTemplate(self.fname, use_axon=False, cache=False)
+        cell, = template.population([[0, 0, 0]])
+        self.assertEqual(len(cell.axon), 0)
+        self.assertEqual(len(cell.all), 4)
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        fname = os.path.join(self.dirname, 'cell.swc')
+        with open(fname, 'w') as f:
+            f.write(swc_one_point_branches)
+        self.cell = morphology.load_swc(fname, cache=False)
+        self.expected = morphology.morphology_to_arrays(self.cell.all)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assertSameMorphology(self, sections):
+        arrays = morphology.morphology_to_arrays(sections)
+        for key in ('points', 'offsets', 'parent', 'parent_loc', 'orientation', 'style'):
+            np.testing.assert_array_equal(arrays[key], self.expected[key])
+        self.assertEqual([sec.name() for sec in sections], list(self.expected['name']))
+
+    def test_wired_section(self):
+        # the one-point dendrite is connected by a wire to the first soma point
+        self.assertEqual(np.isnan(self.expected['style'][:, 0]).tolist(), [True, True, False, True, True])
+
+    def test_npz(self):
+        fname = os.path.join(self.dirname, 'cell.npz')
+        morphology.morphology_to_npz(self.cell.all, fname)
+        self.assertSameMorphology(morphology.load_npz(fname))
+
+    def test_json(self):
+        for encoding in (None, 'base64'):
+            fname = os.path.join(self.dirname, 'cell.json')
+            morphology.morphology_to_dict(self.cell.all, outfile=fname, encoding=encoding)
+            self.assertSameMorphology(morphology.load_json(fname))
+            self.assertSameMorphology(morphology.load_json(morphology.morphology_to_dict(self.cell.all)))
+
+    def test_writer(self):
+        fname = os.path.join(self.dirname, 'cells.json')
+        with morphology.MorphologyWriter(fname, encoding='base64') as writer:
+            writer.write(self.cell.all)
+            writer.write(self.cell.all)
+        cells = morphology.load_json(fname)
+        self.assertEqual(len(cells), 2)
+        for sections in cells:
+            self.assertSameMorphology(sections)
+
+def _random_tree(rng, nsec, with_points=False):
+    # sections attached at random locations, with either end and random nseg
+    secs = []
+    for k in range(nsec):
+        sec = h.Section(name='s%d' % k)
+        sec.L = rng.uniform(5, 100)
+        sec.nseg = rng.randint(1, 8)
+        if with_points:
+            xyz = np.cumsum(rng.normal(0, 10, (rng.randint(2, 6), 3)), axis=0)
+            for (x, y, z) in xyz:
+                h.pt3dadd(x, y, z, 1, sec=sec)
+        if secs:
+            parent = secs[rng.randint(len(secs))]
+            loc = rng.choice([0, 1, rng.uniform(0, 1)])
+            sec.connect(parent(loc), rng.randint(2))
+        secs.append(sec)
+    return secs
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class PathDistancesTest(unittest.TestCase):
+
+    def test_matches_h_distance(self):
+        rng = np.random.RandomState(0)
+        for trial in range(10):
+            secs = _random_tree(rng, rng.randint(1, 15))
+            dist = morphology.PathDistances(h, secs)
+            segs = dist.segments
+            self.assertEqual(len(segs), sum(sec.nseg for sec in secs))
+            expected = np.array([[h.distance(a, b) for b in segs] for a in segs])
+            np.testing.assert_allclose(dist.matrix(), expected, rtol=0, atol=1e-9)
+            i = rng.randint(len(segs), size=20)
+            j = rng.randint(len(segs), size=20)
+            np.testing.assert_allclose(dist.between(i, j), expected[i, j], rtol=0, atol=1e-9)
+            for seg in segs[::3]:
+                self.assertEqual(segs[dist.segment_index(seg)], seg)
+                np.testing.assert_allclose(dist.from_origin(seg), expected[dist.segment_index(seg)],
+                                           rtol=0, atol=1e-9)
+            # any location, including the ends of a section
+            sec = secs[rng.randint(len(secs))]
+            for x in (0, 1, rng.uniform(0, 1)):
+                np.testing.assert_allclose(dist.from_origin((sec, x)),
+                                           [h.distance(sec(x), seg) for seg in segs], rtol=0, atol=1e-9)
+
+    def test_sparse(self):
+        secs = _random_tree(np.random.RandomState(1), 12)
+        dist = morphology.PathDistances(h, secs)
+        full = dist.matrix()
+        i, j, d = dist.sparse(60.0)
+        self.assertEqual(sorted(zip(i, j)), sorted(zip(*np.nonzero(full <= 60.0))))
+        np.testing.assert_array_equal(d, full[i, j])
+        rows, cols = [0, 3, 5], [1, 2]
+        i, j, d = dist.sparse(1e9, rows=rows, cols=cols)
+        np.testing.assert_array_equal(d, full[np.ix_(rows, cols)][i, j])
+        self.assertEqual(len(d), 6)
+
+    def test_separate_trees(self):
+        rng = np.random.RandomState(2)
+        a, b = _random_tree(rng, 3), _random_tree(rng, 3)
+        dist = morphology.PathDistances(h, a + b)
+        na = sum(sec.nseg for sec in a)
+        D = dist.matrix()
+        self.assertTrue(np.all(np.isinf(D[:na, na:])))
+        self.assertTrue(np.all(np.isfinite(D[:na, :na])))
+        self.assertTrue(np.all(np.isfinite(D[na:, na:])))
+
+@unittest.skipIf(morphology is None, 'needs numpy and NEURON')
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.secs = _random_tree(rng, 20, with_points=True)
+        h.define_shape()
+        coords, offsets = morphology.segment_paths(h, self.secs)
+        self.points = rng.uniform(coords.min(axis=0) - 20, coords.max(axis=0) + 20, (300, 3))
+        # distance from every point to every piece of every segment path
+        dist = np.full((len(self.points), len(offsets) - 1), np.inf)
+        for g in range(len(offsets) - 1):
+            for k in range(offsets[g], offsets[g+1] - 1):
+                a, ab = coords[k], coords[k+1] - coords[k]
+                t = np.clip(np.dot(self.points - a, ab) / max(np.dot(ab, ab), 1e-300), 0, 1)
+                d = np.linalg.norm(self.points - (a + t[:, None] * ab), axis=1)
+                dist[:, g] = np.minimum(dist[:, g], d)
+        self.brute = dist
+
+    def check(self, index):
+        self.assertEqual(len(index), self.brute.shape[1])
+        rows = np.arange(len(self.points))
+        # neighboring segments share the ends of their paths, so ties are
+        # common: check the distances and that they belong to the segments
+        segs, dist = index.nearest(self.points)
+        np.testing.assert_allclose(dist, self.brute.min(axis=1), rtol=0, atol=1e-9)
+        np.testing.assert_allclose(self.brute[rows, segs], dist, rtol=0, atol=1e-9)
+        segs, dist = index.knearest(self.points, 5)
+        np.testing.assert_allclose(dist, np.sort(self.brute, axis=1)[:, :5], rtol=0, atol=1e-9)
+        np.testing.assert_allclose(self.brute[rows[:, None], segs], dist, rtol=0, atol=1e-9)
+        self.assertTrue(all(len(set(row)) == 5 for row in segs.tolist()))
+        radius = np.random.RandomState(4).uniform(0, 40, len(self.points))
+        segs, dist, offsets = index.ball(self.points, radius)
+        for (i, row) in enumerate(self.brute):
+            near = np.nonzero(row <= radius[i])[0]
+            found = segs[offsets[i]:offsets[i+1]]
+            self.assertEqual(sorted(found), sorted(near))
+            np.testing.assert_allclose(dist[offsets[i]:offsets[i+1]], row[found], rtol=0, atol=1e-9)
+            self.assertTrue(np.all(np.diff(dist[offsets[i]:offsets[i+1]]) >= 0))
+
+    def test_matches_brute_force(self):
+        self.check(morphology.SpatialIndex(h, self.secs))
+
+    def test_cell_sizes(self):
+        # pieces much longer than a grid cell, and a single cell for everything
+        for cell_size in (0.5, 1e4):
+            self.check(morphology.SpatialIndex(h, self.secs, cell_size=cell_size))
+
+    def test_add(self):
+        index = morphology.SpatialIndex(h, self.secs[:7])
+        index.add(self.secs[7:])
+        index.add(self.secs[:3])
+        self.assertEqual(index.sections, self.secs)
+        self.check(index)
+
+    def test_fewer_segments_than_k(self):
+        index = morphology.SpatialIndex(h, self.secs[:1])
+        n = len(index)
+        segs, dist = index.knearest(self.points[:4], n + 2)
+        self.assertTrue(np.all(segs[:, n:] == -1))
+        self.assertTrue(np.all(np.isinf(dist[:, n:])))
+        self.assertTrue(np.all(segs[:, :n] >= 0))
+
+if __name__ == '__main__':
+    unittest.main()
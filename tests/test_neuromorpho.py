@@ -0,0 +1,293 @@
+"""
+Tests for PyNeuronToolbox.neuromorpho. The downloads run against a local
+threaded HTTP server that stands in for NeuroMorpho.Org.
+
+neuromorpho is a Python 2 module, run with e.g.
+
+    python2 -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import BaseHTTPServer
+    import SocketServer
+    from PyNeuronToolbox import neuromorpho
+except (ImportError, SyntaxError):
+    neuromorpho = None
+
+def _info_page(name):
+    return ('<table><td align="left">Header</td><td align="left">Nav</td>\n'
+            '<tr><td align="right" width="50%%">Neuron Name&nbsp;:&nbsp;</td>'
+            '<td align="left">%s</td></tr>\n'
+            '<tr><td align="right" width="50%%">Soma Surface&nbsp;:&nbsp;</td>'
+            '<td align="left">12.5&nbsp;&#956;m<sup>2</sup></td></tr>\n'
+            '</table>\n'
+            '<a href=dableFiles/x/CNG%%20version/%s.CNG.swc>Morphology File (Standardized)</a>\n'
+            '<a href=dableFiles/x/Source-Version/%s.asc>Morphology File (Original)</a>\n') % (name, name, name)
+
+def _swc(name):
+    return '# %s\n1 1 0 0 0 1 -1\n' % name
+
+class _Clock(object):
+    """Stands in for the time module, recording the delays instead of sleeping."""
+    def __init__(self):
+        self.delays = []
+
+    def sleep(self, seconds):
+        self.delays.append(seconds)
+
+    def time(self):
+        return time.time()
+
+if neuromorpho is not None:
+    class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            with self.server.lock:
+                self.server.connections += 1
+
+        def do_GET(self):
+            server = self.server
+            path = self.path.lstrip('/')
+            with server.lock:
+                server.requests.append(path)
+                fail = server.failures.get(path, 0) > 0
+                if fail:
+                    server.failures[path] -= 1
+            if fail:
+                self._send(503, '')
+            elif path.startswith('neuron_info.jsp?neuron_name='):
+                self._send(200, _info_page(path.split('=', 1)[1]))
+            elif path.startswith('dableFiles/x/CNG%20version/'):
+                self._send(200, _swc(path.rsplit('/', 1)[1].split('.')[0]))
+            else:
+                self._send(404, '')
+            if server.drop_connections:
+                # close without saying so, like a server whose keep-alive timeout ran out
+                self.close_connection = 1
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+@unittest.skipIf(neuromorpho is None, 'neuromorpho needs Python 2')
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.connections = 0
+        self.server.drop_connections = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        # send the requests for neuromorpho.org to the stub
+        stub = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self._http_get = neuromorpho._http_get
+        neuromorpho._http_get = lambda url, redirects=5: \
+            self._http_get(url.replace('http://neuromorpho.org', stub), redirects)
+        neuromorpho.set_network(retries=3, backoff=0.01, timeout=5)
+        neuromorpho.set_cache(None)
+        self.dirname = tempfile.mkdtemp()
+        self.names = ['c%02d' % i for i in range(20)]
+
+    def tearDown(self):
+        neuromorpho._http_get = self._http_get
+        neuromorpho._local.__dict__.pop('connections', None)
+        neuromorpho.set_network()
+        neuromorpho.set_cache(None)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dirname)
+
+    def assertDownloaded(self, names):
+        for name in names:
+            with open(os.path.join(self.dirname, name + '.swc')) as f:
+                self.assertEqual(f.read(), _swc(name))
+            with open(os.path.join(self.dirname, name + '.json')) as f:
+                self.assertIn('"Neuron Name": "%s"' % name, f.read())
+
+    def test_download_all(self):
+        progress = []
+        failed = neuromorpho.download_all(self.names, self.dirname, threads=4,
+                                          progress=lambda *args: progress.append(args))
+        self.assertEqual(failed, {})
+        self.assertDownloaded(self.names)
+        self.assertEqual(sorted(n for (done, total, n) in progress), self.names)
+        self.assertEqual([done for (done, total, n) in progress], range(1, 21))
+        # one page and one file per cell, over one keep-alive connection per thread
+        self.assertEqual(len(self.server.requests), 40)
+        self.assertLessEqual(self.server.connections, 4)
+        self.assertFalse([f for f in os.listdir(self.dirname) if f.endswith('.tmp')])
+
+    def test_retry_with_backoff(self):
+        path = 'neuron_info.jsp?neuron_name=c00'
+        self.server.failures[path] = 2
+        clock = _Clock()
+        neuromorpho.time = clock
+        try:
+            failed = neuromorpho.download_all(['c00'], self.dirname, threads=1)
+        finally:
+            neuromorpho.time = time
+        self.assertEqual(failed, {})
+        self.assertDownloaded(['c00'])
+        self.assertEqual(self.server.requests.count(path), 3)
+        self.assertEqual(clock.delays, [0.01, 0.02])
+
+    def test_give_up_after_retries(self):
+        self.server.failures['neuron_info.jsp?neuron_name=c01'] = 10
+        failed = neuromorpho.download_all(['c00', 'c01'], self.dirname, threads=2)
+        self.assertEqual(list(failed), ['c01'])
+        self.assertEqual(failed['c01'].code, 503)
+        self.assertEqual(self.server.requests.count('neuron_info.jsp?neuron_name=c01'), 4)
+        self.assertDownloaded(['c00'])
+        self.assertFalse(os.path.exists(os.path.join(self.dirname, 'c01.swc')))
+
+    def test_resume(self):
+        neuromorpho.download_all(self.names[:5], self.dirname)
+        # a cell whose metadata is missing is fetched again
+        os.remove(os.path.join(self.dirname, 'c03.json'))
+        del self.server.requests[:]
+        neuromorpho.set_cache(None)
+        failed = neuromorpho.download_all(self.names, self.dirname)
+        self.assertEqual(failed, {})
+        self.assertDownloaded(self.names)
+        fetched = set(path.split('=', 1)[1] for path in self.server.requests if '=' in path)
+        self.assertEqual(fetched, set(['c03']) | set(self.names[5:]))
+
+    def test_reconnect(self):
+        # every keep-alive connection is dropped by the server after one request
+        self.server.drop_connections = True
+        neuromorpho.set_network(retries=1, backoff=0, timeout=5)
+        failed = neuromorpho.download_all(self.names, self.dirname, threads=4)
+        self.assertEqual(failed, {})
+        self.assertDownloaded(self.names)
+        self.assertEqual(self.server.connections, len(self.server.requests))
+
+    def test_shared_cache(self):
+        cache_dir = os.path.join(self.dirname, 'cache')
+        neuromorpho.set_cache(cache_dir)
+        neuromorpho.download_all(self.names, os.path.join(self.dirname, 'a'), threads=8)
+        self.assertEqual(len(os.listdir(cache_dir)), 40)
+        # a second batch is served from the cache
+        del self.server.requests[:]
+        neuromorpho.set_cache(cache_dir)
+        failed = neuromorpho.download_all(self.names, os.path.join(self.dirname, 'b'), threads=8)
+        self.assertEqual(failed, {})
+        self.assertEqual(self.server.requests, [])
+
+    def test_cache_eviction_from_threads(self):
+        cache_dir = os.path.join(self.dirname, 'cache')
+        neuromorpho.set_cache(cache_dir, max_size=2000)
+        failed = neuromorpho.download_all(self.names, self.dirname, threads=8)
+        self.assertEqual(failed, {})
+        self.assertDownloaded(self.names)
+        files = os.listdir(cache_dir)
+        size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in files)
+        self.assertEqual(neuromorpho._cache_size[0], size)
+        self.assertLessEqual(size, 2000)
+        self.assertFalse([name for name in files if name.endswith('.tmp')])
+
+    def test_cache_leaves_other_files(self):
+        cache_dir = os.path.join(self.dirname, 'cache')
+        os.makedirs(os.path.join(cache_dir, 'subdir'))
+        with open(os.path.join(cache_dir, 'notes.txt'), 'w') as f:
+            f.write('x' * 5000)
+        neuromorpho.set_cache(cache_dir, max_size=2000)
+        failed = neuromorpho.download_all(self.names[:5], os.path.join(self.dirname, 'a'))
+        self.assertEqual(failed, {})
+        pages = [name for name in os.listdir(cache_dir) if name.endswith('.page')]
+        self.assertTrue(pages)
+        self.assertEqual(neuromorpho._cache_size[0],
+                         sum(os.path.getsize(os.path.join(cache_dir, name)) for name in pages))
+        neuromorpho.clear_cache()
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['notes.txt', 'subdir'])
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'neuromorpho')
+
+def _fixture(neuron_name):
+    with open(os.path.join(fixtures, 'neuron_info.jsp%3Fneuron_name=' + neuron_name), 'rb') as f:
+        return f.read()
+
+@unittest.skipIf(neuromorpho is None, 'neuromorpho needs Python 2')
+class ParseTest(unittest.TestCase):
+
+    def tearDown(self):
+        neuromorpho.set_cache(None)
+
+    def test_typed(self):
+        for (value, expected) in [('5', 5), ('-3', -3), ('+2', 2), ('0', 0), ('.5', 0.5), ('-.25', -0.25),
+                                  ('5.0', 5.0), ('1e3', 1000.0), ('1E2', 100.0), ('1.2.3', '1.2.3'),
+                                  ('-', '-'), ('Not reported', 'Not reported'), ('', '')]:
+            self.assertEqual(neuromorpho._typed(value), expected)
+            self.assertEqual(type(neuromorpho._typed(value)), type(expected))
+
+    def test_parse_neuron_info(self):
+        info, links = neuromorpho.parse_neuron_info(_fixture('mb100318-a'))
+        self.assertEqual(len(info), 47)
+        self.assertEqual(info['Neuron Name'], 'mb100318-a')
+        self.assertEqual(info['NeuroMorpho.Org ID'], 'NMO_04548')
+        self.assertEqual(info['Brain Region'], 'neocortex, layer 4')
+        self.assertEqual(info['Strain'], 'Not reported')
+        self.assertEqual(info['Soma Surface'], 297.66)
+        self.assertEqual(info['Total Volume'], 1412.25)
+        self.assertEqual(info['Average Bifurcation Angle Local'], 79.3)
+        self.assertEqual(info['Magnification'], 100)
+        self.assertEqual(info['Max Branch Order'], 12)
+        self.assertEqual(info['Date of Upload'], '2012-01-27')
+        self.assertEqual(links, {'swc': 'scanziani/CNG%20version/mb100318-a.CNG.swc',
+                                 'original': 'scanziani/Source-Version/mb100318-a.asc'})
+
+    def test_untyped(self):
+        info, links = neuromorpho.parse_neuron_info(_fixture('mb100318-a'), typed=False)
+        self.assertEqual(info['Soma Surface'], '297.66')
+        self.assertEqual(info['Magnification'], '100')
+        self.assertEqual(info['Max Branch Order'], '12')
+
+    def test_leading_decimal_point(self):
+        info, links = neuromorpho.parse_neuron_info(_fixture('cnic_001'))
+        self.assertEqual(info['Average Diameter'], 0.5)
+
+    def test_links_outside_cells(self):
+        info, links = neuromorpho.parse_neuron_info(_fixture('Cell-1-2'))
+        self.assertEqual(info['Neuron Name'], 'Cell-1-2')
+        self.assertEqual(links, {'swc': 'claiborne/CNG%20version/Cell-1-2.CNG.swc',
+                                 'original': 'claiborne/Source-Version/Cell-1-2.asc'})
+
+    def test_metadata_from_mirror(self):
+        neuromorpho.set_cache(None, mirror=fixtures)
+        for name in ['mb100318-a', 'cnic_001', 'Cell-1-2']:
+            info = neuromorpho.metadata(name)
+            self.assertEqual(info['Neuron Name'], name)
+            self.assertEqual(info, neuromorpho.parse_neuron_info(_fixture(name))[0])
+            self.assertEqual(neuromorpho.metadata(name, typed=False),
+                             neuromorpho.parse_neuron_info(_fixture(name), typed=False)[0])
+
+    def test_mirror_file_names(self):
+        neuromorpho.set_cache(None, mirror='m')
+        url = 'http://neuromorpho.org/getdataforbyregion.jsp?region=CA1%20stratum:radiatum*'
+        self.assertEqual(neuromorpho._mirror_file(url),
+                         os.path.join('m', 'getdataforbyregion.jsp%3Fregion=CA1%2520stratum%3Aradiatum%2A'))
+
+    def test_benchmark(self):
+        self.assertGreater(neuromorpho.benchmark(fixtures, repeat=1), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Tests for PyNeuronToolbox.record.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    from neuron import h
+    from PyNeuronToolbox import record
+except ImportError:
+    record = None
+
+@unittest.skipIf(record is None, 'needs numpy and NEURON')
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        h.load_file('stdrun.hoc')
+        self.soma = h.Section(name='soma')
+        self.soma.insert('hh')
+        self.dend = h.Section(name='dend')
+        self.dend.nseg = 5
+        self.dend.insert('pas')
+        self.dend.connect(self.soma(1))
+        self.stim = h.IClamp(self.soma(0.5))
+        self.stim.delay, self.stim.dur, self.stim.amp = 2, 20, 0.3
+        self.sections = [self.soma, self.dend]
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        self.stim = self.soma = self.dend = self.sections = None
+
+    def reference(self, tstop, dt=None):
+        data, labels = record.ez_record(h, sections=self.sections, dt=dt)
+        h.finitialize(-65)
+        h.continuerun(tstop)
+        return record.ez_convert(data), labels
+
+    def test_stream_recorder(self):
+        expected, labels = self.reference(30)
+        data, labels = record.ez_record(h, sections=self.sections)
+        fname, tname = os.path.join(self.dirname, 'v.npy'), os.path.join(self.dirname, 't.npy')
+        rec = record.StreamRecorder(h, data, fname, tfile=tname)
+        h.finitialize(-65)
+        rec.run(30, chunk=7)
+        rec.close()
+        v = np.load(fname, mmap_mode='r')
+        t = np.load(tname)
+        np.testing.assert_array_equal(v, expected)
+        self.assertEqual(len(t), len(v))
+        np.testing.assert_allclose(t[[0, -1]], [0, 30])
+        # the h.Vector() objects are emptied after every chunk
+        self.assertEqual(len(data[0]), 0)
+
+    def test_stream_recorder_dt(self):
+        expected, labels = self.reference(30, dt=0.5)
+        data, labels = record.ez_record(h, sections=self.sections, dt=0.5)
+        fname, tname = os.path.join(self.dirname, 'v.npy'), os.path.join(self.dirname, 't.npy')
+        rec = record.StreamRecorder(h, data, fname, tfile=tname, dt=0.5)
+        h.finitialize(-65)
+        rec.run(30, chunk=7)
+        rec.close()
+        np.testing.assert_array_equal(np.load(fname), expected)
+        np.testing.assert_allclose(np.load(tname), np.arange(len(expected)) * 0.5)
+
+    def test_record_vars(self):
+        syn = h.ExpSyn(self.dend(0.3))
+        data, labels, sections = record.record_vars(h, ['v', 'ina'], sections=[self.soma],
+                                                    point_processes=[(syn, 'i')])
+        self.assertEqual(len(data), 3)
+        self.assertEqual(list(labels['var']), ['v', 'ina', 'i'])
+        self.assertEqual(list(labels['sec']), [0, 0, -1])
+        np.testing.assert_allclose(labels['x'], [0.5, 0.5, 0.3])
+        h.finitialize(-65)
+        h.continuerun(10)
+        self.assertEqual(len(data[0]), len(data[2]))
+        self.assertLess(min(data[1]), 0)
+
+    def test_gather_recorder(self):
+        expected, labels = self.reference(30)
+        with record.GatherRecorder(h, 'v', sections=self.sections) as rec:
+            h.finitialize(-65)
+            h.continuerun(30)
+        np.testing.assert_allclose(rec.data, expected)
+        self.assertEqual(len(rec.t), len(expected))
+        # removed (here by the with block) recorders no longer sample
+        h.finitialize(-65)
+        h.continuerun(5)
+        self.assertEqual(len(rec.data), len(expected))
+
+    def test_gather_recorder_dt(self):
+        expected, labels = self.reference(30, dt=0.5)
+        rec = record.GatherRecorder(h, 'v', sections=self.sections, dt=0.5, block=16)
+        h.finitialize(-65)
+        h.continuerun(30)
+        rec.remove()
+        np.testing.assert_allclose(rec.t[:len(expected)], np.arange(len(expected)) * 0.5)
+        np.testing.assert_allclose(rec.data[:len(expected)], expected)
+
+    def test_gather_recorder_released(self):
+        import weakref
+        rec = record.GatherRecorder(h, 'v', sections=self.sections, dt=0.5)
+        h.finitialize(-65)
+        h.continuerun(10)
+        ref = weakref.ref(rec)
+        # NEURON does not keep a dropped recorder (or its sections) alive
+        rec = None
+        self.assertIsNone(ref())
+        self.soma = self.dend = self.sections = self.stim = None
+        soma = h.Section(name='soma2')
+        h.finitialize(-65)
+        h.continuerun(5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests for PyNeuronToolbox.storage.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    from PyNeuronToolbox import storage
+except ImportError:
+    storage = None
+
+@unittest.skipIf(storage is None, 'needs numpy')
+class TraceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.data = rng.normal(size=(1000, 37))
+        self.t = np.arange(1000) * 0.025
+        self.labels = np.array(['trace%d' % i for i in range(37)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def check(self, store):
+        self.assertEqual(store.shape, self.data.shape)
+        self.assertEqual(len(store), 1000)
+        np.testing.assert_array_equal(store[:, :], self.data)
+        np.testing.assert_array_equal(store.t, self.t)
+        np.testing.assert_array_equal(store.labels, self.labels)
+        for key in [(5, 3), (slice(100, 700, 7), 20), (slice(None), [0, 36, 11]),
+                    (-1, slice(None)), (slice(990, None), slice(-5, None)), 250]:
+            np.testing.assert_array_equal(store[key], self.data[key])
+        np.testing.assert_array_equal(store.trace(12), self.data[:, 12])
+        # tstart <= t < tstop
+        window = (self.t >= 5) & (self.t < 10)
+        np.testing.assert_array_equal(store.window(5, 10), self.data[window])
+        np.testing.assert_array_equal(store.window(5, 10, traces=[1, 2]), self.data[window][:, [1, 2]])
+
+    def test_save_traces(self):
+        for compress in (True, False):
+            dirname = os.path.join(self.dirname, str(compress))
+            storage.save_traces(dirname, self.data, labels=self.labels, t=self.t,
+                                chunk_rows=128, chunk_cols=16, compress=compress)
+            self.check(storage.TraceStore(dirname))
+
+    def test_append_in_pieces(self):
+        writer = storage.TraceWriter(self.dirname, 37, labels=self.labels, chunk_rows=100, chunk_cols=10)
+        for i in range(0, 1000, 73):
+            writer.append(self.data[i:i+73])
+            writer.time.append(self.t[i:i+73])
+        writer.close()
+        self.check(storage.TraceStore(self.dirname))
+
+    def test_lazy_loading(self):
+        storage.save_traces(self.dirname, self.data, t=self.t, chunk_rows=100, chunk_cols=10)
+        store = storage.TraceStore(self.dirname, cache_size=4)
+        np.testing.assert_array_equal(store[150:250, 12], self.data[150:250, 12])
+        # only the blocks holding rows 150-249 of trace 12 are read
+        self.assertEqual(sorted(store._cache), [(1, 1), (2, 1)])
+        store[:, :]
+        self.assertEqual(len(store._cache), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+"""
+Tests for PyNeuronToolbox.synapses. Pattern mode uses the PatternStim built
+into NEURON, so these tests do not need vecevent.mod.
+"""
+import unittest
+
+try:
+    import numpy as np
+    from neuron import h
+    from PyNeuronToolbox import synapses
+except ImportError:
+    synapses = None
+
+@unittest.skipIf(synapses is None, 'needs numpy and NEURON')
+class PatternBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        h.load_file('stdrun.hoc')
+        self.soma = h.Section(name='soma')
+        self.soma.L = self.soma.diam = 20
+        self.soma.insert('pas')
+        self.vrec = h.Vector()
+        self.vrec.record(self.soma(0.5)._ref_v)
+        self.batches = []
+
+    def tearDown(self):
+        # release the hoc objects before the section, also when a test failed
+        for batch in self.batches:
+            batch.remove()
+        self.vrec = None
+        self.soma = None
+
+    def run_v(self):
+        h.finitialize(-65)
+        h.continuerun(60)
+        return self.vrec.as_numpy().copy()
+
+    def add(self, times, weight, **kwargs):
+        times = np.asarray(times, dtype=float)
+        batch = synapses.add_exp2_batch(h, [self.soma(0.5)] * 2, times, [0, len(times)],
+                                        sources=[0, 0], weight=weight, pattern=True, **kwargs)
+        self.batches.append(batch)
+        return batch
+
+    def test_two_pattern_batches(self):
+        first = self.add([5, 10, 15], 1e-3)
+        v_alone = self.run_v()
+        # a second batch with zero weight must not drive the first one
+        second = self.add([30, 35, 40, 45], 0.0)
+        v_both = self.run_v()
+        self.assertGreater(v_alone.max() - v_alone.min(), 1)
+        np.testing.assert_array_equal(v_alone, v_both)
+        self.assertNotEqual(int(first.gids.max()), int(second.gids.min()))
+
+    def test_gid_base_in_use(self):
+        first = self.add([5], 1e-3)
+        gid_base = first.gid_base
+        with self.assertRaises(ValueError):
+            self.add([5], 1e-3, gid_base=gid_base)
+        # removing a batch frees its gids
+        first.remove()
+        second = self.add([5], 1e-3, gid_base=gid_base)
+        self.assertEqual(second.gid_base, gid_base)
+
+    def test_subset_offsets(self):
+        # three unsorted trains; the batches use only some of them
+        times = np.array([10., 5., 20., 15., 40., 30., 35.])
+        offsets = np.array([0, 2, 4, 7])
+        segs = [self.soma(0.5)] * 2
+        for (trains, expected) in [(offsets[:2], [5, 10]), (offsets[1:3], [15, 20]),
+                                   (offsets[2:], [30, 35, 40])]:
+            batch = synapses.add_exp2_batch(h, segs, times, trains, sources=[0, 0],
+                                            weight=1e-3, pattern=True)
+            self.batches.append(batch)
+            np.testing.assert_array_equal(batch.spikes.as_numpy(), expected)
+            v_subset = self.run_v()
+            batch.remove()
+            self.add(expected, 1e-3)
+            np.testing.assert_array_equal(v_subset, self.run_v())
+            self.batches.pop().remove()
+
+@unittest.skipIf(synapses is None, 'needs numpy and NEURON')
+class TrainsTest(unittest.TestCase):
+
+    def test_sort_trains_subset(self):
+        times = np.array([3., 1., 2., 9., 8., 7., 6., 5.])
+        offsets = np.array([0, 2, 3, 6, 8])
+        np.testing.assert_array_equal(synapses.sort_trains(times, offsets[1:4]),
+                                      [3, 1, 2, 7, 8, 9, 6, 5])
+        np.testing.assert_array_equal(synapses.sort_trains(times, offsets),
+                                      [1, 3, 2, 7, 8, 9, 5, 6])
+        sorted_times = synapses.sort_trains(times, offsets)
+        self.assertIs(synapses.sort_trains(sorted_times, offsets[:3]), sorted_times)
+
+    def test_unique_trains_subset(self):
+        times = np.array([1., 2., 1., 2., 3., 1., 2.])
+        offsets = np.array([0, 2, 4, 5, 7])
+        first, inverse = synapses.unique_trains(times, offsets[1:])
+        np.testing.assert_array_equal(first, [0, 1])
+        np.testing.assert_array_equal(inverse, [0, 1, 0])
+
+def _intervals(times, offsets):
+    # interspike intervals within the trains
+    train = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return np.diff(times)[train[1:] == train[:-1]]
+
+@unittest.skipIf(synapses is None, 'needs numpy and NEURON')
+class GeneratorTest(unittest.TestCase):
+
+    def assertTrains(self, times, offsets, n, tstart, tstop):
+        self.assertEqual(len(offsets), n + 1)
+        self.assertEqual(offsets[0], 0)
+        self.assertEqual(offsets[-1], len(times))
+        self.assertTrue(np.all((times >= tstart) & (times < tstop)))
+        self.assertTrue(np.all(_intervals(times, offsets) >= 0))
+
+    def test_poisson(self):
+        times, offsets = synapses.poisson_trains(2000, 10.0, 10000, tstart=100, seed=0)
+        self.assertTrains(times, offsets, 2000, 100, 10000)
+        counts = np.diff(offsets)
+        # 99 spikes expected per train, with a variance equal to the mean
+        self.assertAlmostEqual(counts.mean() / 99, 1, delta=0.01)
+        self.assertAlmostEqual(counts.var() / counts.mean(), 1, delta=0.1)
+        isi = _intervals(times, offsets)
+        self.assertAlmostEqual(isi.mean() / 100, 1, delta=0.01)
+        self.assertAlmostEqual(isi.std() / isi.mean(), 1, delta=0.02)
+
+    def test_gamma(self):
+        for order in (2, 4):
+            times, offsets = synapses.renewal_trains(1000, 20.0, 10000, order=order, seed=1)
+            self.assertTrains(times, offsets, 1000, 0, 10000)
+            isi = _intervals(times, offsets)
+            self.assertAlmostEqual(isi.mean() / 50, 1, delta=0.01)
+            self.assertAlmostEqual(isi.std() / isi.mean(), 1 / np.sqrt(order), delta=0.02)
+
+    def test_refractory(self):
+        times, offsets = synapses.renewal_trains(1000, 10.0, 10000, refractory=20, seed=2)
+        isi = _intervals(times, offsets)
+        self.assertGreaterEqual(isi.min(), 20)
+        self.assertAlmostEqual(isi.mean() / 100, 1, delta=0.01)
+        # a Poisson process with dead time: the intervals minus it are exponential
+        self.assertAlmostEqual((isi - 20).std() / (isi - 20).mean(), 1, delta=0.02)
+        with self.assertRaises(ValueError):
+            synapses.renewal_trains(10, 10.0, 1000, refractory=100)
+
+    def test_rate_per_train(self):
+        rate = np.tile([0.0, 5.0, 50.0], 500)
+        times, offsets = synapses.poisson_trains(len(rate), rate, 10000, seed=3)
+        counts = np.diff(offsets).reshape(-1, 3)
+        self.assertEqual(counts[:, 0].max(), 0)
+        np.testing.assert_allclose(counts[:, 1:].mean(axis=0), [50, 500], rtol=0.02)
+
+    def test_seed(self):
+        a = synapses.renewal_trains(50, 10.0, 1000, order=3, seed=7)
+        b = synapses.renewal_trains(50, 10.0, 1000, order=3, seed=np.random.RandomState(7))
+        c = synapses.renewal_trains(50, 10.0, 1000, order=3, seed=8)
+        for (x, y) in zip(a, b):
+            np.testing.assert_array_equal(x, y)
+        self.assertFalse(np.array_equal(a[0], c[0]))
+
+    def test_inhomogeneous(self):
+        tvec = np.arange(0, 1001, 1.0)
+        rates = 20 + 20 * np.sin(2 * np.pi * tvec / 250)
+        times, offsets = synapses.inhomogeneous_poisson_trains(4000, (tvec, rates), 1000, seed=4)
+        self.assertTrains(times, offsets, 4000, 0, 1000)
+        # spikes per 25 ms bin over all trains against the integrated rate
+        edges = np.arange(0, 1001, 25)
+        hist = np.histogram(times, edges)[0]
+        integral = np.concatenate(([0], np.cumsum((rates[1:] + rates[:-1]) / 2 * np.diff(tvec))))
+        expected = 4000 * np.diff(integral[edges.astype(int)]) / 1e3
+        np.testing.assert_allclose(hist, expected, rtol=0, atol=4 * np.sqrt(expected.max()))
+        # the same rate as a function
+        times_fn, offsets_fn = synapses.inhomogeneous_poisson_trains(
+            4000, lambda t, i: 20 + 20 * np.sin(2 * np.pi * t / 250), 1000, rate_max=40, seed=4)
+        np.testing.assert_allclose(np.histogram(times_fn, edges)[0], expected, rtol=0,
+                                   atol=4 * np.sqrt(expected.max()))
+        with self.assertRaises(ValueError):
+            synapses.inhomogeneous_poisson_trains(10, lambda t, i: t, 1000)
+
+    def test_inhomogeneous_rows(self):
+        tvec = np.array([0.0, 1000.0])
+        rates = np.array([[0.0, 0.0], [10.0, 10.0], [0.0, 40.0]])
+        times, offsets = synapses.inhomogeneous_poisson_trains(1500, (tvec, np.repeat(rates, 500, axis=0)),
+                                                               1000, seed=5)
+        counts = np.diff(offsets).reshape(3, -1)
+        self.assertEqual(counts[0].max(), 0)
+        np.testing.assert_allclose(counts[1:].mean(axis=1), [10, 20], rtol=0.05)
+
+if __name__ == '__main__':
+    unittest.main()